@@ -34,8 +34,23 @@ Loom adds the following new commands:
  * revert-loom: Revert all change in the current stack of patches to the last
    recorded one.
 
- * show-loom: Shows the threads in the loom. It currently does not show the
-   # of commits in each thread, but it is planned to do that in the future.
+ * show-loom: Shows the threads in the loom. With --stats it also shows the
+   # of commits in each thread and a diffstat against the thread below.
+
+ * loom-log: Shows how the threads in the loom changed each time it was
+   recorded.
+
+ * loom-prune: Removes every thread that has been merged into the thread
+   below it, or into upstream.
+
+ * loom-serve: Runs a daemon that answers queries about looms on a Unix
+   socket, for tools that would otherwise run show-loom over and over.
+
+ * export-patches: Writes each thread out as a patch against the thread
+   below it, as a directory of patches or as an mbox.
+
+ * import-series: Imports a quilt patch series, creating a thread for each
+   patch.
 
  * down-thread: Move the branch down a thread. After doing this commits and 
    merges in this branch will affect the newly selected thread.
@@ -50,6 +65,10 @@ Loom adds the following new commands:
    to remove a thread which has been merged into upstream. 
 
 
+'bzr status' on a loom shows the current thread, whether it has commits that
+are not recorded in the loom, how many threads above it need an up-thread, and
+whether the loom has unrecorded changes.
+
 Loom also adds new revision specifiers 'thread:' and 'below:'. You can use these
 to diff against threads in the current Loom. For instance, 'bzr diff -r
 thread:' will show you the different between the thread below yours, and your
@@ -67,12 +86,8 @@ if brz_minimum_version > breezy_version_info:
     raise Exception('Breezy version too old')
 
 from breezy import branch as _mod_branch
-import breezy.builtins
 import breezy.commands
-
-from breezy.plugins.loom import (
-    commands,
-    )
+import breezy.errors
 
 
 for command in [
@@ -80,26 +95,27 @@ for command in [
     'create_thread',
     'down_thread',
     'export_loom',
+    'export_patches',
+    'import_series',
+    'loom_benchmark',
+    'loom_log',
+    'loom_prune',
+    'loom_serve',
     'loomify',
     'record',
     'revert_loom',
     'show_loom',
+    # Overrides the builtin switch, falling back to it for normal branches.
+    'switch',
     'up_thread',
     ]:
     breezy.commands.plugin_cmds.register_lazy('cmd_' + command, [],
         'breezy.plugins.loom.commands')
 
-# XXX: bzr fix needed: for switch, we have to register directly, not
-# lazily, because register_lazy does not stack in the same way register_command
-# does.
-if not hasattr(breezy.builtins, "cmd_switch"):
-    # provide a switch command (allows 
-    breezy.commands.register_command(getattr(commands, 'cmd_switch'))
-else:
-    commands.cmd_switch._original_command = breezy.commands.register_command(
-        getattr(commands, 'cmd_switch'), True)
+from breezy.hooks import install_lazy_named_hook, known_hooks
+known_hooks.register_lazy_hook('breezy.plugins.loom.timing', 'hooks',
+    'LoomTimingHooks')
 
-from breezy.hooks import install_lazy_named_hook
 def show_loom_summary(params):
     branch = getattr(params.new_tree, "branch", None)
     if branch is None:
@@ -109,11 +125,40 @@ def show_loom_summary(params):
         require_loom_branch(branch)
     except NotALoom:
         return
-    params.to_file.write('Current thread: %s\n' % branch.nick)
+    from breezy.plugins.loom import stats
+    with branch.lock_read():
+        state = branch.get_loom_state()
+        threads = state.get_threads()
+        nick = branch.nick
+        if not threads:
+            params.to_file.write('Current thread: %s\n' % nick)
+            return
+        loom_unrecorded, flags = stats.loom_summary(branch, state)
+    current = state.thread_index(nick)
+    if flags[current][0]:
+        params.to_file.write(
+            'Current thread: %s (unrecorded commits)\n' % nick)
+    else:
+        params.to_file.write('Current thread: %s\n' % nick)
+    behind = len([flag for flag in flags[current + 1:] if flag[1]])
+    if behind:
+        params.to_file.write('Threads above needing up-thread: %d\n' % behind)
+    if loom_unrecorded:
+        params.to_file.write('Loom has unrecorded changes.\n')
 
 install_lazy_named_hook('breezy.status', 'hooks', 'post_status',
     show_loom_summary, 'loom status')
 
+
+def log_loom_timings(command):
+    from breezy import debug
+    if 'loomtime' in debug.debug_flags:
+        from breezy.plugins.loom import timing
+        timing.log_profile(command)
+
+install_lazy_named_hook('breezy.commands', 'Command.hooks', 'post_command',
+    log_loom_timings, 'loom timings')
+
 try:
     from breezy.registry import register_lazy
 except ImportError: # bzr < 2.6
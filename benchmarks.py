@@ -0,0 +1,321 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+
+"""Benchmarks of loom operations on synthetic looms.
+
+The looms are described by a LoomShape, and each benchmark builds a fresh
+loom of that shape before every timed run, so only the operation itself is
+measured. run_benchmarks returns a dict that is easily written as JSON, to
+compare results between releases.
+"""
+
+from __future__ import absolute_import
+
+from io import BytesIO
+import tempfile
+import time
+
+import breezy
+from breezy import (
+    controldir,
+    osutils,
+    transport as _mod_transport,
+    )
+
+from breezy.commit import NullCommitReporter
+
+from breezy.plugins.loom import (
+    branch as loom_branch,
+    loom_io,
+    loom_state,
+    )
+from breezy.plugins.loom.tree import LoomTreeDecorator
+
+
+_COMMITTER = 'Loom Benchmark <loom-benchmark@example.com>'
+
+
+class LoomShape(object):
+    """The shape of a synthetic loom.
+
+    :ivar threads: The number of threads, including the base thread.
+    :ivar commits: The number of commits in each thread.
+    :ivar parents: The number of recorded looms in the loom's history, and
+        the number of parent looms in the state used for the I/O round trip.
+    :ivar files: The number of files in the tree.
+    """
+
+    def __init__(self, threads=10, commits=5, parents=2, files=100):
+        self.threads = threads
+        self.commits = commits
+        self.parents = parents
+        self.files = files
+
+    def as_dict(self):
+        return {'threads': self.threads, 'commits': self.commits,
+            'parents': self.parents, 'files': self.files}
+
+
+def _thread_name(index):
+    return 'thread-%d' % index
+
+
+def _commit(tree, message, **kwargs):
+    return tree.commit(message, committer=_COMMITTER,
+        reporter=NullCommitReporter(), **kwargs)
+
+
+def make_loom(path, shape):
+    """Create a loom of the given shape at path.
+
+    Each thread above the base thread has its own file, changed by each of
+    its commits, so threads merge without conflicts.
+
+    :return: The working tree of the loom, on its top thread.
+    """
+    tree = controldir.ControlDir.create_standalone_workingtree(path)
+    tree.branch.get_config_stack().set('email', _COMMITTER)
+    tree.branch.nick = _thread_name(0)
+    tree.controldir.root_transport.mkdir('files')
+    for index in range(shape.files):
+        tree.controldir.root_transport.put_bytes('files/%d' % index,
+            b'file %d\n' % index)
+    tree.smart_add([tree.basedir])
+    _commit(tree, 'base')
+    loom_branch.loomify(tree.branch)
+    tree = tree.controldir.open_workingtree()
+    tree.branch.new_thread(_thread_name(0))
+    for thread in range(1, shape.threads):
+        loom_branch.create_thread(tree.branch, _thread_name(thread))
+        filename = 'thread-%d' % thread
+        for commit in range(shape.commits):
+            tree.controldir.root_transport.put_bytes(filename,
+                b'commit %d\n' % commit)
+            if not commit:
+                tree.add([filename])
+            _commit(tree, '%s commit %d' % (filename, commit))
+    for record in range(shape.parents):
+        if record:
+            # Give each recorded loom something to record.
+            _commit(tree, 'record %d' % record, allow_pointless=True)
+        tree.branch.record_loom('record %d' % record)
+    return tree
+
+
+def _commit_to_base(tree):
+    """Commit a change to the base thread, leaving the tree on it."""
+    LoomTreeDecorator(tree).down_thread(_thread_name(0))
+    tree.controldir.root_transport.put_bytes('files/0', b'changed\n')
+    _commit(tree, 'change the base thread')
+
+
+class _Benchmark(object):
+    """A benchmark of one loom operation.
+
+    Subclasses implement setUp, which prepares a run and returns the
+    arguments for run, and run, which is what gets timed.
+    """
+
+    name = None
+
+    def __init__(self, shape, directory):
+        self.shape = shape
+        self.directory = directory
+
+    def setUp(self):
+        return ()
+
+    def run(self, *args):
+        raise NotImplementedError(self.run)
+
+
+class LoomStateRoundTrip(_Benchmark):
+
+    name = 'loom_state_round_trip'
+
+    def setUp(self):
+        parents = [b'parent-%d' % parent for parent in range(self.shape.parents)]
+        state = loom_state.LoomState()
+        state.set_parents(parents)
+        state.set_threads([
+            (_thread_name(thread), b'revision-%d' % thread, list(parents))
+            for thread in range(self.shape.threads)])
+        return (state,)
+
+    def run(self, state):
+        stream = BytesIO()
+        loom_io.LoomStateWriter(state).write(stream)
+        stream.seek(0)
+        loom_state.LoomState(loom_io.LoomStateReader(stream))
+
+
+class _LoomBenchmark(_Benchmark):
+    """A benchmark that runs on a freshly made synthetic loom."""
+
+    def make_loom(self, name='loom'):
+        return make_loom(osutils.pathjoin(self.directory, name), self.shape)
+
+    def setUp(self):
+        return (self.make_loom(),)
+
+
+class GetLoomState(_LoomBenchmark):
+
+    name = 'get_loom_state'
+
+    def run(self, tree):
+        tree.branch.get_loom_state()
+
+
+class RecordLoom(_LoomBenchmark):
+
+    name = 'record_loom'
+
+    def setUp(self):
+        tree = self.make_loom()
+        _commit(tree, 'unrecorded change', allow_pointless=True)
+        return (tree,)
+
+    def run(self, tree):
+        tree.branch.record_loom('benchmark')
+
+
+class UpThread(_LoomBenchmark):
+
+    name = 'up_thread'
+
+    def setUp(self):
+        tree = self.make_loom()
+        _commit_to_base(tree)
+        return (tree,)
+
+    def run(self, tree):
+        with tree.lock_write():
+            LoomTreeDecorator(tree).up_many()
+
+
+class DownThread(_LoomBenchmark):
+
+    name = 'down_thread'
+
+    def run(self, tree):
+        LoomTreeDecorator(tree).down_thread(_thread_name(0))
+
+
+class ExportLoom(_LoomBenchmark):
+
+    name = 'export_loom'
+
+    def setUp(self):
+        tree = self.make_loom()
+        root_transport = _mod_transport.get_transport(
+            osutils.pathjoin(self.directory, 'export'))
+        root_transport.ensure_base()
+        return (tree, root_transport)
+
+    def run(self, tree, root_transport):
+        tree.branch.export_threads(root_transport)
+
+
+class Branch(_LoomBenchmark):
+
+    name = 'branch'
+
+    def run(self, tree):
+        tree.controldir.sprout(osutils.pathjoin(self.directory, 'branch'))
+
+
+class _TransferBenchmark(_LoomBenchmark):
+    """A benchmark of moving new loom revisions between two looms."""
+
+    def setUp(self):
+        tree = self.make_loom()
+        copy = tree.controldir.sprout(
+            osutils.pathjoin(self.directory, 'copy')).open_branch()
+        _commit_to_base(tree)
+        tree.branch.record_loom('new loom')
+        return (tree.branch, copy)
+
+
+class Pull(_TransferBenchmark):
+
+    name = 'pull'
+
+    def run(self, source, target):
+        target.pull(source)
+
+
+class Push(_TransferBenchmark):
+
+    name = 'push'
+
+    def run(self, source, target):
+        source.push(target)
+
+
+BENCHMARKS = [
+    LoomStateRoundTrip,
+    GetLoomState,
+    RecordLoom,
+    UpThread,
+    DownThread,
+    ExportLoom,
+    Branch,
+    Pull,
+    Push,
+    ]
+
+
+def run_benchmarks(shape, repeat=3, names=None, scratch_dir=None):
+    """Run the loom benchmarks.
+
+    :param shape: The LoomShape of the looms to benchmark with.
+    :param repeat: How many times to time each operation.
+    :param names: The names of the benchmarks to run, or None for all.
+    :param scratch_dir: The directory to build looms in, or None for the
+        system temporary directory.
+    :return: A dict holding the shape, the breezy version, and for each
+        benchmark the time of every run, in seconds, with their minimum and
+        median.
+    """
+    results = {}
+    for benchmark_class in BENCHMARKS:
+        if names is not None and benchmark_class.name not in names:
+            continue
+        times = []
+        for unused in range(repeat):
+            directory = tempfile.mkdtemp(prefix='loom-benchmark-',
+                                         dir=scratch_dir)
+            try:
+                benchmark = benchmark_class(shape, directory)
+                args = benchmark.setUp()
+                start = time.perf_counter()
+                benchmark.run(*args)
+                times.append(time.perf_counter() - start)
+            finally:
+                osutils.rmtree(directory)
+        times_sorted = sorted(times)
+        results[benchmark_class.name] = {
+            'runs': times,
+            'min': times_sorted[0],
+            'median': times_sorted[len(times_sorted) // 2],
+            }
+    return {
+        'shape': shape.as_dict(),
+        'breezy_version': breezy.__version__,
+        'results': results,
+        }
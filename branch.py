@@ -33,6 +33,7 @@ from breezy import (
     commit as _mod_commit,
     controldir,
     errors,
+    osutils,
     symbol_versioning,
     trace,
     ui,
@@ -49,9 +50,12 @@ from breezy.bzr import (
 from breezy.revision import is_null, NULL_REVISION
 
 from breezy.plugins.loom import (
+    loom_index,
     loom_io,
     loom_state,
     require_loom_branch,
+    state_cache,
+    timing,
     NotALoom,
     )
 
@@ -62,6 +66,13 @@ EMPTY_REVISION = b'empty:'
 from breezy.bzr.fullhistory import BzrBranch5, BzrBranchFormat5
 
 
+def _fetch(target_repository, source_repository, **kwargs):
+    """Fetch into target_repository, timing and counting the fetch."""
+    timing.count('fetch')
+    with timing.span('fetch'):
+        target_repository.fetch(source_repository, **kwargs)
+
+
 def create_thread(loom, thread_name):
     """Create a thread in the branch loom called thread."""
     require_loom_branch(loom)
@@ -112,6 +123,16 @@ class LoomThreadError(errors.BzrError):
         self.thread = thread
 
 
+class LoomStateChanged(errors.BzrError):
+
+    _fmt = """The loom state of %(branch)s changed while it was being \
+updated."""
+
+    def __init__(self, branch):
+        errors.BzrError.__init__(self)
+        self.branch = branch
+
+
 class UnrecordedRevision(errors.BzrError):
 
     _fmt = """The revision %(revision_id)s is not recorded in the loom %(branch)s."""
@@ -203,6 +224,12 @@ class LoomMetaTree(_mod_inventorytree.InventoryTree):
 class LoomSupport(object):
     """Loom specific logic called into from Branch."""
 
+    # Set when the branch tip, the nick or the loom state change, so unlock
+    # knows whether the current thread may need recording.
+    _thread_tip_changed = False
+    # The loom state and its key, cached while the branch is locked.
+    _loom_state_cache = None
+
     def _adjust_nick_after_changing_threads(self, threads, current_index):
         """Adjust the branch nick when we may have removed a current thread.
 
@@ -285,18 +312,95 @@ class LoomSupport(object):
         return format
 
     def get_loom_state(self):
-        """Get the current loom state object."""
-        # TODO: cache the loom state during the transaction lifetime.
-        current_content = self._transport.get('last-loom')
-        reader = loom_io.LoomStateReader(current_content)
-        state = loom_state.LoomState(reader)
-        return state
+        """Get the current loom state object.
+
+        While the branch is locked, last-loom is only read once: later calls,
+        such as each thread: revision specifier in a command, get a copy of
+        the cached state. The caller may change the state it gets.
+        """
+        return self.get_loom_state_and_key()[0]
+
+    def get_loom_state_and_key(self):
+        """Get the current loom state and the key of its version.
+
+        Reading does not need a lock: last-loom is replaced atomically, so
+        readers see either the old or the new state, never a mix.
+
+        :return: A (state, key) tuple. The key is the sha1 of last-loom, to
+            pass to set_loom_state_if_unchanged.
+        """
+        if self._loom_state_cache is not None:
+            state, key = self._loom_state_cache
+            return state.copy(), key
+        timing.count('last-loom.read')
+        with timing.span('branch.read_state'):
+            content = self._transport.get_bytes('last-loom')
+            reader = loom_io.LoomStateReader(BytesIO(content))
+            state = loom_state.LoomState(reader)
+        key = osutils.sha_string(content)
+        if self.is_locked():
+            self._loom_state_cache = (state.copy(), key)
+        return state, key
+
+    def get_loom_snapshot(self):
+        """Get an immutable snapshot of the current loom state.
+
+        Snapshots come from a cache shared by every branch object and thread
+        in the process, so concurrent readers of a loom parse last-loom once
+        between changes. Use get_loom_state for a state to change.
+
+        :return: A FrozenLoomState.
+        """
+        return state_cache.cache.get(self)[0]
+
+    def set_loom_state_if_unchanged(self, state, key):
+        """Write state, if last-loom is still the version key names.
+
+        The check and the write are done under a short write lock, so a
+        writer can read the state and work out its change without a lock,
+        and retry if another writer got in first.
+
+        :param state: The new LoomState.
+        :param key: The key of the state the change was based on, from
+            get_loom_state_and_key.
+        :raises LoomStateChanged: If last-loom has been changed since.
+        :return: The key of the new state.
+        """
+        with self.lock_write():
+            if self.get_loom_state_and_key()[1] != key:
+                raise LoomStateChanged(self)
+            return self._set_last_loom(state)
+
+    def update_loom_state(self, update, retries=5):
+        """Change the loom state with optimistic concurrency control.
+
+        :param update: A callable that is given a LoomState to change in
+            place. It may be called several times, each time with a fresh
+            state, so it should not have other side effects.
+        :param retries: How many times to retry when another writer changes
+            the state first.
+        :raises LoomStateChanged: If every attempt lost to another writer.
+        :return: The key of the new state.
+        """
+        for attempt in range(retries + 1):
+            state, key = self.get_loom_state_and_key()
+            update(state)
+            try:
+                return self.set_loom_state_if_unchanged(state, key)
+            except LoomStateChanged:
+                if attempt == retries:
+                    raise
+
+    def _clear_cached_state(self):
+        super(LoomSupport, self)._clear_cached_state()
+        self._loom_state_cache = None
     
     def get_old_bound_location(self):
         """Return the URL of the branch we used to be bound to."""
         # No binding for looms yet.
         raise errors.UpgradeRequired(self.base)
 
+    @timing.timed('branch.get_threads')
     def get_threads(self, rev_id):
         """Return the threads from a loom revision.
 
@@ -309,9 +413,139 @@ class LoomSupport(object):
                 DeprecationWarning, stacklevel=2)
         if is_null(rev_id):
             return []
-        content = self._loom_content(rev_id)
-        return self._parse_loom(content)
+        index = self._get_loom_index()
+        entry = index.get(rev_id)
+        if entry is None:
+            threads = self._parse_loom(self._loom_content(rev_id))
+            index.add(rev_id, self._get_loom_revision_parents(rev_id), threads)
+            self._save_loom_index()
+            return threads
+        return list(entry[1])
+
+    def _get_loom_index(self):
+        """Return the LoomIndex of the recorded looms in this branch."""
+        index = getattr(self, '_loom_index', None)
+        if index is None:
+            index = self._loom_index = loom_index.LoomIndex(self._transport)
+        return index
+
+    def _save_loom_index(self):
+        """Write new loom index entries out, if the branch is write locked.
+
+        Without the write lock another process could be appending to the
+        index too, and the transport may be read only, so read only
+        operations keep the entries they add in memory. The next save under
+        a write lock, such as record_loom's, writes them out.
+        """
+        if self.peek_lock_mode() == 'w':
+            self._get_loom_index().save()
+
+    def _get_loom_revision_parents(self, rev_id):
+        """Get the parents of a loom revision from the repository."""
+        parents = self.repository.get_parent_map([rev_id]).get(rev_id, ())
+        return [parent for parent in parents if not is_null(parent)]
+
+    def iter_loom_history(self, rev_id=None):
+        """Iterate over the left-hand history of recorded looms, newest first.
 
+        Looms missing from the loom index are indexed as they are reached,
+        a batch at a time.
+
+        :param rev_id: The loom revision to start from. Defaults to the last
+            recorded loom.
+        """
+        if rev_id is None:
+            rev_id = self.get_loom_state().get_basis_revision_id()
+        index = self._get_loom_index()
+        while not is_null(rev_id):
+            entry = index.get(rev_id)
+            if entry is None:
+                self._index_loom_history(index, rev_id)
+                entry = index.get(rev_id)
+                if entry is None:
+                    # A ghost.
+                    return
+            yield rev_id
+            parents = entry[0]
+            if not parents:
+                break
+            rev_id = parents[0]
+
+    def _index_loom_history(self, index, rev_id, batch_size=100):
+        """Index up to batch_size unindexed looms in the history of rev_id.
+
+        The parents are read through one Graph under a repository read lock,
+        so remote repositories answer from the ancestry each get_parent_map
+        request prefetches rather than with a round trip per loom. The loom
+        texts are fetched together with iter_files_bytes, and their keys are
+        found without building a revision tree for each loom.
+        """
+        with self.repository.lock_read():
+            graph = self.repository.get_graph()
+            parent_map = {}
+            while (not is_null(rev_id) and index.get(rev_id) is None and
+                   len(parent_map) < batch_size):
+                parents = graph.get_parent_map([rev_id]).get(rev_id)
+                if parents is None:
+                    break
+                parents = [parent for parent in parents if not is_null(parent)]
+                parent_map[rev_id] = parents
+                if not parents:
+                    break
+                rev_id = parents[0]
+            if not parent_map:
+                return
+            revision_ids = list(parent_map)
+            desired_files = []
+            for revision_id, text_key in zip(revision_ids,
+                    self._loom_text_keys(revision_ids)):
+                desired_files.append(text_key + (revision_id,))
+            for revision_id, chunks in self.repository.iter_files_bytes(
+                    desired_files):
+                threads = self._parse_loom(self._loom_lines(b''.join(chunks)))
+                index.add(revision_id, parent_map[revision_id], threads)
+        self._save_loom_index()
+
+    def _loom_text_keys(self, revision_ids):
+        """Return the text key of the loom file of each loom revision.
+
+        record_loom always gives the loom file the same file id, and a loom
+        whose threads changed introduces a new text of it, keyed by the loom
+        revision. Only looms whose text is carried over from a parent, such
+        as merges, need their inventory read to find the key.
+        """
+        keys = [(b'loom_meta_tree', revision_id)
+                for revision_id in revision_ids]
+        present = self.repository.texts.get_parent_map(keys)
+        missing = [revision_id for revision_id, key in zip(revision_ids, keys)
+                   if key not in present]
+        if missing:
+            trees = dict(zip(missing, self.repository.revision_trees(missing)))
+            for position, revision_id in enumerate(revision_ids):
+                tree = trees.get(revision_id)
+                if tree is not None:
+                    keys[position] = (tree.path2id('loom'),
+                                      tree.get_file_revision('loom'))
+        return keys
+
+    def get_loom_revision_id(self, revno):
+        """Return the id of a recorded loom.
+
+        :param revno: The position of the loom in the left-hand history of
+            recorded looms. 1 is the first loom recorded, and negative numbers
+            count back from the last one, so -1 is the last loom recorded.
+        """
+        if revno < 0:
+            for position, rev_id in enumerate(self.iter_loom_history(), 1):
+                if position == -revno:
+                    return rev_id
+        elif revno > 0:
+            history = list(self.iter_loom_history())
+            if revno <= len(history):
+                return history[-revno]
+        raise errors.InvalidRevisionNumber(revno)
+
+    @timing.timed('branch.export_threads')
     def export_threads(self, root_transport):
         """Export the threads in this loom as branches.
 
@@ -360,7 +594,11 @@ class LoomSupport(object):
         """
         tree = self.repository.revision_tree(rev_id)
         with tree.get_file('loom') as f:
-            lines = f.read().split(b'\n')
+            return self._loom_lines(f.read())
+
+    def _loom_lines(self, text):
+        """Split the text of a loom into the lines describing its threads."""
+        lines = text.split(b'\n')
         assert lines[0] == b'Loom meta 1'
         return lines[1:-1]
 
@@ -395,6 +633,29 @@ class LoomSupport(object):
         state.set_threads(threads)
         self._set_last_loom(state)
 
+    def insert_threads(self, new_threads, after_thread):
+        """Add several threads with existing revisions to this branch at once.
+
+        This writes the loom state once, rather than once per thread.
+
+        :param new_threads: A list of (thread_name, revision_id) tuples, in
+            loom order.
+        :param after_thread: The thread to insert the new threads after.
+        """
+        with self.lock_write():
+            state = self.get_loom_state()
+            threads = state.get_threads()
+            threads_dict = state.get_threads_dict()
+            for thread_name, revision_id in new_threads:
+                if thread_name in threads_dict:
+                    raise DuplicateThreadName(self, thread_name)
+            insertion_point = state.thread_index(after_thread) + 1
+            threads[insertion_point:insertion_point] = [
+                (thread_name, revision_id, [None] * len(state.get_parents()))
+                for thread_name, revision_id in new_threads]
+            state.set_threads(threads)
+            self._set_last_loom(state)
+
     def _parse_loom(self, content):
         """Parse the body of a loom file."""
         result = []
@@ -448,6 +709,7 @@ class LoomSupport(object):
             return _Pusher(self, target).transfer(overwrite, stop_revision,
                                                   run_hooks=True)
 
+    @timing.timed('branch.record_loom')
     def record_loom(self, commit_message):
         """Perform a 'commit' to the loom branch.
 
@@ -480,6 +742,9 @@ class LoomSupport(object):
                 pass
             builder.finish_inventory()
             rev_id = builder.commit(commit_message)
+            index = self._get_loom_index()
+            index.add(rev_id, parents, new_threads)
+            index.save()
             state.set_parents([rev_id])
             state.set_threads((thread + ([thread[1]],) for thread in new_threads))
             self._set_last_loom(state)
@@ -506,6 +771,26 @@ class LoomSupport(object):
             state.set_threads(threads)
             self._set_last_loom(state)
 
+    def record_threads(self, thread_revisions):
+        """Record updated versions of several existing threads at once.
+
+        This writes the loom state once, rather than once per thread as
+        record_thread does.
+
+        :param thread_revisions: A dict mapping thread names to the revisions
+            they are now at.
+        """
+        with self.lock_write():
+            state = self.get_loom_state()
+            threads = state.get_threads()
+            for position, (name, rev, parents) in enumerate(threads):
+                revision_id = thread_revisions.get(name, rev)
+                if is_null(revision_id):
+                    revision_id = EMPTY_REVISION
+                threads[position] = (name, revision_id, parents)
+            state.set_threads(threads)
+            self._set_last_loom(state)
+
     def remove_thread(self, thread_name):
         """Remove thread from the current loom.
 
@@ -519,6 +804,24 @@ class LoomSupport(object):
             state.set_threads(threads)
             self._set_last_loom(state)
 
+    def remove_threads(self, thread_names):
+        """Remove several threads from the current loom at once.
+
+        This writes the loom state once, rather than once per thread as
+        remove_thread does.
+
+        :param thread_names: The threads to remove.
+        """
+        with self.lock_write():
+            state = self.get_loom_state()
+            threads_dict = state.get_threads_dict()
+            for thread_name in thread_names:
+                if thread_name not in threads_dict:
+                    raise NoSuchThread(self, thread_name)
+            state.set_threads(thread for thread in state.get_threads()
+                if thread[0] not in thread_names)
+            self._set_last_loom(state)
+
     def revert_loom(self):
         """Revert the loom to be the same as the basis loom."""
         with self.lock_write():
@@ -560,38 +863,70 @@ class LoomSupport(object):
             # adjust the nickname to be valid
             self._adjust_nick_after_changing_threads(threads, position)
 
+    @timing.timed('branch.write_state')
     def _set_last_loom(self, state):
-        """Record state to the last-loom control file."""
+        """Record state to the last-loom control file.
+
+        put_file replaces the file atomically, writing a temporary file and
+        renaming it into place, so readers never see a partial state.
+
+        :return: The key of the new state, as get_loom_state_and_key gives.
+        """
+        timing.count('last-loom.write')
+        self._thread_tip_changed = True
         stream = BytesIO()
         writer = loom_io.LoomStateWriter(state)
         writer.write(stream)
+        key = osutils.sha_string(stream.getvalue())
         stream.seek(0)
         self._transport.put_file('last-loom', stream)
+        state_cache.cache.invalidate(self)
+        if self.is_locked():
+            self._loom_state_cache = (state.copy(), key)
+        return key
+
+    def set_last_revision_info(self, revno, revision_id):
+        """See Branch.set_last_revision_info."""
+        self._thread_tip_changed = True
+        super(LoomSupport, self).set_last_revision_info(revno, revision_id)
+
+    def _set_nick(self, nick):
+        self._thread_tip_changed = True
+        super(LoomSupport, self)._set_nick(nick)
 
     def unlock(self):
         """Unlock the loom after a lock.
 
         If at the end of the lock, the current revision in the branch is not
         recorded correctly in the loom, an automatic record is attempted.
+        That can only happen if the branch tip, the current thread or the loom
+        state were changed during the lock, so otherwise the loom state is not
+        read at all.
         """
         if (self.control_files._lock_count==1 and
-            self.control_files._lock_mode=='w'):
+            self.control_files._lock_mode=='w' and
+            self._thread_tip_changed):
             # about to release the lock
+            self._thread_tip_changed = False
             state = self.get_loom_state()
-            threads = state.get_threads()
-            if len(threads):
+            if state.get_threads():
                 # looms are enabled:
                 lastrev = self.last_revision()
                 if is_null(lastrev):
                     lastrev = EMPTY_REVISION
-                if dict(state.get_threads_dict())[self.nick][0] != lastrev:
-                    self.record_thread(self.nick, lastrev)
+                nick = self.nick
+                if state.get_thread_revision(nick) != lastrev:
+                    self.record_thread(nick, lastrev)
+                # Recording the thread is not a change that needs checking.
+                self._thread_tip_changed = False
         super(LoomSupport, self).unlock()
 
 
 class _Puller(object):
     # XXX: Move into InterLoomBranch.
 
+    span_name = 'transfer.pull'
+
     def __init__(self, source, target):
         self.target = target
         self.source = source
@@ -645,8 +980,7 @@ class _Puller(object):
         if new_rev == EMPTY_REVISION:
             new_rev = breezy.revision.NULL_REVISION
         fetch_spec = self.build_fetch_spec(stop_revision)
-        self.target.repository.fetch(self.source.repository,
-            fetch_spec=fetch_spec)
+        self.fetch(fetch_spec=fetch_spec)
         self.target.generate_revision_history(new_rev, self.target.last_revision(),
             self.source)
         tag_ret = self.source.tags.merge_to(self.target.tags)
@@ -658,6 +992,10 @@ class _Puller(object):
         self.do_hooks(result, run_hooks)
         return result
 
+    def fetch(self, **kwargs):
+        """Fetch from the source repository into the target repository."""
+        _fetch(self.target.repository, self.source.repository, **kwargs)
+
     def build_fetch_spec(self, stop_revision):
         factory = _mod_fetch.FetchSpecFactory()
         factory.source_branch = self.source
@@ -676,7 +1014,8 @@ class _Puller(object):
         pb = ui.ui_factory.nested_progress_bar()
         try:
             result = self.prepare_result(_override_hook_target)
-            with self.target.lock_write(), self.source.lock_read():
+            with self.target.lock_write(), self.source.lock_read(), \
+                    timing.span(self.span_name):
                 source_state = self.real_source.get_loom_state()
                 source_parents = source_state.get_parents()
                 if not source_parents:
@@ -695,8 +1034,7 @@ class _Puller(object):
                             raise errors.DivergedBranches(
                                 self.target, self.source)
                 # fetch the loom content
-                self.target.repository.fetch(self.source.repository,
-                    revision_id=source_loom_rev)
+                self.fetch(revision_id=source_loom_rev)
                 # get the threads for the new basis
                 threads = self.target.get_threads(
                     source_state.get_basis_revision_id())
@@ -704,8 +1042,7 @@ class _Puller(object):
                 revisions = [rev for name,rev in threads]
                 # fetch content for all threads and tags.
                 fetch_spec = self.build_fetch_spec(stop_revision)
-                self.target.repository.fetch(self.source.repository,
-                    fetch_spec=fetch_spec)
+                self.fetch(fetch_spec=fetch_spec)
                 # set our work threads to match (this is where we lose data if
                 # there are local mods)
                 my_state.set_threads(
@@ -736,6 +1073,8 @@ class _Puller(object):
 
 class _Pusher(_Puller):
 
+    span_name = 'transfer.push'
+
     @staticmethod
     def make_result():
         return breezy.branch.BranchPushResult()
@@ -752,6 +1091,12 @@ class LoomBranch(LoomSupport, BzrBranch5):
     delegated object may well be cleaner.
     """
 
+    def _set_revision_history(self, rev_history):
+        # generate_revision_history changes the tip without going through
+        # set_last_revision_info.
+        self._thread_tip_changed = True
+        super(LoomBranch, self)._set_revision_history(rev_history)
+
 
 class LoomBranch6(LoomSupport, _mod_bzrbranch.BzrBranch6):
     """Branch6 Loom branch.
@@ -972,6 +1317,7 @@ class InterLoomBranch(breezy.branch.GenericInterBranch):
         format = klass.unwrap_format(branch._format)
         return isinstance(format, LoomFormatMixin)
 
+    @timing.timed('interbranch.copy_content_into')
     def copy_content_into(self, revision_id=None, tag_selector=None):
         with self.lock_write():
             if not self.__class__.branch_is_loom(self.source):
@@ -1006,13 +1352,13 @@ class InterLoomBranch(breezy.branch.GenericInterBranch):
                 nested = ui.ui_factory.nested_progress_bar()
                 try:
                     if parents:
-                        self.target.repository.fetch(self.source.repository,
-                            revision_id=parents[0])
+                        _fetch(self.target.repository,
+                            self.source.repository, revision_id=parents[0])
                     if threads:
                         for thread, rev_id in reversed(threads):
                             # fetch the loom content for this revision
-                            self.target.repository.fetch(self.source.repository,
-                                revision_id=rev_id)
+                            _fetch(self.target.repository,
+                                self.source.repository, revision_id=rev_id)
                 finally:
                     nested.finished()
             state = loom_state.LoomState()
@@ -19,17 +19,28 @@
 
 from __future__ import absolute_import
 
+import itertools
+import json
+import os
+import socket
+
 from breezy import controldir, directory_service, workingtree
+import breezy.builtins
 import breezy.commands
 import breezy.branch
 from breezy import errors
 from breezy.lazy_import import lazy_import
-from breezy.option import Option
+from breezy.option import Option, RegistryOption
+import breezy.osutils
+from breezy.revision import is_null
 import breezy.trace
 import breezy.transport
 
 lazy_import(globals(), """
 from breezy.plugins.loom import branch
+from breezy.plugins.loom import patches
+from breezy.plugins.loom import series as loom_series
+from breezy.plugins.loom import stats as loom_stats
 from breezy.plugins.loom.tree import LoomTreeDecorator
 """)
 
@@ -131,6 +142,62 @@ class cmd_combine_thread(breezy.commands.Command):
         tree.branch.remove_thread(current_thread)
 
 
+class cmd_loom_prune(breezy.commands.Command):
+    """Remove every thread that has been merged.
+
+    A thread has been merged when all of its work is in the thread below
+    it, or, if --upstream is given, in the upstream branch. All the threads
+    are checked at once, and all the merged threads are removed in one
+    change to the loom. The bottom thread is never removed.
+
+    If the current thread is removed, the tree moves to the nearest thread
+    below it that is kept.
+    """
+
+    takes_options = [
+        Option('dry-run',
+            help='Show the threads that would be removed, without removing '
+                'them.'),
+        Option('upstream', type=str,
+            help='Also remove threads merged into this branch.'),
+        ]
+
+    def run(self, dry_run=False, upstream=None):
+        (tree, path) = workingtree.WorkingTree.open_containing('.')
+        branch.require_loom_branch(tree.branch)
+        if dry_run:
+            self.add_cleanup(tree.lock_read().unlock)
+        else:
+            self.add_cleanup(tree.lock_write().unlock)
+        state = tree.branch.get_loom_state()
+        threads = state.get_threads()
+        thread_states = _classify_threads(self, tree.branch,
+            [revid for thread, revid, parents in threads], upstream)
+        merged_threads = []
+        for index, (thread, revid, parents) in enumerate(threads):
+            if thread_states[index] != 'live':
+                merged_threads.append(thread)
+                if dry_run:
+                    action = 'Would remove'
+                else:
+                    action = 'Removing'
+                breezy.trace.note("%s thread '%s'%s.", action, thread,
+                    _THREAD_STATE_SUFFIXES[thread_states[index]])
+        if not merged_threads:
+            breezy.trace.note('No merged threads.')
+            return
+        if dry_run:
+            return
+        current_thread = tree.branch.nick
+        if current_thread in merged_threads:
+            current_index = state.thread_index(current_thread)
+            for thread, revid, parents in reversed(threads[:current_index]):
+                if thread not in merged_threads:
+                    LoomTreeDecorator(tree).down_thread(thread)
+                    break
+        tree.branch.remove_threads(merged_threads)
+
+
 class cmd_create_thread(breezy.commands.Command):
     """Add a thread to this loom.
 
@@ -150,32 +217,260 @@ class cmd_create_thread(breezy.commands.Command):
         branch.create_thread(loom, thread)
 
 
+# Keyed by the states returned by stats.classify_threads.
+_THREAD_STATE_SUFFIXES = {
+    'merged': ' (merged)',
+    'upstream': ' (merged upstream)',
+    'live': '',
+    }
+
+
+def _classify_threads(command, loom, revisions, upstream_location=None):
+    """Classify threads with stats.classify_threads.
+
+    :param command: The running command, which cleans up any upstream
+        branch opened.
+    :param loom: A read locked loom.
+    :param upstream_location: The location of an upstream branch to check,
+        or None.
+    """
+    if upstream_location is None:
+        return loom_stats.classify_threads(loom.repository.get_graph(),
+            revisions)
+    upstream = breezy.branch.Branch.open(upstream_location)
+    command.add_cleanup(upstream.lock_read().unlock)
+    graph = loom.repository.get_graph(upstream.repository)
+    return loom_stats.classify_threads(graph, revisions,
+        upstream.last_revision())
+
+
+def json_thread_entry(thread, revid, parents, nick):
+    """Return the show-loom --format=json entry of a thread, without stats.
+
+    :param nick: The name of the current thread.
+    """
+    return {
+        'name': thread,
+        'revision': revid.decode('utf-8'),
+        'parents': [parent and parent.decode('utf-8') for parent in parents],
+        'current': thread == nick,
+        }
+
+
 class cmd_show_loom(breezy.commands.Command):
     """Show the threads in this loom.
 
     Output the threads in this loom with the newest thread at the top and
     the base thread at the bottom. A => marker indicates the thread that
     'commit' will commit to.
+
+    With --stats, each thread above the base thread is followed by the number
+    of revisions it has that the thread below it does not, and a summary of
+    its changes against the thread below it.
+
+    With --format=json a single JSON object is written instead, holding the
+    current thread, the parent revisions of the loom and, base thread first,
+    the name, tip revision and parent loom revisions of each thread. A thread
+    that is not present in a parent loom has a null parent revision.
+
+    With -r, the threads of a recorded loom are shown instead. Revision
+    numbers count recorded looms, so -r -1 shows the last loom recorded.
+
+    With --merged, threads whose work is all in the thread below them are
+    marked as merged. If --upstream is given too, threads whose work is all
+    in that branch are marked as merged upstream.
+
+    With --dependencies, each thread lists the lower threads whose changes
+    touch the same files as its own. Threads that list nothing can be
+    merged, reordered or moved to another loom independently of the
+    threads below them, other than the base thread.
     """
 
     takes_args = ['location?']
+    takes_options = [
+        Option('stats',
+            help='Show revision counts and diffstats for each thread.'),
+        RegistryOption.from_kwargs('format',
+            'Format for the list of threads.',
+            text='One line per thread, newest thread first.',
+            json='A JSON document, for use by other programs.'),
+        'revision',
+        Option('merged', help='Show which threads have been merged.'),
+        Option('upstream', type=str,
+            help='Branch to check for threads merged upstream.'),
+        Option('dependencies',
+            help='Show which lower threads each thread depends on.'),
+        ]
 
-    def run(self, location='.'):
+    def run(self, location='.', stats=False, format='text', revision=None,
+            merged=False, upstream=None, dependencies=False):
         (loom, path) = breezy.branch.Branch.open_containing(location)
         branch.require_loom_branch(loom)
         loom.lock_read()
         try:
-            threads = loom.get_loom_state().get_threads()
-            nick = loom.nick
-            for thread, revid, parents in reversed(threads):
-                if thread == nick:
-                    symbol = '=>'
-                else:
-                    symbol = '  '
-                self.outf.write(symbol + thread + '\n')
+            if revision is None:
+                state = loom.get_loom_state()
+                loom_parents = state.get_parents()
+                threads = state.get_threads()
+                nick = loom.nick
+            else:
+                loom_revision = self._get_loom_revision_id(loom, revision)
+                loom_parents = [loom_revision]
+                threads = [(thread, revid, [revid]) for thread, revid in
+                    loom.get_threads(loom_revision)]
+                nick = None
+            thread_stats = None
+            if stats:
+                thread_stats = loom_stats.thread_stats(loom,
+                    [revid for thread, revid, parents in threads])
+            thread_states = None
+            if merged or upstream is not None:
+                thread_states = _classify_threads(self, loom,
+                    [revid for thread, revid, parents in threads], upstream)
+            thread_dependencies = None
+            if dependencies:
+                thread_dependencies = loom_stats.thread_dependencies(
+                    loom.repository,
+                    [revid for thread, revid, parents in threads])
+            if format == 'json':
+                self._show_json(loom_parents, threads, nick,
+                    thread_stats, thread_states, thread_dependencies)
+            else:
+                self._show_text(threads, nick, thread_stats, thread_states,
+                    thread_dependencies)
         finally:
             loom.unlock()
 
+    def _get_loom_revision_id(self, loom, revision):
+        if len(revision) != 1:
+            raise errors.BzrCommandError(
+                'show-loom -r takes exactly one revision.')
+        spec = revision[0]
+        if spec.prefix == 'revid:':
+            return spec.spec.encode('utf-8')
+        if spec.prefix in (None, 'revno:'):
+            try:
+                revno = int(spec.spec)
+            except ValueError:
+                pass
+            else:
+                return loom.get_loom_revision_id(revno)
+        raise errors.BzrCommandError(
+            'show-loom -r only accepts loom revision numbers and revid:.')
+
+    def _show_text(self, threads, nick, thread_stats, thread_states,
+                   thread_dependencies):
+        if thread_stats is not None:
+            width = max(
+                [len(thread) for thread, revid, parents in threads] + [0])
+        for index in reversed(range(len(threads))):
+            thread = threads[index][0]
+            if thread == nick:
+                line = '=>'
+            else:
+                line = '  '
+            if thread_stats is not None and thread_stats[index] is not None:
+                line += ('%-*s  %d revisions, %d files changed, +%d -%d' %
+                    ((width, thread) + thread_stats[index]))
+            else:
+                line += thread
+            if thread_states is not None:
+                line += _THREAD_STATE_SUFFIXES[thread_states[index]]
+            if (thread_dependencies is not None and
+                thread_dependencies[index]):
+                line += ' (depends on %s)' % ', '.join(
+                    threads[lower][0] for lower in thread_dependencies[index])
+            self.outf.write(line + '\n')
+
+    def _show_json(self, loom_parents, threads, nick, thread_stats,
+                   thread_states, thread_dependencies):
+        # Written a thread at a time, so large looms are not held in memory
+        # twice.
+        self.outf.write('{"current": %s,\n "parents": %s,\n "threads": [' % (
+            json.dumps(nick),
+            json.dumps([revid.decode('utf-8') for revid in loom_parents])))
+        for index, (thread, revid, parents) in enumerate(threads):
+            entry = json_thread_entry(thread, revid, parents, nick)
+            if thread_stats is not None:
+                entry['stats'] = None
+                if thread_stats[index] is not None:
+                    entry['stats'] = dict(zip(
+                        ['revisions', 'files_changed', 'insertions',
+                         'deletions'], thread_stats[index]))
+            if thread_states is not None:
+                entry['state'] = thread_states[index]
+            if thread_dependencies is not None:
+                entry['depends_on'] = None
+                if thread_dependencies[index] is not None:
+                    entry['depends_on'] = [threads[lower][0]
+                        for lower in thread_dependencies[index]]
+            if index:
+                self.outf.write(',')
+            self.outf.write('\n  %s' % json.dumps(entry, sort_keys=True))
+        self.outf.write('\n ]}\n')
+
+
+class cmd_loom_log(breezy.commands.Command):
+    """Show how the threads of a loom changed each time it was recorded.
+
+    Recorded looms are shown newest first, following the left-hand history
+    of the loom. Each one lists the threads that were added, removed, or
+    moved to a new revision since the loom recorded before it.
+    """
+
+    takes_args = ['location?']
+    takes_options = [
+        Option('limit', short_name='l', type=int,
+            help='Show at most this many recorded looms.'),
+        ]
+
+    _batch_size = 100
+
+    def run(self, location='.', limit=None):
+        (loom, path) = breezy.branch.Branch.open_containing(location)
+        branch.require_loom_branch(loom)
+        with loom.lock_read():
+            history = loom.iter_loom_history()
+            if limit is not None:
+                history = itertools.islice(history, limit)
+            while True:
+                batch = list(itertools.islice(history, self._batch_size))
+                if not batch:
+                    break
+                revisions = loom.repository.get_revisions(batch)
+                for revision in revisions:
+                    self._show_loom_revision(loom, revision)
+
+    def _show_loom_revision(self, loom, revision):
+        self.outf.write('-' * 60 + '\n')
+        self.outf.write('loom revision: %s\n' %
+            revision.revision_id.decode('utf-8'))
+        self.outf.write('committer: %s\n' % revision.committer)
+        self.outf.write('timestamp: %s\n' % breezy.osutils.format_date(
+            revision.timestamp, revision.timezone))
+        self.outf.write('message:\n')
+        for line in revision.message.rstrip('\n').split('\n'):
+            self.outf.write('  %s\n' % line)
+        if revision.parent_ids:
+            old_threads = loom.get_threads(revision.parent_ids[0])
+        else:
+            old_threads = []
+        self.outf.write('threads:\n')
+        old_revisions = dict(old_threads)
+        new_threads = loom.get_threads(revision.revision_id)
+        for thread, revid in new_threads:
+            old_revid = old_revisions.get(thread)
+            if old_revid is None:
+                self.outf.write('  added %s at %s\n' % (thread,
+                    revid.decode('utf-8')))
+            elif old_revid != revid:
+                self.outf.write('  moved %s to %s\n' % (thread,
+                    revid.decode('utf-8')))
+        new_names = set(thread for thread, revid in new_threads)
+        for thread, revid in old_threads:
+            if thread not in new_names:
+                self.outf.write('  removed %s\n' % thread)
+
 
 class cmd_switch(breezy.builtins.cmd_switch):
     """Set the branch of a checkout and update.
@@ -193,7 +488,9 @@ class cmd_switch(breezy.builtins.cmd_switch):
     Pending merges need to be committed or reverted before using switch.
     """
 
-    _original_command = None
+    # switch is registered lazily over the builtin, so this module is only
+    # imported when switch or another loom command is run.
+    _original_command = breezy.builtins.cmd_switch
 
     def _get_thread_name(self, loom, to_location):
         """Return the name of the thread pointed to by 'to_location'.
@@ -255,9 +552,7 @@ class cmd_switch(breezy.builtins.cmd_switch):
         """
         try:
             super(cmd_switch, self).run_argv_aliases(list(argv), alias_argv)
-        except (errors.MustUseDecorated, errors.BzrOptionError):
-            if self._original_command is None:
-                raise
+        except errors.MustUseDecorated:
             self._original_command().run_argv_aliases(argv, alias_argv)
 
 
@@ -342,6 +637,10 @@ class cmd_up_thread(breezy.commands.Command):
     the next thread up into the next thread up and switches your tree to be
     that thread.  Unless there are conflicts, or --manual is specified, it
     will then commit and repeat the process.
+
+    With --dry-run, nothing is changed. Instead each thread is merged into
+    the one above it in memory, and the threads whose merges would conflict
+    are reported along with the conflicts.
     """
 
     takes_args = ['thread?']
@@ -349,14 +648,31 @@ class cmd_up_thread(breezy.commands.Command):
     takes_options = ['merge-type', Option('auto',
         help='Deprecated - now the default.'),
         Option('manual', help='Perform commit manually.'),
+        Option('dry-run', help='Report the threads that would conflict '
+            'without changing anything.'),
         ]
 
     _see_also = ['down-thread', 'switch']
 
-    def run(self, merge_type=None, manual=False, thread=None, auto=None):
+    def run(self, merge_type=None, manual=False, thread=None, auto=None,
+            dry_run=False):
         (tree, path) = workingtree.WorkingTree.open_containing('.')
         branch.require_loom_branch(tree.branch)
         tree = LoomTreeDecorator(tree)
+        if dry_run:
+            if manual:
+                raise errors.BzrCommandError('--dry-run does not work with'
+                                             ' --manual.')
+            conflicting = tree.predict_conflicts(merge_type, thread)
+            for lower, upper, conflicts in conflicting:
+                self.outf.write("Merging '%s' into '%s' would conflict:\n"
+                    % (lower, upper))
+                for conflict in conflicts:
+                    self.outf.write('  %s\n' % (conflict,))
+            if conflicting:
+                return 1
+            self.outf.write('No conflicts predicted.\n')
+            return 0
         if manual:
             if thread is not None:
                 raise errors.BzrCommandError('Specifying a thread does not'
@@ -390,3 +706,141 @@ class cmd_export_loom(breezy.commands.Command):
             possible_transports=[loom.controldir.root_transport])
         root_transport.ensure_base()
         loom.export_threads(root_transport)
+
+
+class cmd_export_patches(breezy.commands.Command):
+    """Export each thread as a patch against the thread below it.
+
+    The patches are written to the directory OUTPUT, which is created if
+    needed, and named after their position in the loom and their thread,
+    e.g. 01-fix-build.patch. With --mbox, OUTPUT is instead a single mbox
+    file with one message per patch, ready to be mailed or applied with
+    'git am'.
+
+    Threads with no changes against the thread below are skipped.
+    """
+
+    takes_args = ['output']
+    takes_options = [
+        Option('mbox', help='Write the patches to a single mbox file.'),
+        ]
+
+    def run(self, output, mbox=False):
+        (loom, path) = breezy.branch.Branch.open_containing('.')
+        branch.require_loom_branch(loom)
+        self.add_cleanup(loom.lock_read().unlock)
+        series = list(patches.iter_thread_patches(loom))
+        if mbox:
+            with open(output, 'wb') as to_file:
+                for index, (thread, revision, patch) in enumerate(series, 1):
+                    patches.write_mbox_message(to_file, revision,
+                        '[PATCH %d/%d] %s' % (index, len(series), thread),
+                        patch)
+        else:
+            transport = breezy.transport.get_transport(output)
+            transport.ensure_base()
+            for index, (thread, revision, patch) in enumerate(series, 1):
+                transport.put_bytes(patches.patch_filename(index, thread),
+                    patch)
+        breezy.trace.note('Exported %d patches.', len(series))
+
+
+class cmd_import_series(breezy.commands.Command):
+    """Import a quilt patch series as threads.
+
+    SERIES is a quilt series file. Each patch it lists, read from the
+    directory containing SERIES, becomes a new thread above the current
+    thread, in series order. Each patch is committed straight to the
+    repository on top of the thread below it, without using the working
+    tree, and the loom is updated once all the patches have been committed.
+    If any patch does not apply, no threads are added.
+    """
+
+    takes_args = ['series']
+
+    def run(self, series):
+        (loom, path) = breezy.branch.Branch.open_containing('.')
+        branch.require_loom_branch(loom)
+        self.add_cleanup(loom.lock_write().unlock)
+        with open(series, 'rb') as f:
+            patch_list = loom_series.read_series(f.read())
+        patch_directory = os.path.dirname(series)
+        current_thread = loom.nick
+        state = loom.get_loom_state()
+        threads_dict = state.get_threads_dict()
+        parent_revision = loom.last_revision()
+        if is_null(parent_revision):
+            raise errors.BzrCommandError(
+                "Thread '%s' has no commits to import patches onto."
+                % current_thread)
+        new_threads = []
+        for patch_name, strip in patch_list:
+            thread_name = loom_series.thread_name_for_patch(patch_name)
+            if (thread_name in threads_dict or
+                thread_name in [name for name, revid in new_threads]):
+                raise branch.DuplicateThreadName(loom, thread_name)
+            with open(os.path.join(patch_directory, patch_name), 'rb') as f:
+                content = f.read()
+            parent_revision = loom_series.commit_patch(loom, parent_revision,
+                patch_name, content, strip, thread_name)
+            new_threads.append((thread_name, parent_revision))
+        loom.insert_threads(new_threads, current_thread)
+        breezy.trace.note('Imported %d patches.', len(new_threads))
+
+
+class cmd_loom_benchmark(breezy.commands.Command):
+    """Time loom operations on synthetic looms.
+
+    A loom of the given shape is built in a temporary directory before each
+    timed run, and the results are written as a JSON document, so they can
+    be compared between releases.
+    """
+
+    hidden = True
+    takes_args = ['benchmark*']
+    takes_options = [
+        Option('threads', type=int,
+            help='Number of threads in the loom, including the base.'),
+        Option('commits', type=int, help='Number of commits per thread.'),
+        Option('parents', type=int, help='Number of recorded looms.'),
+        Option('files', type=int, help='Number of files in the tree.'),
+        Option('repeat', type=int, help='Number of timed runs of each '
+            'benchmark.'),
+        ]
+
+    def run(self, benchmark_list=None, threads=10, commits=5, parents=2,
+            files=100, repeat=3):
+        from breezy.plugins.loom import benchmarks
+        shape = benchmarks.LoomShape(threads, commits, parents, files)
+        results = benchmarks.run_benchmarks(shape, repeat,
+            benchmark_list or None)
+        self.outf.write(json.dumps(results, indent=1, sort_keys=True) + '\n')
+
+
+class cmd_loom_serve(breezy.commands.Command):
+    """Answer loom queries from a daemon listening on a Unix socket.
+
+    The daemon keeps the looms it is asked about open, so queries do not pay
+    for starting brz and reading the loom each time. Looms are reread when
+    their control files change. It answers show-loom, the current thread,
+    and revision specifiers such as thread:foo, until it is interrupted.
+
+    loom_client.py, in the loom plugin directory, is a client that runs
+    without loading brz.
+    """
+
+    takes_args = ['socket_path']
+
+    def run(self, socket_path):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise errors.BzrCommandError(
+                'loom-serve needs Unix socket support.')
+        from breezy.plugins.loom import server
+        loom_server = server.LoomServer(socket_path)
+        try:
+            breezy.trace.note('Serving loom queries on %s.', socket_path)
+            loom_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            loom_server.close()
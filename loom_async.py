@@ -0,0 +1,173 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+
+"""Loom operations for asyncio programs.
+
+Branch and repository operations block on the disk and the network, so
+LoomExecutor runs them in a pool of worker threads and returns awaitables::
+
+  async with LoomExecutor(max_workers=8) as looms:
+      states = await asyncio.gather(
+          *[looms.get_loom_state(url) for url in urls])
+
+At most max_workers operations run at once; the rest wait their turn, so one
+event loop can start operations on many looms without opening too many
+connections. Each operation opens its own branch when given a location.
+Branch objects are not thread safe, so a branch object passed in instead
+must not be used by anything else until the operation finishes.
+"""
+
+from __future__ import absolute_import
+
+import asyncio
+import concurrent.futures
+import functools
+
+from breezy import (
+    branch as _mod_branch,
+    transport as _mod_transport,
+    )
+
+from breezy.plugins.loom import require_loom_branch
+
+
+def _open_loom(location):
+    """Return the loom branch at location, which may already be a branch."""
+    if isinstance(location, _mod_branch.Branch):
+        branch = location
+    else:
+        branch = _mod_branch.Branch.open(location)
+    require_loom_branch(branch)
+    return branch
+
+
+def _open_branch(location):
+    """Return the branch at location, which may already be a branch."""
+    if isinstance(location, _mod_branch.Branch):
+        return location
+    return _mod_branch.Branch.open(location)
+
+
+def _get_loom_state(location):
+    return _open_loom(location).get_loom_state()
+
+
+def _get_loom_snapshot(location):
+    return _open_loom(location).get_loom_snapshot()
+
+
+def _get_threads(location):
+    return _open_loom(location).get_loom_snapshot().get_threads()
+
+
+def _get_recorded_threads(location, rev_id):
+    branch = _open_loom(location)
+    with branch.lock_read():
+        return branch.get_threads(rev_id)
+
+
+def _export_threads(location, root_location):
+    branch = _open_loom(location)
+    if isinstance(root_location, _mod_transport.Transport):
+        root_transport = root_location
+    else:
+        root_transport = _mod_transport.get_transport(root_location)
+    root_transport.ensure_base()
+    with branch.lock_read():
+        branch.export_threads(root_transport)
+
+
+def _pull(target, source, overwrite, stop_revision):
+    return _open_branch(target).pull(_open_branch(source),
+        overwrite=overwrite, stop_revision=stop_revision)
+
+
+def _push(source, target, overwrite, stop_revision):
+    return _open_branch(source).push(_open_branch(target),
+        overwrite=overwrite, stop_revision=stop_revision)
+
+
+class LoomExecutor(object):
+    """Run loom operations for asyncio in a bounded pool of threads.
+
+    Branches may be given as locations or as Branch objects. Errors raised
+    by an operation, such as NotBranchError or NotALoom, are raised by the
+    awaitable.
+    """
+
+    def __init__(self, max_workers=4):
+        """Create an executor.
+
+        :param max_workers: How many operations may run at once.
+        """
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='loom')
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+            functools.partial(function, *args))
+
+    async def get_loom_state(self, location):
+        """Return the current LoomState of a loom."""
+        return await self._run(_get_loom_state, location)
+
+    async def get_loom_snapshot(self, location):
+        """Return a FrozenLoomState of a loom, shared with other readers."""
+        return await self._run(_get_loom_snapshot, location)
+
+    async def get_threads(self, location):
+        """Return the current threads of a loom.
+
+        :return: A list of (name, revision_id, parent_ids) tuples, as
+            LoomState.get_threads gives them.
+        """
+        return await self._run(_get_threads, location)
+
+    async def get_recorded_threads(self, location, rev_id):
+        """Return the threads of a recorded loom revision.
+
+        :return: A list of (name, revision_id) tuples.
+        """
+        return await self._run(_get_recorded_threads, location, rev_id)
+
+    async def export_threads(self, location, root_location):
+        """Export the threads of a loom as branches under root_location.
+
+        :param root_location: A URL or a Transport.
+        """
+        await self._run(_export_threads, location, root_location)
+
+    async def pull(self, target, source, overwrite=False, stop_revision=None):
+        """Pull source into target, and return the PullResult."""
+        return await self._run(_pull, target, source, overwrite,
+            stop_revision)
+
+    async def push(self, source, target, overwrite=False, stop_revision=None):
+        """Push source into target, and return the BranchPushResult."""
+        return await self._run(_push, source, target, overwrite,
+            stop_revision)
+
+    def close(self):
+        """Wait for running operations, and stop the worker threads."""
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
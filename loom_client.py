@@ -0,0 +1,86 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+
+"""A client for the loom-serve daemon.
+
+This module only uses the standard library, so it can be run as a script
+without the start up cost of breezy::
+
+  python loom_client.py SOCKET show-loom BRANCH
+  python loom_client.py SOCKET current-thread BRANCH
+  python loom_client.py SOCKET revision-id BRANCH thread:foo
+
+The result is printed as JSON. See the server module for the protocol.
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import socket
+import sys
+
+
+class QueryError(Exception):
+    """The server could not answer a query."""
+
+
+def query(path, request):
+    """Send request to the server listening at path, and return the result.
+
+    :param request: A dict such as {'query': 'show-loom', 'branch': '.'}.
+        A relative branch path is taken from the current directory.
+    :raises QueryError: If the server answered with an error.
+    """
+    request = dict(request, branch=os.path.abspath(request['branch']))
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+    reply = json.loads(b''.join(chunks).decode('utf-8'))
+    if 'error' in reply:
+        raise QueryError(reply['error'])
+    return reply['result']
+
+
+def main(argv):
+    if len(argv) not in (3, 4):
+        sys.stderr.write(
+            'usage: loom_client.py SOCKET QUERY BRANCH [SPEC]\n')
+        return 2
+    request = {'query': argv[1], 'branch': argv[2]}
+    if len(argv) == 4:
+        request['spec'] = argv[3]
+    try:
+        result = query(argv[0], request)
+    except (QueryError, socket.error) as e:
+        sys.stderr.write('loom_client: %s\n' % (e,))
+        return 1
+    sys.stdout.write(json.dumps(result, indent=1, sort_keys=True) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,147 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+# 
+
+
+"""An index of the threads in each recorded loom revision."""
+
+from __future__ import absolute_import
+
+from breezy import (
+    errors,
+    osutils,
+    transport as _mod_transport,
+    )
+
+
+# The index format:
+# the first line is the format signature.
+# each recorded loom then has a line with its revision id followed by the
+# revision ids of its parents, and one line per thread, starting with a
+# space, holding the thread revision id and then the thread name. The entry
+# ends with a line holding '= ' and the sha1 of the entry's other lines, so
+# that an entry torn by an interrupted append is recognised and ignored.
+_CURRENT_INDEX_FORMAT_STRING = b"Loom index 2\n"
+
+
+class LoomIndex(object):
+    """Map loom revisions to their parents and threads.
+
+    Loom revisions never change, so the index only ever grows: entries are
+    appended to a file in the branch control directory by save, which the
+    branch only calls while it is write locked. The index is only an
+    optimisation. It is ignored if
+    its format is not recognised, entries that are incomplete or do not
+    match their checksum are ignored, and entries that cannot be written are
+    simply dropped.
+    """
+
+    _filename = 'loom-index'
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._entries = None
+        self._pending = []
+        self._recognised = False
+        # Whether the file ends part way through a line.
+        self._torn = False
+
+    def _get_entries(self):
+        if self._entries is None:
+            self._entries = {}
+            try:
+                content = self._transport.get_bytes(self._filename)
+            except _mod_transport.NoSuchFile:
+                content = b''
+            self._recognised = content.startswith(
+                _CURRENT_INDEX_FORMAT_STRING)
+            if self._recognised:
+                self._parse(content[len(_CURRENT_INDEX_FORMAT_STRING):])
+                self._torn = not content.endswith(b'\n')
+        return self._entries
+
+    def _parse(self, content):
+        entry_lines = []
+        # The last piece is empty, or the start of a torn line.
+        for line in content.split(b'\n')[:-1]:
+            line += b'\n'
+            if line.startswith(b'= '):
+                if (entry_lines and line[2:-1] ==
+                    osutils.sha_strings(entry_lines)):
+                    self._add_parsed(entry_lines)
+                entry_lines = []
+            elif line.startswith(b' '):
+                entry_lines.append(line)
+            else:
+                # A new entry, so any entry before it was torn.
+                entry_lines = [line]
+
+    def _add_parsed(self, entry_lines):
+        fields = entry_lines[0][:-1].split(b' ')
+        threads = []
+        for line in entry_lines[1:]:
+            rev_id, name = line[1:-1].split(b' ', 1)
+            threads.append((name.decode('utf-8'), rev_id))
+        self._entries[fields[0]] = (fields[1:], threads)
+
+    def get(self, revision_id):
+        """Get the parents and threads of a loom revision.
+
+        :return: A (parents, threads) tuple, with threads in the form
+            returned by LoomSupport.get_threads, or None if the revision is
+            not in the index.
+        """
+        return self._get_entries().get(revision_id)
+
+    def add(self, revision_id, parents, threads):
+        """Add a loom revision to the index.
+
+        The entry is written out by the next call to save.
+        """
+        entries = self._get_entries()
+        if revision_id in entries:
+            return
+        entries[revision_id] = (list(parents), list(threads))
+        self._pending.append(revision_id)
+
+    def save(self):
+        """Append any new entries to the index file."""
+        if not self._pending:
+            return
+        lines = []
+        if self._torn:
+            # Finish the torn line, so the new entries start on their own.
+            lines.append(b'\n')
+        for revision_id in self._pending:
+            parents, threads = self._entries[revision_id]
+            entry_lines = [b' '.join([revision_id] + parents) + b'\n']
+            for name, rev_id in threads:
+                entry_lines.append(
+                    b' %s %s\n' % (rev_id, name.encode('utf-8')))
+            lines.extend(entry_lines)
+            lines.append(b'= %s\n' % osutils.sha_strings(entry_lines))
+        try:
+            if self._recognised:
+                self._transport.append_bytes(self._filename, b''.join(lines))
+            else:
+                # Replace a missing or unrecognised index.
+                self._transport.put_bytes(self._filename,
+                    _CURRENT_INDEX_FORMAT_STRING + b''.join(lines))
+                self._recognised = True
+            self._torn = False
+        except (errors.TransportNotPossible, errors.PermissionDenied):
+            pass
+        self._pending = []
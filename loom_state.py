@@ -38,12 +38,25 @@ class LoomState(object):
         """
         self._parents = []
         self._threads = []
+        # Maps thread names to their index, built when first needed.
+        self._thread_indices = None
         if reader is not None:
             # perhaps this should be lazy evaluated at some point?
             self._parents = reader.read_parents()
             for thread in reader.read_thread_details():
                 self._threads.append(thread)
 
+    def copy(self):
+        """Return a copy of this state that can be changed independently."""
+        result = LoomState()
+        result.set_parents(self._parents)
+        result.set_threads(self._threads)
+        return result
+
+    def freeze(self):
+        """Return an immutable snapshot of this state."""
+        return FrozenLoomState(self._parents, self._threads)
+
     def get_basis_revision_id(self):
         """Get the revision id for the basis revision.
 
@@ -70,14 +83,22 @@ class LoomState(object):
         """
         return dict((thread[0], thread[1:]) for thread in self._threads)
 
+    def get_thread_revision(self, thread):
+        """Get the revision of thread."""
+        return self._threads[self.thread_index(thread)][1]
+
     def thread_index(self, thread):
         """Find the index of thread in threads."""
         # Avoid circular import
         from breezy.plugins.loom.branch import NoSuchThread
-        thread_names = [name for name, rev, parents in self._threads]
+        if self._thread_indices is None:
+            self._thread_indices = {}
+            for index, (name, rev, parents) in enumerate(self._threads):
+                # Keep the first thread of a name, as list.index would.
+                self._thread_indices.setdefault(name, index)
         try:
-            return thread_names.index(thread)
-        except ValueError:
+            return self._thread_indices[thread]
+        except KeyError:
             raise NoSuchThread(self, thread)
 
     def get_new_thread_after_deleting(self, current_thread):
@@ -105,3 +126,59 @@ class LoomState(object):
             effect on the LoomState.
         """
         self._threads = list(threads)
+        self._thread_indices = None
+
+
+class FrozenLoomState(LoomState):
+    """An immutable snapshot of a LoomState.
+
+    A snapshot can be shared between threads and branch objects: it is
+    never changed after it is made, and the lists it returns are new each
+    time, so changing them does not change the snapshot. Use copy to get a
+    LoomState that can be changed.
+    """
+
+    def __init__(self, parents=(), threads=()):
+        """Create a snapshot.
+
+        :param parents: The loom parents, as LoomState.set_parents takes.
+        :param threads: The threads, as LoomState.set_threads takes.
+        """
+        self._parents = tuple(parents)
+        self._threads = tuple((name, rev_id, tuple(thread_parents))
+            for name, rev_id, thread_parents in threads)
+        # Built now, so readers in other threads never build it.
+        self._thread_indices = {}
+        for index, thread in enumerate(self._threads):
+            self._thread_indices.setdefault(thread[0], index)
+
+    def copy(self):
+        """Return a LoomState with the same content, that can be changed."""
+        result = LoomState()
+        result.set_parents(self._parents)
+        result.set_threads(self.get_threads())
+        return result
+
+    def freeze(self):
+        """Return self, as a snapshot is already immutable."""
+        return self
+
+    def get_parents(self):
+        """Get the list of loom revisions that are parents to this state."""
+        return list(self._parents)
+
+    def get_threads(self):
+        """Get the threads for the current state."""
+        return [(name, rev_id, list(parents))
+                for name, rev_id, parents in self._threads]
+
+    def get_threads_dict(self):
+        """Get the threads as a dict. See LoomState.get_threads_dict."""
+        return dict((name, (rev_id, list(parents)))
+                    for name, rev_id, parents in self._threads)
+
+    def set_parents(self, parent_list):
+        raise TypeError('A FrozenLoomState cannot be changed.')
+
+    def set_threads(self, threads):
+        raise TypeError('A FrozenLoomState cannot be changed.')
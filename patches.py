@@ -0,0 +1,102 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+
+"""Export the threads of a loom as a series of patches."""
+
+from __future__ import absolute_import
+
+import email.utils
+from io import BytesIO
+import time
+
+from breezy import diff as _mod_diff
+from breezy.revision import NULL_REVISION
+
+from breezy.plugins.loom import stats as loom_stats
+from breezy.plugins.loom.branch import EMPTY_REVISION
+
+
+def patch_filename(index, thread):
+    """Return the file name for the patch of a thread.
+
+    :param index: The position of the patch in the series, starting at 1.
+    """
+    return '%02d-%s.patch' % (index, thread.replace('/', '-'))
+
+
+def iter_thread_patches(loom):
+    """Iterate over the diff of each thread against the thread below it.
+
+    The trees of all the threads are loaded in one batch, and each is used
+    as the new tree of one diff and the old tree of the next. Threads with
+    no changes against the thread below are left out, as are empty threads,
+    so the thread above an empty thread is diffed against the thread below
+    it.
+
+    :param loom: A read locked loom.
+    :return: An iterator of (thread, revision, diff) tuples, bottom thread
+        first, where revision is the Revision of the thread tip and diff is
+        the patch as bytes.
+    """
+    threads = loom.get_loom_state().get_threads()
+    revisions = []
+    for thread, revid, parents in threads:
+        if revid == EMPTY_REVISION:
+            revid = NULL_REVISION
+        revisions.append(revid)
+    trees = loom_stats.load_trees(loom.repository, revisions)
+    tips = dict(
+        (revision.revision_id, revision) for revision in
+        loom.repository.get_revisions(
+            [revid for revid in set(revisions[1:]) if revid != NULL_REVISION]))
+    lower = revisions[0]
+    for index in range(1, len(threads)):
+        if revisions[index] == NULL_REVISION:
+            # An empty thread has no work of its own, and the thread above it
+            # is diffed against the thread below it instead.
+            continue
+        old_tree = trees[lower]
+        new_tree = trees[revisions[index]]
+        if lower == revisions[index]:
+            continue
+        lower = revisions[index]
+        patch = BytesIO()
+        if not _mod_diff.show_diff_trees(old_tree, new_tree, patch):
+            continue
+        yield threads[index][0], tips[revisions[index]], patch.getvalue()
+
+
+def write_mbox_message(to_file, revision, subject, patch):
+    """Write a patch to an mbox file as one message.
+
+    :param revision: The Revision the author and date are taken from.
+    """
+    to_file.write(b'From loom-export %s\n' % time.asctime(
+        time.gmtime(revision.timestamp)).encode('ascii'))
+    to_file.write(b'From: %s\n' % revision.committer.encode('utf-8'))
+    to_file.write(b'Date: %s\n' % email.utils.formatdate(
+        revision.timestamp, localtime=True).encode('ascii'))
+    to_file.write(b'Subject: %s\n' % subject.encode('utf-8'))
+    to_file.write(b'MIME-Version: 1.0\n')
+    to_file.write(b'Content-Type: text/plain; charset="utf-8"\n\n')
+    for line in revision.message.encode('utf-8').splitlines():
+        if line.startswith(b'From '):
+            line = b'>' + line
+        to_file.write(line + b'\n')
+    to_file.write(b'---\n')
+    to_file.write(patch)
+    to_file.write(b'\n')
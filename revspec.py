@@ -20,7 +20,10 @@
 from __future__ import absolute_import
 
 from breezy.plugins.loom.branch import NoLowerThread
-from breezy.plugins.loom import require_loom_branch
+from breezy.plugins.loom import (
+    loom_state,
+    require_loom_branch,
+    )
 from breezy.revisionspec import RevisionSpec, RevisionInfo
 
 
@@ -30,15 +33,43 @@ class LoomRevisionSpec(RevisionSpec):
     def _match_on(self, branch, revs):
          return RevisionInfo(branch, None, self._as_revision_id(branch))
 
+    def _split_spec(self, state):
+        """Split the spec into a thread name and a recorded loom revno.
+
+        A spec that names a thread of the current loom, even one with an '@'
+        in its name, is never split.
+
+        :param state: The current LoomState of the branch.
+        :return: A (thread_name, loom_revno) tuple. loom_revno is None unless
+            the spec ends in '@' and a number, such as 'foo@-2'.
+        """
+        if self.spec in [thread[0] for thread in state.get_threads()]:
+            return self.spec, None
+        thread_name, at, loom_revno = self.spec.rpartition('@')
+        if at:
+            try:
+                return thread_name, int(loom_revno)
+            except ValueError:
+                pass
+        return self.spec, None
+
     def _as_revision_id(self, branch):
         require_loom_branch(branch)
-        branch.lock_read()
-        try:
+        with branch.lock_read():
+            # Cached while the branch is locked, so commands that hold a
+            # lock while resolving several specs only read it once.
             state = branch.get_loom_state()
+            thread_name, loom_revno = self._split_spec(state)
+            if loom_revno is not None:
+                # Recorded looms are read from the loom index.
+                threads = branch.get_threads(
+                    branch.get_loom_revision_id(loom_revno))
+                state = loom_state.LoomState()
+                state.set_threads(
+                    (thread + ([thread[1]],) for thread in threads))
             threads = state.get_threads()
-            return self._as_thread_revision_id(branch, state, threads)
-        finally:
-            branch.unlock()
+            return self._as_thread_revision_id(branch, state, threads,
+                                               thread_name)
 
 
 class RevisionSpecBelow(LoomRevisionSpec):
@@ -53,17 +84,19 @@ class RevisionSpecBelow(LoomRevisionSpec):
       below:                   -> return the tip of the next lower thread.
       below:foo                -> return the tip of the thread under the one
                                   named 'foo'
+      below:foo@-2             -> return the tip of the thread under 'foo' in
+                                  the loom recorded before the last one
 
     see also: loom, the thread: revision specifier
     """
 
     prefix = 'below:'
 
-    def _as_thread_revision_id(self, branch, state, threads):
+    def _as_thread_revision_id(self, branch, state, threads, thread_name):
         # '' -> next lower
         # foo -> thread under foo
-        if len(self.spec):
-            index = state.thread_index(self.spec)
+        if len(thread_name):
+            index = state.thread_index(thread_name)
         else:
             current_thread = branch.nick
             index = state.thread_index(current_thread)
@@ -83,17 +116,25 @@ class RevisionSpecThread(LoomRevisionSpec):
 
       thread:                   -> return the tip of the next lower thread.
       thread:foo                -> return the tip of the thread named 'foo'
+      thread:foo@-2             -> return the tip of the thread named 'foo'
+                                   in the loom recorded before the last one
+
+    A thread name followed by '@' and a number looks the thread up in a
+    recorded loom. Numbers count recorded looms as ``show-loom -r`` does:
+    1 is the first loom recorded and -1 the last. A thread of the current
+    loom whose name itself ends in '@' and a number is still selected by
+    its name.
 
     see also: loom, the below: revision specifier
     """
 
     prefix = 'thread:'
 
-    def _as_thread_revision_id(self, branch, state, threads):
+    def _as_thread_revision_id(self, branch, state, threads, thread_name):
         # '' -> next lower
         # foo -> named
-        if len(self.spec):
-            index = state.thread_index(self.spec)
+        if len(thread_name):
+            index = state.thread_index(thread_name)
         else:
             current_thread = branch.nick
             index = state.thread_index(current_thread) - 1
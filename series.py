@@ -0,0 +1,190 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+
+"""Import a quilt patch series into a loom."""
+
+from __future__ import absolute_import
+
+import posixpath
+
+from breezy import (
+    errors,
+    osutils,
+    patches as _mod_patches,
+    )
+from breezy.bzr import generate_ids
+
+
+class PatchDoesNotApply(errors.BzrError):
+
+    _fmt = """Patch %(patch_name)s does not apply: %(reason)s"""
+
+    def __init__(self, patch_name, reason):
+        errors.BzrError.__init__(self)
+        self.patch_name = patch_name
+        self.reason = reason
+
+
+def read_series(content):
+    """Parse the content of a quilt series file.
+
+    :param content: The series file as bytes.
+    :return: A list of (patch_name, strip_level) tuples, in order.
+    """
+    result = []
+    for line in content.decode('utf-8').splitlines():
+        line = line.split('#', 1)[0].split()
+        if not line:
+            continue
+        strip = 1
+        for option in line[1:]:
+            if option.startswith('-p'):
+                strip = int(option[2:])
+        result.append((line[0], strip))
+    return result
+
+
+def thread_name_for_patch(patch_name):
+    """Return the name of the thread to import a patch as."""
+    for suffix in ('.patch', '.diff'):
+        if patch_name.endswith(suffix):
+            return patch_name[:-len(suffix)]
+    return patch_name
+
+
+def patch_message(patch_name, content):
+    """Return a commit message for a patch.
+
+    This is the description quilt keeps before the diff, or a generic
+    message if there is none.
+    """
+    description = []
+    for line in content.decode('utf-8', 'replace').splitlines():
+        if line.startswith(('--- ', '=== ', 'diff ', 'Index: ')):
+            break
+        description.append(line)
+    while description and not description[-1].strip():
+        description.pop()
+    while description and not description[0].strip():
+        description.pop(0)
+    if not description:
+        return 'Import %s.' % patch_name
+    return '\n'.join(description)
+
+
+def _strip_path(path, strip):
+    if path == b'/dev/null':
+        return None
+    path = path.decode('utf-8')
+    return '/'.join(path.split('/')[strip:])
+
+
+def _check_hunks(patch_name, path, old_lines, hunks):
+    """Raise PatchDoesNotApply unless hunks apply exactly to old_lines.
+
+    iter_patched_from_hunks cannot build the PatchConflict for bytes lines,
+    and fails obscurely on a patch that runs past the end of the file, so
+    the lines are checked before it is called.
+    """
+    for hunk in hunks:
+        line_no = hunk.orig_pos
+        for hunk_line in hunk.lines:
+            if not isinstance(hunk_line,
+                    (_mod_patches.ContextLine, _mod_patches.RemoveLine)):
+                continue
+            if (line_no > len(old_lines) or
+                old_lines[line_no - 1] != hunk_line.contents):
+                raise PatchDoesNotApply(patch_name,
+                    'conflict in %s at line %d' % (path, line_no))
+            line_no += 1
+
+
+def commit_patch(branch, parent_revision, patch_name, content, strip,
+                 thread_name):
+    """Commit a patch on top of a revision, without a working tree.
+
+    The patch is applied to a preview of parent_revision and the result is
+    committed directly to the repository.
+
+    :param branch: The write locked loom the revision is committed for.
+    :return: The new revision id.
+    """
+    basis = branch.repository.revision_tree(parent_revision)
+    # Apply every hunk first, so a patch touching a file twice works.
+    new_contents = {}
+    for patch in _mod_patches.parse_patches(
+            osutils.split_lines(content), allow_dirty=True):
+        if not isinstance(patch, _mod_patches.Patch):
+            raise PatchDoesNotApply(patch_name, 'binary patches are not '
+                'supported')
+        old_path = _strip_path(patch.oldname, strip)
+        new_path = _strip_path(patch.newname, strip)
+        path = new_path or old_path
+        source = old_path or new_path
+        if source in new_contents:
+            old_lines = new_contents[source] or []
+        elif old_path is not None and basis.is_versioned(old_path):
+            old_lines = basis.get_file_lines(old_path)
+        else:
+            old_lines = []
+        _check_hunks(patch_name, source, old_lines, patch.hunks)
+        try:
+            lines = list(_mod_patches.iter_patched_from_hunks(old_lines,
+                patch.hunks))
+        except _mod_patches.PatchConflict as e:
+            raise PatchDoesNotApply(patch_name, str(e))
+        if new_path is None:
+            new_contents[path] = None
+        else:
+            new_contents[path] = lines
+            if old_path is not None and old_path != new_path:
+                # A rename: the file is no longer at its old path.
+                new_contents[old_path] = None
+    with basis.preview_transform() as transform:
+        directories = {'': transform.root}
+
+        def trans_id_for_directory(path):
+            if path not in directories:
+                if basis.is_versioned(path):
+                    directories[path] = transform.trans_id_tree_path(path)
+                else:
+                    directory, name = posixpath.split(path)
+                    directories[path] = transform.new_directory(name,
+                        trans_id_for_directory(directory),
+                        generate_ids.gen_file_id(name))
+            return directories[path]
+
+        for path, lines in sorted(new_contents.items()):
+            if basis.is_versioned(path):
+                trans_id = transform.trans_id_tree_path(path)
+                transform.delete_contents(trans_id)
+                if lines is None:
+                    transform.unversion_file(trans_id)
+                else:
+                    transform.create_file(lines, trans_id)
+            elif lines is not None:
+                directory, name = posixpath.split(path)
+                transform.new_file(name, trans_id_for_directory(directory),
+                    lines, generate_ids.gen_file_id(name))
+        builder = branch.get_commit_builder([parent_revision],
+            revprops={'branch-nick': thread_name})
+        for unused in builder.record_iter_changes(
+            transform.get_preview_tree(), parent_revision,
+            transform.iter_changes()):
+            pass
+        builder.finish_inventory()
+        return builder.commit(patch_message(patch_name, content))
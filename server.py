@@ -0,0 +1,240 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+
+"""A daemon answering loom queries over a Unix socket.
+
+Each connection carries one request: a line of JSON naming the query and
+the branch to ask about, as an absolute path, such as::
+
+  {"query": "show-loom", "branch": "/src/project"}
+
+The reply is a line of JSON holding either the result or an error::
+
+  {"result": ...}
+  {"error": "No such thread 'foo'."}
+
+The queries are:
+
+ * show-loom: the current thread, the loom parents and the threads, as
+   ``show-loom --format=json`` gives them.
+ * current-thread: the name of the current thread.
+ * revision-id: the revision id a revision specifier, given as "spec",
+   selects in the branch, such as "thread:foo" or "below:".
+
+Branches are kept open and read locked between queries, so their loom
+state is only parsed once. Before each query the control files of the
+branch and the pack list of its repository are checked, and the branch is
+locked afresh if any of them changed. Only the most recently queried
+branches are kept open.
+Requests are answered one at a time, as branch objects are not thread
+safe.
+
+loom_client is a client that does not need breezy.
+"""
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+import json
+import os
+import socket
+import socketserver
+
+from breezy import (
+    branch as _mod_branch,
+    errors,
+    trace,
+    )
+from breezy.revisionspec import RevisionSpec
+
+from breezy.plugins.loom import require_loom_branch
+from breezy.plugins.loom.commands import json_thread_entry
+
+
+# The control files that change when a loom is changed.
+_WATCHED_FILES = [
+    'branch.conf',
+    'last-loom',
+    'last-revision',
+    'revision-history',
+    ]
+
+# The repository files that change when revisions are added or repacked.
+_WATCHED_REPOSITORY_FILES = [
+    'pack-names',
+    ]
+
+# How many branches the server keeps open. The least recently queried
+# branch is unlocked and dropped beyond that.
+_MAX_OPEN_LOOMS = 20
+
+
+class ServerAlreadyRunning(errors.BzrError):
+
+    _fmt = """A loom server is already listening on %(path)s."""
+
+    def __init__(self, path):
+        errors.BzrError.__init__(self)
+        self.path = path
+
+
+class _OpenLoom(object):
+    """A loom branch held open and read locked by the server."""
+
+    def __init__(self, location):
+        self.branch = _mod_branch.Branch.open(location)
+        require_loom_branch(self.branch)
+        self._signature = self._stat()
+        self.branch.lock_read()
+
+    def _stat(self):
+        signature = []
+        watched = [(self.branch._transport, name) for name in _WATCHED_FILES]
+        watched.extend((self.branch.repository.control_transport, name)
+                       for name in _WATCHED_REPOSITORY_FILES)
+        for transport, name in watched:
+            try:
+                stat = os.stat(transport.local_abspath(name))
+            except (OSError, errors.NotLocalUrl):
+                signature.append(None)
+            else:
+                signature.append(
+                    (stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return signature
+
+    def refresh(self):
+        """Forget the cached state of the branch if it has changed.
+
+        A change to the repository's pack list, as after a commit or a
+        repack, counts too, so queries do not read packs that are gone.
+        """
+        signature = self._stat()
+        if signature != self._signature:
+            # The branch and repository cache their state only while they
+            # are locked.
+            self.branch.unlock()
+            self._signature = signature
+            self.branch.lock_read()
+
+    def close(self):
+        self.branch.unlock()
+
+
+def _show_loom(branch, request):
+    state = branch.get_loom_state()
+    nick = branch.nick
+    return {
+        'current': nick,
+        'parents': [revid.decode('utf-8') for revid in state.get_parents()],
+        'threads': [json_thread_entry(thread, revid, parents, nick)
+                    for thread, revid, parents in state.get_threads()],
+        }
+
+
+def _current_thread(branch, request):
+    return branch.nick
+
+
+def _revision_id(branch, request):
+    spec = RevisionSpec.from_string(request['spec'])
+    return spec.as_revision_id(branch).decode('utf-8')
+
+
+_QUERIES = {
+    'current-thread': _current_thread,
+    'revision-id': _revision_id,
+    'show-loom': _show_loom,
+    }
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            reply = {'result': self.server.loom_server.answer(request)}
+        except (errors.BzrError, KeyError, ValueError) as e:
+            reply = {'error': str(e)}
+        except Exception as e:
+            trace.log_exception_quietly()
+            reply = {'error': 'internal error: %s' % (e,)}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class LoomServer(object):
+    """Answer loom queries on a Unix socket."""
+
+    def __init__(self, path):
+        """Listen on the Unix socket at path.
+
+        A stale socket left by a server that has exited is replaced.
+
+        :raises ServerAlreadyRunning: If a server is listening on path.
+        """
+        self.path = path
+        # Location to _OpenLoom, least recently queried first.
+        self._looms = OrderedDict()
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path)
+            else:
+                raise ServerAlreadyRunning(path)
+            finally:
+                probe.close()
+        self._server = socketserver.UnixStreamServer(path, _RequestHandler)
+        self._server.loom_server = self
+
+    def _get_branch(self, location):
+        if not os.path.isabs(location):
+            # The working directory of the server is not the client's.
+            raise ValueError('Branch path is not absolute: %r' % (location,))
+        loom = self._looms.pop(location, None)
+        if loom is None:
+            loom = _OpenLoom(location)
+        else:
+            loom.refresh()
+        self._looms[location] = loom
+        while len(self._looms) > _MAX_OPEN_LOOMS:
+            self._looms.popitem(last=False)[1].close()
+        return loom.branch
+
+    def answer(self, request):
+        """Answer one request, already decoded from JSON."""
+        query = _QUERIES[request['query']]
+        return query(self._get_branch(request['branch']), request)
+
+    def serve_forever(self):
+        """Answer requests until shutdown is called."""
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """Stop serve_forever, from another thread."""
+        self._server.shutdown()
+
+    def close(self):
+        """Stop listening, and release the branches."""
+        self._server.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        for loom in self._looms.values():
+            loom.close()
+        self._looms.clear()
@@ -0,0 +1,196 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+
+"""A cache of loom states shared by every thread in a process.
+
+Hosts that read looms from many threads, such as a web service, open a
+branch object per request. Each would read and parse last-loom again; with
+the cache they share one FrozenLoomState per loom. A cached state is
+checked against the size, inode and modification time of last-loom before
+it is used, or, where the transport cannot stat files, against the sha1
+of its content, so a change made by any process is seen.
+
+Each loom has a ReadWriteLock: threads finding a fresh state share it under
+the read lock, and only a thread that has to parse last-loom takes the
+write lock, so one slow read does not hold up readers of other looms.
+"""
+
+from __future__ import absolute_import
+
+import contextlib
+from io import BytesIO
+import threading
+
+from breezy import (
+    errors,
+    osutils,
+    )
+
+from breezy.plugins.loom import (
+    loom_io,
+    loom_state,
+    timing,
+    )
+
+
+class ReadWriteLock(object):
+    """A lock that many readers may hold at once, or a single writer.
+
+    Waiting writers go first, so a steady stream of readers cannot keep a
+    writer out. The lock is not reentrant.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        """Hold the lock for reading in the body of a with statement."""
+        with self._condition:
+            while self._writing or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        """Hold the lock for writing in the body of a with statement."""
+        with self._condition:
+            self._writers_waiting += 1
+            try:
+                while self._writing or self._readers:
+                    self._condition.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class _Entry(object):
+    """The cached state of one loom."""
+
+    def __init__(self):
+        self.lock = ReadWriteLock()
+        # The stat signature of last-loom when it was read, if known.
+        self.signature = None
+        # The sha1 of last-loom, as get_loom_state_and_key gives it.
+        self.key = None
+        self.state = None
+
+
+def _stat_signature(transport):
+    """Return a signature of the last-loom file, or None if unknown."""
+    try:
+        stat = transport.stat('last-loom')
+    except errors.TransportNotPossible:
+        return None
+    return (getattr(stat, 'st_ino', None), stat.st_size,
+            getattr(stat, 'st_mtime_ns', stat.st_mtime))
+
+
+def _parse(content):
+    with timing.span('branch.read_state'):
+        reader = loom_io.LoomStateReader(BytesIO(content))
+        return loom_state.LoomState(reader).freeze()
+
+
+class LoomStateCache(object):
+    """Thread safe cache of the loom state of each loom branch.
+
+    Looms are known by the URL of their control directory, so separate
+    branch objects for one loom share its cached state.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _get_entry(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                entry = self._entries[url] = _Entry()
+            return entry
+
+    def get(self, branch):
+        """Return the current state of branch.
+
+        :return: A (FrozenLoomState, key) tuple, where key is the sha1 of
+            last-loom.
+        """
+        transport = branch._transport
+        entry = self._get_entry(transport.base)
+        signature = _stat_signature(transport)
+        if signature is not None:
+            with entry.lock.read():
+                if entry.signature == signature:
+                    return entry.state, entry.key
+            with entry.lock.write():
+                # Another thread may have read it while we waited.
+                if entry.signature != signature:
+                    entry.state, entry.key = self._read(transport, entry)
+                    entry.signature = signature
+                return entry.state, entry.key
+        # Without stat the content has to be read, but not parsed again.
+        content, key = self._read_content(transport)
+        with entry.lock.read():
+            if entry.key == key:
+                return entry.state, entry.key
+        state = _parse(content)
+        with entry.lock.write():
+            entry.state, entry.key, entry.signature = state, key, None
+        return state, key
+
+    def _read_content(self, transport):
+        timing.count('last-loom.read')
+        content = transport.get_bytes('last-loom')
+        return content, osutils.sha_string(content)
+
+    def _read(self, transport, entry):
+        content, key = self._read_content(transport)
+        if key == entry.key:
+            # Only the stat signature changed, such as after a touch.
+            return entry.state, key
+        return _parse(content), key
+
+    def invalidate(self, branch):
+        """Forget the cached state of branch."""
+        with self._lock:
+            self._entries.pop(branch._transport.base, None)
+
+    def clear(self):
+        """Forget every cached state."""
+        with self._lock:
+            self._entries.clear()
+
+
+# The cache shared by all branches in the process.
+cache = LoomStateCache()
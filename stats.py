@@ -0,0 +1,502 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+
+"""Statistics about the threads in a loom."""
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from io import BytesIO
+
+import patiencediff
+
+from breezy import (
+    errors,
+    osutils,
+    textfile,
+    transport as _mod_transport,
+    )
+from breezy.revision import NULL_REVISION
+
+from breezy.plugins.loom import loom_io
+from breezy.plugins.loom.branch import EMPTY_REVISION
+
+
+def _thread_revision(revision_id):
+    """Map the empty thread marker to the null revision."""
+    if revision_id == EMPTY_REVISION:
+        return NULL_REVISION
+    return revision_id
+
+
+# The states classify_threads puts threads in.
+MERGED = 'merged'
+MERGED_UPSTREAM = 'upstream'
+LIVE = 'live'
+
+
+def thread_revision_counts(graph, revisions):
+    """Count the revisions in each thread that are not in the thread below.
+
+    Each pair of threads is compared with Graph.find_unique_ancestors,
+    which stops reading the graph once it has found where the two threads
+    meet, so the cost follows the size of the threads rather than the depth
+    of the history under them.
+
+    :param graph: The Graph of the loom's repository.
+    :param revisions: The thread revisions, bottom thread first.
+    :return: A list with one entry per thread. The entry for the bottom
+        thread is None, as there is no thread below it.
+    """
+    revisions = [_thread_revision(revision) for revision in revisions]
+    return [None] + _pair_revision_counts(graph,
+        list(zip(revisions, revisions[1:])))
+
+
+def _pair_revision_counts(graph, pairs):
+    """Count the revisions in upper that are not in lower, for each pair."""
+    counts = []
+    for lower, upper in pairs:
+        if upper == NULL_REVISION:
+            counts.append(0)
+            continue
+        unique = graph.find_unique_ancestors(upper, [lower])
+        # Ghosts are not revisions of the thread.
+        counts.append(len(graph.get_parent_map(unique)))
+    return counts
+
+
+def classify_threads(graph, revisions, upstream_revision=None):
+    """Classify every thread as merged, merged upstream, or live.
+
+    A thread is MERGED when all of its work is in the thread below it, and
+    MERGED_UPSTREAM when all of its work is in upstream_revision. Other
+    threads are LIVE, as is the bottom thread, which is what the loom is
+    built on. Only the graph between the threads compared is read.
+
+    :param graph: A Graph that can answer for the loom's repository and, if
+        upstream_revision is given, the upstream repository.
+    :param revisions: The thread revisions, bottom thread first.
+    :param upstream_revision: An optional upstream revision to check for
+        merged threads.
+    :return: A list with the state of each thread.
+    """
+    revisions = [_thread_revision(revision) for revision in revisions]
+    result = [LIVE] * min(len(revisions), 1)
+    for lower, upper in zip(revisions, revisions[1:]):
+        if graph.is_ancestor(upper, lower):
+            result.append(MERGED)
+        elif (upstream_revision is not None and
+              graph.is_ancestor(upper, upstream_revision)):
+            result.append(MERGED_UPSTREAM)
+        else:
+            result.append(LIVE)
+    return result
+
+
+def threads_needing_up_thread(graph, revisions, contained=None):
+    """Find the threads an up-thread would have to merge into.
+
+    Those are the threads that do not contain the thread below them, and
+    every thread above such a thread, since the changes an up-thread brings
+    in travel all the way up the loom. Only the graph between adjacent
+    threads is read, and nothing above the first thread that is behind.
+
+    :param graph: The Graph of the loom's repository.
+    :param revisions: The thread revisions, bottom thread first.
+    :param contained: An optional dict mapping (lower, upper) revision pairs
+        to whether upper contains lower. Answers found there are not looked
+        up again, and new answers are added to it.
+    :return: A list with one boolean per thread. The entry for the bottom
+        thread is False.
+    """
+    revisions = [_thread_revision(revision) for revision in revisions]
+    if contained is None:
+        contained = {}
+    result = [False] * min(len(revisions), 1)
+    behind = False
+    for lower, upper in zip(revisions, revisions[1:]):
+        if not behind:
+            pair = (lower, upper)
+            if pair not in contained:
+                contained[pair] = graph.is_ancestor(lower, upper)
+            behind = not contained[pair]
+        result.append(behind)
+    return result
+
+
+def diffstat(old_tree, new_tree):
+    """Summarise the changes between two trees.
+
+    :return: A (files_changed, lines_inserted, lines_deleted) tuple. Binary
+        files count as changed files but contribute no lines.
+    """
+    files = inserted = deleted = 0
+    with old_tree.lock_read(), new_tree.lock_read():
+        for change in new_tree.iter_changes(old_tree):
+            if not set(change.kind).intersection(('file', 'symlink')):
+                continue
+            files += 1
+            if not change.changed_content:
+                continue
+            old_path, new_path = change.path
+            old_lines = new_lines = []
+            if change.kind[0] == 'file':
+                old_lines = old_tree.get_file_lines(old_path)
+            if change.kind[1] == 'file':
+                new_lines = new_tree.get_file_lines(new_path)
+            try:
+                textfile.check_text_lines(old_lines)
+                textfile.check_text_lines(new_lines)
+            except textfile.BinaryFile:
+                continue
+            matcher = patiencediff.PatienceSequenceMatcher(None, old_lines,
+                new_lines)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                if tag in ('replace', 'delete'):
+                    deleted += i2 - i1
+                if tag in ('replace', 'insert'):
+                    inserted += j2 - j1
+    return files, inserted, deleted
+
+
+def load_trees(repository, revisions):
+    """Load the revision trees of several threads at once.
+
+    Adjacent threads share a tree, the new tree of one thread being the old
+    tree of the next, so each distinct tree is loaded only once.
+
+    :param revisions: Thread revisions, which may include the null revision.
+    :return: A dict mapping each revision to its tree.
+    """
+    unique_revisions = list(set(revisions) - set([NULL_REVISION]))
+    trees = dict(zip(unique_revisions,
+                     repository.revision_trees(unique_revisions)))
+    trees[NULL_REVISION] = repository.revision_tree(NULL_REVISION)
+    return trees
+
+
+def _pair_diffstats(repository, pairs):
+    """Compute the diffstat for each (old_revision, new_revision) pair."""
+    revisions = set()
+    for pair in pairs:
+        revisions.update(pair)
+    trees = load_trees(repository, revisions)
+    return [diffstat(trees[old], trees[new]) for old, new in pairs]
+
+
+def thread_diffstats(repository, revisions):
+    """Compute the diffstat of each thread against the thread below it.
+
+    :param repository: The loom's repository.
+    :param revisions: The thread revisions, bottom thread first.
+    :return: A list with one diffstat tuple per thread, as returned by
+        diffstat. The entry for the bottom thread is None.
+    """
+    revisions = [_thread_revision(revision) for revision in revisions]
+    return [None] + _pair_diffstats(repository,
+        list(zip(revisions[:-1], revisions[1:])))
+
+
+def _changed_paths(old_tree, new_tree):
+    """Return the set of paths that differ between two trees."""
+    paths = set()
+    with old_tree.lock_read(), new_tree.lock_read():
+        for change in new_tree.iter_changes(old_tree):
+            paths.update(path for path in change.path if path is not None)
+    return paths
+
+
+def thread_dependencies(repository, revisions):
+    """Find which lower threads each thread's changes depend on.
+
+    A thread depends on a lower thread when their changes, each against the
+    thread below it, touch a common path. Threads that touch disjoint paths
+    are independent of each other, and could be merged, reordered or split
+    into separate looms without conflicts. The bottom thread is what the
+    loom is built on, so it is not counted as a dependency.
+
+    :param repository: The loom's repository.
+    :param revisions: The thread revisions, bottom thread first.
+    :return: A list with one entry per thread, holding the sorted indices
+        of the threads it depends on. The entry for the bottom thread is
+        None.
+    """
+    revisions = [_thread_revision(revision) for revision in revisions]
+    trees = load_trees(repository, revisions)
+    changed = [None]
+    result = [None]
+    for index in range(1, len(revisions)):
+        paths = _changed_paths(trees[revisions[index - 1]],
+                               trees[revisions[index]])
+        result.append([lower for lower in range(1, index)
+                       if paths & changed[lower]])
+        changed.append(paths)
+    return result
+
+
+class StatsCache(object):
+    """A size bounded cache of thread statistics, stored in a branch.
+
+    Entries are keyed by the (lower_revision, thread_revision) pair they
+    describe. Revisions never change, so entries never go stale; the least
+    recently used entries are dropped once there are more than max_entries.
+    The cache is only an optimisation: it is discarded if it cannot be read,
+    and not saved if the branch cannot be written to.
+    """
+
+    _filename = 'loom-stats'
+    _header = b'Loom statistics cache 1\n'
+
+    def __init__(self, transport, max_entries=1000):
+        self._transport = transport
+        self._max_entries = max_entries
+        self._entries = None
+        self._changed = False
+
+    def _get_entries(self):
+        if self._entries is None:
+            self._entries = OrderedDict()
+            try:
+                lines = self._transport.get_bytes(self._filename).splitlines(
+                    True)
+            except _mod_transport.NoSuchFile:
+                lines = []
+            if lines and lines[0] == self._header:
+                for line in lines[1:]:
+                    fields = line.split()
+                    if len(fields) != 6:
+                        continue
+                    self._entries[tuple(fields[:2])] = tuple(
+                        int(field) for field in fields[2:])
+        return self._entries
+
+    def get(self, lower_revision, thread_revision):
+        """Return the cached statistics for a thread, or None."""
+        entries = self._get_entries()
+        key = (lower_revision, thread_revision)
+        value = entries.pop(key, None)
+        if value is not None:
+            entries[key] = value
+        return value
+
+    def add(self, lower_revision, thread_revision, value):
+        """Cache the statistics for a thread.
+
+        :param value: A (revisions, files_changed, lines_inserted,
+            lines_deleted) tuple.
+        """
+        entries = self._get_entries()
+        key = (lower_revision, thread_revision)
+        entries.pop(key, None)
+        entries[key] = tuple(value)
+        while len(entries) > self._max_entries:
+            entries.popitem(last=False)
+        self._changed = True
+
+    def save(self):
+        """Write the cache back to the branch if it has changed."""
+        if not self._changed:
+            return
+        lines = [self._header]
+        for (lower_revision, thread_revision), value in self._entries.items():
+            lines.append(b' '.join(
+                [lower_revision, thread_revision] +
+                [b'%d' % field for field in value]) + b'\n')
+        try:
+            self._transport.put_bytes(self._filename, b''.join(lines))
+        except (errors.TransportNotPossible, errors.PermissionDenied):
+            return
+        self._changed = False
+
+
+def thread_stats(loom, revisions):
+    """Return the statistics of each thread against the thread below it.
+
+    Results are read from, and added to, the StatsCache of the loom, so
+    only threads that have changed since they were last looked at cost a
+    graph walk and a diff.
+
+    :param loom: A read locked loom branch.
+    :param revisions: The thread revisions, bottom thread first.
+    :return: A list with one (revisions, files_changed, lines_inserted,
+        lines_deleted) tuple per thread. The entry for the bottom thread is
+        None.
+    """
+    revisions = [_thread_revision(revision) for revision in revisions]
+    cache = StatsCache(loom._transport)
+    result = [None]
+    missing = []
+    for index in range(1, len(revisions)):
+        value = cache.get(revisions[index - 1], revisions[index])
+        result.append(value)
+        if value is None:
+            missing.append(index)
+    if missing:
+        pairs = [(revisions[index - 1], revisions[index]) for index in missing]
+        counts = _pair_revision_counts(loom.repository.get_graph(), pairs)
+        diffstats = _pair_diffstats(loom.repository, pairs)
+        for index, count, diff in zip(missing, counts, diffstats):
+            result[index] = (count,) + diff
+            cache.add(revisions[index - 1], revisions[index], result[index])
+        cache.save()
+    return result
+
+
+class SummaryCache(object):
+    """The summary of one loom state, stored in a branch.
+
+    Only the summary of the last state asked about is kept, keyed by the
+    sha1 of the serialised state, so it stays valid until the loom state
+    changes. Alongside it is kept which adjacent threads of that state
+    contain each other, by revision pair, so after a commit only the pairs
+    next to the changed thread need the graph again. Like StatsCache, it is
+    only an optimisation.
+    """
+
+    _filename = 'loom-summary'
+    _header = b'Loom summary cache 2\n'
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._content = None
+
+    def _read(self):
+        """Return the cached (key, summary, contained), or None."""
+        if self._content is None:
+            self._content = self._parse()
+        return self._content or None
+
+    def _parse(self):
+        try:
+            lines = self._transport.get_bytes(self._filename).splitlines()
+        except _mod_transport.NoSuchFile:
+            return ()
+        if len(lines) < 3 or lines[0] + b'\n' != self._header:
+            return ()
+        flags = []
+        contained = {}
+        try:
+            loom_unrecorded = bool(int(lines[2]))
+            for line in lines[3:]:
+                fields = line.split()
+                if len(fields) == 2:
+                    flags.append(tuple(bool(int(field)) for field in fields))
+                elif len(fields) == 3:
+                    contained[tuple(fields[:2])] = bool(int(fields[2]))
+                else:
+                    return ()
+        except ValueError:
+            return ()
+        return lines[1], (loom_unrecorded, flags), contained
+
+    def get(self, key):
+        """Return the cached summary for key, or None."""
+        content = self._read()
+        if content is None or content[0] != key:
+            return None
+        return content[1]
+
+    def get_contained(self):
+        """Return the cached (lower, upper) to contained dict.
+
+        Unlike the summary, these stay valid when the loom state changes.
+        """
+        content = self._read()
+        if content is None:
+            return {}
+        return dict(content[2])
+
+    def set(self, key, summary, contained=None):
+        """Cache summary as the summary for key.
+
+        :param contained: A dict as threads_needing_up_thread takes, for the
+            threads of the state.
+        """
+        loom_unrecorded, flags = summary
+        lines = [self._header, key + b'\n', b'%d\n' % loom_unrecorded]
+        for unrecorded, needs_up_thread in flags:
+            lines.append(b'%d %d\n' % (unrecorded, needs_up_thread))
+        for (lower, upper), value in sorted((contained or {}).items()):
+            lines.append(b'%s %s %d\n' % (lower, upper, value))
+        try:
+            self._transport.put_bytes(self._filename, b''.join(lines))
+        except (errors.TransportNotPossible, errors.PermissionDenied,
+                errors.LockContention):
+            return
+        self._content = (key, summary, contained or {})
+
+
+def _summarise_loom(loom, state, contained):
+    """Compare state with its basis loom; see loom_summary."""
+    threads = state.get_threads()
+    basis_threads = loom.get_threads(state.get_basis_revision_id())
+    loom_unrecorded = (len(state.get_parents()) > 1 or
+        [thread[:2] for thread in threads] != basis_threads)
+    basis_revisions = dict(basis_threads)
+    revisions = [revision for name, revision, parents in threads]
+    needs_up_thread = threads_needing_up_thread(loom.repository.get_graph(),
+        revisions, contained)
+    flags = []
+    for index, (name, revision, parents) in enumerate(threads):
+        if name in basis_revisions:
+            recorded = basis_revisions[name]
+        elif index:
+            # A new thread starts at the tip of the thread below it.
+            recorded = revisions[index - 1]
+        else:
+            recorded = EMPTY_REVISION
+        flags.append((revision != recorded, needs_up_thread[index]))
+    return loom_unrecorded, flags
+
+
+def loom_summary(loom, state=None):
+    """Summarise how a loom differs from its last recorded loom.
+
+    The summary is cached by SummaryCache, so while the loom state does not
+    change this costs a read of one small file. After a change, only the
+    threads next to a changed thread are compared again.
+
+    :param loom: A loom branch.
+    :param state: The current loom state, if it has been read already.
+    :return: A (loom_unrecorded, flags) tuple. loom_unrecorded is True when
+        the threads or parents differ from the basis loom. flags holds an
+        (unrecorded, needs_up_thread) tuple for each thread, bottom thread
+        first: unrecorded is True when the thread has commits that are not
+        in the basis loom, and needs_up_thread is what
+        threads_needing_up_thread gives for the thread.
+    """
+    with loom.lock_read():
+        if state is None:
+            state = loom.get_loom_state()
+        stream = BytesIO()
+        loom_io.LoomStateWriter(state).write(stream)
+        key = osutils.sha_string(stream.getvalue())
+        cache = SummaryCache(loom._transport)
+        summary = cache.get(key)
+        if summary is None or len(summary[1]) != len(state.get_threads()):
+            # Keep only what is known about the adjacent threads of state.
+            known = cache.get_contained()
+            revisions = [_thread_revision(thread[1])
+                         for thread in state.get_threads()]
+            contained = {}
+            for pair in zip(revisions, revisions[1:]):
+                if pair in known:
+                    contained[pair] = known[pair]
+            summary = _summarise_loom(loom, state, contained)
+            cache.set(key, summary, contained)
+        return summary
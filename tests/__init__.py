@@ -27,10 +27,19 @@ from breezy.workingtree import WorkingTree
 
 def test_suite():
     module_names = [
+        'breezy.plugins.loom.tests.test_benchmarks',
         'breezy.plugins.loom.tests.test_branch',
+        'breezy.plugins.loom.tests.test_import',
+        'breezy.plugins.loom.tests.test_loom_index',
+        'breezy.plugins.loom.tests.test_loom_async',
         'breezy.plugins.loom.tests.test_loom_io',
         'breezy.plugins.loom.tests.test_loom_state',
         'breezy.plugins.loom.tests.test_revspec',
+        'breezy.plugins.loom.tests.test_series',
+        'breezy.plugins.loom.tests.test_server',
+        'breezy.plugins.loom.tests.test_state_cache',
+        'breezy.plugins.loom.tests.test_stats',
+        'breezy.plugins.loom.tests.test_timing',
         'breezy.plugins.loom.tests.test_tree',
         'breezy.plugins.loom.tests.blackbox',
         ]
@@ -18,10 +18,12 @@
 
 """UI tests for loom."""
 
+import json
 import os
 
 import breezy
 from breezy import branch as _mod_branch
+from breezy import debug
 from breezy import workingtree
 from breezy.plugins.loom.branch import EMPTY_REVISION
 from breezy.plugins.loom.tree import LoomTreeDecorator
@@ -159,6 +161,95 @@ class TestShow(TestsWithLooms):
         tree = self.get_vendor_loom('subtree')
         self.assertShowLoom(['vendor'], 'vendor', 'subtree')
 
+    def test_show_loom_stats(self):
+        """--stats shows revision counts and diffstats for each thread."""
+        tree = self.get_vendor_loom()
+        tree.branch.new_thread('debian')
+        tree.branch._set_nick('debian')
+        self.build_tree_contents([('file', b'one\ntwo\n')])
+        tree.add('file')
+        tree.commit('add file')
+        self.build_tree_contents([('file', b'one\n2\n')])
+        tree.commit('change file')
+        out, err = self.run_bzr(['show-loom', '--stats'])
+        self.assertEqual(
+            '=>debian  2 revisions, 1 files changed, +2 -0\n'
+            '  vendor\n', out)
+        self.assertEqual('', err)
+
+    def test_show_loom_json(self):
+        """--format=json describes every thread in one document."""
+        tree = self.get_vendor_loom()
+        vendor_rev = tree.last_revision().decode('utf-8')
+        tree.branch.new_thread('debian')
+        tree.branch._set_nick('debian')
+        tree.branch.record_loom('save loom')
+        debian_rev = tree.commit('debian change').decode('utf-8')
+        out, err = self.run_bzr(['show-loom', '--format=json'])
+        self.assertEqual('', err)
+        loom_rev = tree.branch.get_loom_state().get_parents()[0].decode(
+            'utf-8')
+        self.assertEqual({
+            'current': 'debian',
+            'parents': [loom_rev],
+            'threads': [
+                {'name': 'vendor', 'revision': vendor_rev,
+                 'parents': [vendor_rev], 'current': False},
+                {'name': 'debian', 'revision': debian_rev,
+                 'parents': [vendor_rev], 'current': True},
+                ]}, json.loads(out))
+
+    def test_show_loom_json_stats(self):
+        """--format=json includes the statistics asked for with --stats."""
+        tree = self.get_vendor_loom()
+        tree.branch.new_thread('debian')
+        tree.branch._set_nick('debian')
+        tree.commit('debian change')
+        out, err = self.run_bzr(['show-loom', '--format=json', '--stats'])
+        threads = json.loads(out)['threads']
+        self.assertEqual(None, threads[0]['stats'])
+        self.assertEqual({'revisions': 1, 'files_changed': 0,
+            'insertions': 0, 'deletions': 0}, threads[1]['stats'])
+
+    def test_show_loom_dependencies(self):
+        """--dependencies lists the lower threads touching the same files."""
+        tree = self.get_vendor_loom()
+        self.run_bzr(['create-thread', 'one'])
+        self.build_tree_contents([('one', b'one\n')])
+        self.run_bzr(['add', 'one'])
+        self.run_bzr(['commit', '-m', 'one'])
+        self.run_bzr(['create-thread', 'two'])
+        self.build_tree_contents([('two', b'two\n')])
+        self.run_bzr(['add', 'two'])
+        self.run_bzr(['commit', '-m', 'two'])
+        self.run_bzr(['create-thread', 'three'])
+        self.build_tree_contents([('one', b'three\n')])
+        self.run_bzr(['commit', '-m', 'three'])
+        out, err = self.run_bzr(['show-loom', '--dependencies'])
+        self.assertEqual('=>three (depends on one)\n  two\n  one\n'
+            '  vendor\n', out)
+        out, err = self.run_bzr(
+            ['show-loom', '--dependencies', '--format=json'])
+        self.assertEqual([None, [], [], ['one']],
+            [thread['depends_on'] for thread in json.loads(out)['threads']])
+
+    def test_show_loom_revision(self):
+        """-r shows the threads of a recorded loom."""
+        tree = self.get_vendor_loom()
+        tree.branch.record_loom('first')
+        tree.branch.new_thread('debian')
+        tree.branch._set_nick('debian')
+        tree.branch.record_loom('second')
+        tree.branch.new_thread('patch')
+        out, err = self.run_bzr(['show-loom', '-r', '-1'])
+        self.assertEqual('  debian\n  vendor\n', out)
+        out, err = self.run_bzr(['show-loom', '-r', '1'])
+        self.assertEqual('  vendor\n', out)
+        out, err = self.run_bzr(['show-loom', '-r', '3'], retcode=3)
+        self.assertContainsRe(err, 'Invalid revision number')
+        out, err = self.run_bzr(['show-loom', '-r', 'last:1'], retcode=3)
+        self.assertContainsRe(err, 'only accepts loom revision numbers')
+
     def assertShowLoom(self, threads, selected_thread, location=None):
         """Check expected show-loom output."""
         if location:
@@ -182,6 +273,88 @@ class TestShow(TestsWithLooms):
         self.assert_exception_raised_on_non_loom_branch(['show-loom'])
 
 
+class TestLoomLog(TestsWithLooms):
+
+    def test_loom_log(self):
+        """loom-log shows the thread changes in each recorded loom."""
+        tree = self.get_vendor_loom()
+        vendor_rev = tree.last_revision().decode('utf-8')
+        tree.branch.record_loom('first')
+        tree.branch.new_thread('debian')
+        tree.branch.new_thread('patch')
+        tree.branch._set_nick('debian')
+        tree.branch.record_loom('second\nwith two lines')
+        debian_rev = tree.commit('change').decode('utf-8')
+        tree.branch.remove_thread('patch')
+        tree.branch.record_loom('third')
+        out, err = self.run_bzr(['loom-log'])
+        self.assertEqual('', err)
+        self.assertContainsRe(out,
+            '(?s)message:\n  third\nthreads:\n'
+            '  moved debian to %s\n  removed patch\n'
+            '.*message:\n  second\n  with two lines\nthreads:\n'
+            '  added debian at %s\n  added patch at %s\n'
+            '.*message:\n  first\nthreads:\n  added vendor at %s\n$'
+            % (debian_rev, vendor_rev, vendor_rev, vendor_rev))
+        out, err = self.run_bzr(['loom-log', '-l', '1'])
+        self.assertEqual(1, out.count('loom revision:'))
+
+    def test_loom_log_on_non_loomed_branch(self):
+        self.assert_exception_raised_on_non_loom_branch(['loom-log'])
+
+
+class TestLoomPrune(TestsWithLooms):
+
+    def get_loom_with_merged_threads(self):
+        """Get a loom where 'merged' is merged into 'vendor' and 'upstream'
+        into the branch at 'upstream'.
+        """
+        tree = self.get_vendor_loom()
+        self.run_bzr(['create-thread', 'upstream'])
+        self.run_bzr(['commit', '--unchanged', '-m', 'landed upstream'])
+        self.run_bzr(['branch', '.', 'upstream'])
+        self.run_bzr(['create-thread', 'merged'])
+        self.run_bzr(['create-thread', 'live'])
+        self.run_bzr(['commit', '--unchanged', '-m', 'live change'])
+        return tree
+
+    def test_show_loom_merged(self):
+        self.get_loom_with_merged_threads()
+        out, err = self.run_bzr(['show-loom', '--merged'])
+        self.assertEqual(
+            '=>live\n  merged (merged)\n  upstream\n  vendor\n', out)
+        out, err = self.run_bzr(['show-loom', '--upstream', 'upstream'])
+        self.assertEqual(
+            '=>live\n  merged (merged)\n  upstream (merged upstream)\n'
+            '  vendor\n', out)
+
+    def test_loom_prune_dry_run(self):
+        tree = self.get_loom_with_merged_threads()
+        out, err = self.run_bzr(
+            ['loom-prune', '--dry-run', '--upstream', 'upstream'])
+        self.assertEqual("Would remove thread 'upstream' (merged upstream).\n"
+            "Would remove thread 'merged' (merged).\n", err)
+        self.assertEqual(4, len(tree.branch.get_loom_state().get_threads()))
+
+    def test_loom_prune(self):
+        tree = self.get_loom_with_merged_threads()
+        self.run_bzr(['switch', 'merged'])
+        out, err = self.run_bzr(['loom-prune', '--upstream', 'upstream'])
+        self.assertEqual("Removing thread 'upstream' (merged upstream).\n"
+            "Removing thread 'merged' (merged).\n"
+            "All changes applied successfully.\n"
+            "Moved to thread 'vendor'.\n", err)
+        branch = _mod_branch.Branch.open('.')
+        self.assertEqual(['vendor', 'live'],
+            [thread[0] for thread in branch.get_loom_state().get_threads()])
+        self.assertEqual('vendor', branch.nick)
+
+    def test_loom_prune_nothing_merged(self):
+        tree = self.get_vendor_loom()
+        out, err = self.run_bzr(['loom-prune'])
+        self.assertEqual('No merged threads.\n', err)
+
+
 class TestStatus(TestsWithLooms):
 
     def setUp(self):
@@ -201,16 +374,52 @@ class TestStatus(TestsWithLooms):
         # 'bzr status' shows the current thread.
         tree = self.get_vendor_loom()
         self._add_patch(tree, 'thread1')
+        tree.branch.record_loom('add thread1')
         out, err = self.run_bzr(['status'], retcode=0)
         self.assertEqual('', err)
         self.assertEqual('Current thread: thread1\n', out)
 
+    def test_status_shows_unrecorded_loom(self):
+        # 'bzr status' shows unrecorded commits in the current thread and
+        # unrecorded changes to the loom.
+        tree = self.get_vendor_loom()
+        self._add_patch(tree, 'thread1')
+        out, err = self.run_bzr(['status'], retcode=0)
+        self.assertEqual('', err)
+        self.assertEqual('Current thread: thread1 (unrecorded commits)\n'
+            'Loom has unrecorded changes.\n', out)
+        tree.branch.record_loom('add thread1')
+        self.run_bzr(['down-thread'])
+        out, err = self.run_bzr(['status'], retcode=0)
+        self.assertEqual('Current thread: vendor\n', out)
+
+    def test_status_shows_threads_needing_up_thread(self):
+        tree = self.get_vendor_loom()
+        self._add_patch(tree, 'thread1')
+        self._add_patch(tree, 'thread2')
+        LoomTreeDecorator(tree).down_thread('vendor')
+        tree.commit('change vendor', allow_pointless=True)
+        tree.branch.record_loom('change vendor')
+        out, err = self.run_bzr(['status'], retcode=0)
+        self.assertEqual('Current thread: vendor\n'
+            'Threads above needing up-thread: 2\n', out)
+        # The summary is cached until the loom state changes.
+        self.assertTrue(tree.branch._transport.has('loom-summary'))
+        out, err = self.run_bzr(['status'], retcode=0)
+        self.assertEqual('Current thread: vendor\n'
+            'Threads above needing up-thread: 2\n', out)
+        self.run_bzr(['up-thread', '--auto'])
+        out, err = self.run_bzr(['status'], retcode=0)
+        self.assertEqual('Current thread: thread2 (unrecorded commits)\n'
+            'Loom has unrecorded changes.\n', out)
+
     def test_status_shows_current_thread_after_status(self):
         # 'bzr status' shows the current thread after the rest of the status
         # output.
         self.build_tree(['hello.c'])
         tree = self.get_vendor_loom()
         self._add_patch(tree, 'thread1')
+        tree.branch.record_loom('add thread1')
         out, err = self.run_bzr(['status'], retcode=0)
         self.assertEqual('', err)
         self.assertEqual(
@@ -230,6 +439,7 @@ class TestStatus(TestsWithLooms):
         tree = self.get_vendor_loom()
         self._add_patch(tree, 'thread1')
         self._add_patch(tree, 'thread2')
+        tree.branch.record_loom('add threads')
         out, err = self.run_bzr(['status'], retcode=0)
         self.assertEqual('', err)
         self.assertEqual('Current thread: thread2\n', out)
@@ -290,6 +500,13 @@ class TestSwitch(TestsWithLooms):
         self.assertEqual('', out)
         self.assertEqual('', err)
 
+    def test_switch_dash_b_not_a_loom(self):
+        # 'bzr switch -b' in a normal branch is done by the builtin switch.
+        tree = self.make_branch_and_tree('.')
+        tree.commit('first')
+        out, err = self.run_bzr(['switch', '-b', 'other'], retcode=0)
+        self.assertContainsRe(err, 'Switched to branch.*other')
+
 
 class TestRecord(TestsWithLooms):
 
@@ -364,14 +581,12 @@ class TestDown(TestsWithLooms):
         # do a null change in vendor - a new release.
         vendor_release = tree.commit('new vendor release.', allow_pointless=True)
         # pop up, then down
+        # up-thread fast-forwards patch, as it has no commits of its own.
         self.run_bzr(['up-thread'])
         self.run_bzr(['revert'])
         out, err = self.run_bzr(['down-thread'])
         self.assertEqual('', out)
-        self.assertEqual(
-            'All changes applied successfully.\n'
-            "Moved to thread 'vendor'.\n",
-            err)
+        self.assertEqual("Moved to thread 'vendor'.\n", err)
         self.assertEqual('vendor', tree.branch.nick)
         # the tree needs to be updated.
         self.assertEqual(vendor_release, tree.last_revision())
@@ -567,6 +782,34 @@ class TestUp(TestsWithLooms):
         self.run_bzr(['diff'])
         self.assertEqual([patch_rev, vendor_release], tree.get_parent_ids())
 
+    def test_up_thread_dry_run(self):
+        tree = self.get_vendor_loom()
+        tree.branch.new_thread('patch')
+        tree.branch._set_nick('patch')
+        self.build_tree(['afile'])
+        tree.add('afile')
+        patch_rev = tree.commit('add afile as a patch')
+        self.run_bzr(['down-thread'])
+        self.build_tree(['afile'])
+        tree.add('afile')
+        vendor_release = tree.commit('new vendor release adds a file.')
+        out, err = self.run_bzr(['up-thread', '--dry-run'], retcode=1)
+        self.assertEqual(
+            "Merging 'vendor' into 'patch' would conflict:\n"
+            "  Conflict adding file afile.  Moved existing file to"
+            " afile.moved.\n", out)
+        self.assertEqual('vendor', tree.branch.nick)
+        self.assertEqual([vendor_release], tree.get_parent_ids())
+
+    def test_up_thread_dry_run_no_conflicts(self):
+        tree = self.get_vendor_loom()
+        tree.branch.new_thread('patch')
+        tree.branch._set_nick('vendor')
+        tree.commit('new vendor release.', allow_pointless=True)
+        out, err = self.run_bzr(['up-thread', '--dry-run'])
+        self.assertEqual('No conflicts predicted.\n', out)
+        self.assertEqual('vendor', tree.branch.nick)
+
     def test_up_thread_accepts_thread(self):
         tree = self.get_vendor_loom()
         tree.branch.new_thread('lower-middle')
@@ -823,3 +1066,154 @@ class TestExportLoom(TestsWithLooms):
         tree = self.get_vendor_loom()
         self.run_bzr(['export-loom', 'export-path'])
         branch = breezy.branch.Branch.open('export-path/vendor')
+
+
+class TestExportPatches(TestsWithLooms):
+
+    def get_loom_with_patches(self):
+        tree = self.get_vendor_loom()
+        self.build_tree_contents([('file', b'vendor\n')])
+        tree.add('file')
+        tree.commit('vendor')
+        self.run_bzr(['create-thread', 'fix/build'])
+        self.build_tree_contents([('file', b'fixed\n')])
+        self.run_bzr(['commit', '-m', 'Fix the build.'])
+        self.run_bzr(['create-thread', 'empty'])
+        self.run_bzr(['create-thread', 'feature'])
+        self.build_tree_contents([('feature', b'feature\n')])
+        self.run_bzr(['add', 'feature'])
+        self.run_bzr(['commit', '-m', 'Add a feature.'])
+        return tree
+
+    def test_export_patches(self):
+        self.get_loom_with_patches()
+        out, err = self.run_bzr(['export-patches', 'series'])
+        self.assertEqual('Exported 2 patches.\n', err)
+        self.assertEqual(['01-fix-build.patch', '02-feature.patch'],
+            sorted(os.listdir('series')))
+        with open('series/01-fix-build.patch') as f:
+            self.assertContainsRe(f.read(),
+                "^=== modified file 'file'\n"
+                "--- a/file\t.*\n"
+                "\\+\\+\\+ b/file\t.*\n"
+                "@@ -1,1 \\+1,1 @@\n"
+                "-vendor\n"
+                "\\+fixed\n\n$")
+
+    def test_export_patches_with_empty_thread(self):
+        tree = self.get_loom_with_patches()
+        tree.branch.insert_threads([('unstarted', EMPTY_REVISION)],
+            'fix/build')
+        out, err = self.run_bzr(['export-patches', 'series'])
+        self.assertEqual('Exported 2 patches.\n', err)
+        self.assertEqual(['01-fix-build.patch', '02-feature.patch'],
+            sorted(os.listdir('series')))
+        # feature is diffed against fix/build, below the empty thread.
+        with open('series/02-feature.patch') as f:
+            patch = f.read()
+        self.assertContainsRe(patch, "=== added file 'feature'")
+        self.assertNotContainsRe(patch, "file 'file'")
+
+    def test_export_patches_mbox(self):
+        self.get_loom_with_patches()
+        out, err = self.run_bzr(['export-patches', '--mbox', 'series.mbox'])
+        with open('series.mbox', 'rb') as f:
+            content = f.read()
+        self.assertContainsRe(content,
+            b'(?m)^Subject: \\[PATCH 1/2\\] fix/build\n'
+            b'(.|\n)*^Fix the build.\n---\n'
+            b"=== modified file 'file'\n")
+        self.assertContainsRe(content,
+            b"(?m)^Subject: \\[PATCH 2/2\\] feature\n"
+            b"(.|\n)*^=== added file 'feature'\n")
+        self.assertEqual(2, content.count(b'\nFrom loom-export ') +
+            content.startswith(b'From loom-export '))
+
+    def test_export_patches_on_non_loomed_branch(self):
+        self.assert_exception_raised_on_non_loom_branch(
+            ['export-patches', 'series'])
+
+
+class TestImportSeries(TestsWithLooms):
+
+    def get_loom_and_series(self):
+        tree = self.get_vendor_loom()
+        self.build_tree_contents([('file', b'one\ntwo\n'), ('old', b'old\n')])
+        tree.add(['file', 'old'])
+        tree.commit('vendor files')
+        self.build_tree_contents([
+            ('patches/',),
+            ('patches/series', b'modify.patch\nadd-and-remove.patch\n'),
+            ('patches/modify.patch', b'Change two.\n\n'
+                b'--- a/file\n+++ b/file\n@@ -1,2 +1,2 @@\n one\n-two\n+2\n'),
+            ('patches/add-and-remove.patch',
+                b'--- /dev/null\n+++ b/dir/new\n@@ -0,0 +1,1 @@\n+new\n'
+                b'--- a/old\n+++ /dev/null\n@@ -1,1 +0,0 @@\n-old\n'),
+            ])
+        return tree
+
+    def test_import_series(self):
+        tree = self.get_loom_and_series()
+        out, err = self.run_bzr(['import-series', 'patches/series'])
+        self.assertEqual('Imported 2 patches.\n', err)
+        loom = _mod_branch.Branch.open('.')
+        self.addCleanup(loom.lock_read().unlock)
+        threads = loom.get_loom_state().get_threads()
+        self.assertEqual(['vendor', 'modify', 'add-and-remove'],
+            [thread[0] for thread in threads])
+        self.assertEqual('vendor', loom.nick)
+        modify = loom.repository.revision_tree(threads[1][1])
+        self.assertEqual(b'one\n2\n', modify.get_file_text('file'))
+        self.assertEqual('Change two.',
+            loom.repository.get_revision(threads[1][1]).message)
+        add_and_remove = loom.repository.revision_tree(threads[2][1])
+        self.assertEqual((threads[1][1],),
+            loom.repository.get_parent_map([threads[2][1]])[threads[2][1]])
+        self.assertEqual(b'one\n2\n', add_and_remove.get_file_text('file'))
+        self.assertEqual(b'new\n', add_and_remove.get_file_text('dir/new'))
+        self.assertFalse(add_and_remove.is_versioned('old'))
+
+    def test_import_series_rename(self):
+        tree = self.get_loom_and_series()
+        self.build_tree_contents([
+            ('patches/series', b'rename.patch\n'),
+            ('patches/rename.patch',
+                b'--- a/old\n+++ b/renamed\n@@ -1,1 +1,1 @@\n-old\n+new\n'),
+            ])
+        self.run_bzr(['import-series', 'patches/series'])
+        loom = _mod_branch.Branch.open('.')
+        self.addCleanup(loom.lock_read().unlock)
+        rename = loom.repository.revision_tree(
+            loom.get_loom_state().get_threads()[1][1])
+        self.assertEqual(b'new\n', rename.get_file_text('renamed'))
+        self.assertFalse(rename.is_versioned('old'))
+
+    def test_import_series_conflict(self):
+        tree = self.get_loom_and_series()
+        self.build_tree_contents([('patches/add-and-remove.patch',
+            b'--- a/file\n+++ b/file\n@@ -1,1 +1,1 @@\n-three\n+3\n')])
+        out, err = self.run_bzr(['import-series', 'patches/series'],
+            retcode=3)
+        self.assertContainsRe(err, 'Patch add-and-remove.patch does not apply')
+        self.assertEqual(1, len(tree.branch.get_loom_state().get_threads()))
+
+
+class TestLoomTime(TestsWithLooms):
+
+    def setUp(self):
+        super(TestLoomTime, self).setUp()
+        from breezy.commands import Command
+        from breezy.plugins.loom import log_loom_timings
+        Command.hooks.install_named_hook('post_command', log_loom_timings,
+            'loom timings')
+
+    def test_loomtime_logs_profile(self):
+        """-Dloomtime writes a summary of the loom timings to the log."""
+        self.overrideAttr(debug, 'debug_flags', set())
+        tree = self.get_vendor_loom()
+        self.run_bzr(['create-thread', 'patch'])
+        self.run_bzr(['-Dloomtime', 'down-thread'])
+        log = self.get_log()
+        self.assertContainsRe(log, 'loom timings for down-thread:')
+        self.assertContainsRe(log, r'\ntree\.down_thread +1 ')
+        self.assertContainsRe(log, r'\nlast-loom\.read +\d+\n')
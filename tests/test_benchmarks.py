@@ -0,0 +1,47 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+# 
+
+
+
+"""Tests of the loom benchmarks."""
+
+
+from breezy.plugins.loom import benchmarks
+from breezy.plugins.loom.tests import TestCaseWithLoom
+
+
+class TestBenchmarks(TestCaseWithLoom):
+
+    def test_make_loom(self):
+        shape = benchmarks.LoomShape(threads=3, commits=2, parents=2, files=4)
+        tree = benchmarks.make_loom('loom', shape)
+        loom = tree.branch
+        self.assertEqual(['thread-0', 'thread-1', 'thread-2'],
+            [thread[0] for thread in loom.get_loom_state().get_threads()])
+        self.assertEqual('thread-2', loom.nick)
+        self.assertEqual(2, len(list(loom.iter_loom_history())))
+
+    def test_run_benchmarks(self):
+        shape = benchmarks.LoomShape(threads=2, commits=1, parents=1, files=1)
+        names = [benchmark.name for benchmark in benchmarks.BENCHMARKS]
+        result = benchmarks.run_benchmarks(shape, repeat=1,
+            scratch_dir=self.test_dir)
+        self.assertEqual(shape.as_dict(), result['shape'])
+        self.assertEqual(sorted(names), sorted(result['results']))
+        for timings in result['results'].values():
+            self.assertEqual(1, len(timings['runs']))
+            self.assertEqual(timings['runs'][0], timings['min'])
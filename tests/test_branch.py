@@ -23,9 +23,15 @@ import breezy
 from breezy.branch import Branch
 from breezy.commit import PointlessCommit
 import breezy.errors as errors
+from breezy.plugins.loom import (
+    loom_index,
+    loom_state,
+    timing,
+    )
 from breezy.plugins.loom.branch import (
     AlreadyLoom,
     EMPTY_REVISION,
+    LoomStateChanged,
     loomify,
     require_loom_branch,
     NotALoom,
@@ -260,6 +266,112 @@ class TestLoom(TestCaseWithLoom):
         finally:
             tree.unlock()
 
+    def count_loom_state_reads(self):
+        reads = []
+        timing.hooks.install_named_hook('count',
+            lambda name, amount: reads.append(name == 'last-loom.read'),
+            'test')
+        return lambda: reads.count(True)
+
+    def test_unlock_without_changes_reads_no_state(self):
+        tree = self.get_tree_with_one_commit()
+        tree.branch.new_thread('baseline')
+        tree.branch._set_nick('baseline')
+        branch = Branch.open('.')
+        reads = self.count_loom_state_reads()
+        branch.lock_write()
+        branch.unlock()
+        self.assertEqual(0, reads())
+
+    def test_unlock_records_changed_tip(self):
+        tree = self.get_tree_with_one_commit()
+        tree.branch.new_thread('baseline')
+        tree.branch._set_nick('baseline')
+        revision = tree.commit('change something', allow_pointless=True)
+        self.assertEqual([('baseline', revision, [])],
+            tree.branch.get_loom_state().get_threads())
+        # The record itself is not a change that needs checking again.
+        reads = self.count_loom_state_reads()
+        tree.branch.lock_write()
+        tree.branch.unlock()
+        self.assertEqual(0, reads())
+
+    def test_unlock_records_generated_history(self):
+        # Format 1 looms change the tip through _set_revision_history.
+        self.make_branch_and_tree('.', format='knit')
+        tree = WorkingTree.open('.')
+        loomify(tree.branch)
+        tree = tree.controldir.open_workingtree()
+        self.assertIsInstance(tree.branch,
+            breezy.plugins.loom.branch.LoomBranch)
+        first = tree.commit('first')
+        tree.branch.new_thread('baseline')
+        tree.branch._set_nick('baseline')
+        tree.commit('second')
+        tree.branch.lock_write()
+        try:
+            tree.branch.generate_revision_history(first)
+        finally:
+            tree.branch.unlock()
+        self.assertEqual([('baseline', first, [])],
+            tree.branch.get_loom_state().get_threads())
+
+    def test_get_loom_snapshot(self):
+        tree = self.get_tree_with_one_commit()
+        tree.branch.new_thread('baseline')
+        tree.branch._set_nick('baseline')
+        snapshot = tree.branch.get_loom_snapshot()
+        self.assertIsInstance(snapshot, loom_state.FrozenLoomState)
+        self.assertIs(snapshot, Branch.open('.').get_loom_snapshot())
+        tree.branch.new_thread('other', 'baseline')
+        self.assertEqual(['baseline', 'other'],
+            [thread[0] for thread in
+             tree.branch.get_loom_snapshot().get_threads()])
+
+    def test_set_loom_state_if_unchanged(self):
+        tree = self.get_tree_with_one_commit()
+        tree.branch.new_thread('baseline')
+        tree.branch._set_nick('baseline')
+        state, key = tree.branch.get_loom_state_and_key()
+        state.set_threads(state.get_threads() + [
+            ('other', tree.last_revision(), [])])
+        new_key = tree.branch.set_loom_state_if_unchanged(state, key)
+        self.assertEqual(new_key, tree.branch.get_loom_state_and_key()[1])
+        self.assertEqual(['baseline', 'other'],
+            [thread[0] for thread in tree.branch.get_loom_state().get_threads()])
+        # key is out of date now.
+        self.assertRaises(LoomStateChanged,
+            tree.branch.set_loom_state_if_unchanged, state, key)
+
+    def test_update_loom_state_retries(self):
+        tree = self.get_tree_with_one_commit()
+        tree.branch.new_thread('baseline')
+        tree.branch._set_nick('baseline')
+        other_branch = Branch.open('.')
+        calls = []
+        def update(state):
+            calls.append(len(state.get_threads()))
+            if len(calls) == 1:
+                # Another writer gets in first.
+                other_branch.new_thread('other', 'baseline')
+            state.set_threads(state.get_threads() + [
+                ('mine', tree.last_revision(), [])])
+        tree.branch.update_loom_state(update)
+        self.assertEqual([1, 2], calls)
+        self.assertEqual(['baseline', 'other', 'mine'],
+            [thread[0] for thread in tree.branch.get_loom_state().get_threads()])
+
+    def test_update_loom_state_gives_up(self):
+        tree = self.get_tree_with_one_commit()
+        tree.branch.new_thread('baseline')
+        tree.branch._set_nick('baseline')
+        other_branch = Branch.open('.')
+        def update(state):
+            other_branch.new_thread('other-%d' % len(state.get_threads()))
+        self.assertRaises(LoomStateChanged, tree.branch.update_loom_state,
+            update, retries=2)
+        self.assertEqual(4, len(tree.branch.get_loom_state().get_threads()))
+
     def test_clone_empty_loom(self):
         source_tree = self.get_tree_with_loom('source')
         source_tree.branch._set_nick('source')
@@ -623,6 +735,106 @@ class TestLoom(TestCaseWithLoom):
         tree.branch.record_loom('foo')
         self.assertEqual([], tree.branch.get_threads(NULL_REVISION))
 
+    def test_record_loom_adds_to_index(self):
+        tree = self.get_tree_with_loom()
+        tree.branch.new_thread('foo')
+        tree.branch._set_nick('foo')
+        rev_id = tree.branch.record_loom('foo')
+        index = loom_index.LoomIndex(
+            tree.branch._transport)
+        self.assertEqual(([], [('foo', EMPTY_REVISION)]), index.get(rev_id))
+
+    def test_get_threads_uses_index(self):
+        tree = self.get_tree_with_loom()
+        tree.branch.new_thread('foo')
+        tree.branch._set_nick('foo')
+        rev_id = tree.branch.record_loom('foo')
+        branch = Branch.open('.')
+        # Loom revisions are immutable, so an indexed entry is trusted rather
+        # than read from the repository.
+        branch._get_loom_index().get(rev_id)[1][:] = [('bar', b'bar-id')]
+        self.assertEqual([('bar', b'bar-id')], branch.get_threads(rev_id))
+
+    def test_get_threads_indexes_unindexed_loom(self):
+        tree = self.get_tree_with_loom()
+        tree.branch.new_thread('foo')
+        tree.branch._set_nick('foo')
+        rev_id = tree.branch.record_loom('foo')
+        tree.branch._transport.delete('loom-index')
+        branch = Branch.open('.')
+        with branch.lock_read():
+            self.assertEqual([('foo', EMPTY_REVISION)],
+                branch.get_threads(rev_id))
+        # Readers keep the entry in memory only.
+        self.assertFalse(branch._transport.has('loom-index'))
+        self.assertEqual(([], [('foo', EMPTY_REVISION)]),
+            branch._get_loom_index().get(rev_id))
+        branch = Branch.open('.')
+        with branch.lock_write():
+            self.assertEqual([('foo', EMPTY_REVISION)],
+                branch.get_threads(rev_id))
+        index = loom_index.LoomIndex(branch._transport)
+        self.assertEqual(([], [('foo', EMPTY_REVISION)]), index.get(rev_id))
+
+    def test_get_loom_revision_id(self):
+        tree = self.get_tree_with_loom()
+        tree.branch.new_thread('foo')
+        tree.branch._set_nick('foo')
+        first = tree.branch.record_loom('first')
+        tree.branch.new_thread('bar')
+        second = tree.branch.record_loom('second')
+        self.assertEqual([second, first],
+            list(tree.branch.iter_loom_history()))
+        self.assertEqual(second, tree.branch.get_loom_revision_id(-1))
+        self.assertEqual(first, tree.branch.get_loom_revision_id(-2))
+        self.assertEqual(first, tree.branch.get_loom_revision_id(1))
+        self.assertEqual(second, tree.branch.get_loom_revision_id(2))
+        self.assertRaises(errors.InvalidRevisionNumber,
+            tree.branch.get_loom_revision_id, 3)
+        self.assertRaises(errors.InvalidRevisionNumber,
+            tree.branch.get_loom_revision_id, -3)
+        self.assertRaises(errors.InvalidRevisionNumber,
+            tree.branch.get_loom_revision_id, 0)
+
+    def test_iter_loom_history_indexes_looms(self):
+        tree = self.get_tree_with_loom()
+        tree.branch.new_thread('foo')
+        tree.branch._set_nick('foo')
+        first = tree.branch.record_loom('first')
+        tree.branch.new_thread('bar')
+        second = tree.branch.record_loom('second')
+        tree.branch._transport.delete('loom-index')
+        branch = Branch.open('.')
+        with branch.lock_read():
+            self.assertEqual([second, first],
+                list(branch.iter_loom_history()))
+        self.assertFalse(branch._transport.has('loom-index'))
+        branch = Branch.open('.')
+        self.addCleanup(branch.lock_write().unlock)
+        # The loom texts are found without building revision trees.
+        branch.repository.revision_trees = None
+        self.assertEqual([second, first], list(branch.iter_loom_history()))
+        index = loom_index.LoomIndex(branch._transport)
+        self.assertEqual(([], [('foo', EMPTY_REVISION)]), index.get(first))
+        self.assertEqual(([first],
+            [('foo', EMPTY_REVISION), ('bar', EMPTY_REVISION)]),
+            index.get(second))
+
+    def test_loom_text_keys_of_carried_over_texts(self):
+        tree = self.get_tree_with_loom()
+        tree.branch.new_thread('foo')
+        tree.branch._set_nick('foo')
+        first = tree.branch.record_loom('first')
+        branch = Branch.open('.')
+        self.addCleanup(branch.lock_read().unlock)
+        self.assertEqual([(b'loom_meta_tree', first)],
+            branch._loom_text_keys([first]))
+        # A loom whose text is not keyed by its own revision, as after a
+        # merge, has its key read from its inventory.
+        branch.repository.texts.get_parent_map = lambda keys: {}
+        self.assertEqual([(b'loom_meta_tree', first)],
+            branch._loom_text_keys([first]))
+
     def get_multi_threaded(self):
         tree = self.get_tree_with_loom()
         tree.branch.new_thread('thread1')
@@ -0,0 +1,57 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+# 
+
+"""Tests of what importing the loom plugin loads."""
+
+
+import os
+import subprocess
+import sys
+
+import breezy.plugins.loom
+from breezy.tests import TestCase
+
+
+# Import the plugin in a fresh interpreter, under its usual name whatever
+# directory it was loaded from, and list the modules that it loaded.
+_LIST_MODULES = """
+import importlib.util
+import sys
+import breezy.plugins
+spec = importlib.util.spec_from_file_location('breezy.plugins.loom',
+    sys.argv[1], submodule_search_locations=[sys.argv[2]])
+module = importlib.util.module_from_spec(spec)
+sys.modules['breezy.plugins.loom'] = module
+spec.loader.exec_module(module)
+for name in sorted(sys.modules):
+    print(name)
+"""
+
+
+class TestImport(TestCase):
+
+    def test_import_is_lazy(self):
+        plugin_file = breezy.plugins.loom.__file__
+        output = subprocess.check_output([sys.executable, '-c',
+            _LIST_MODULES, plugin_file, os.path.dirname(plugin_file)])
+        modules = output.decode('ascii').split()
+        self.assertIn('breezy.plugins.loom', modules)
+        # Only the version check is needed before a loom command is run.
+        self.assertEqual(['breezy.plugins.loom.version'],
+            [name for name in modules
+             if name.startswith('breezy.plugins.loom.')])
+        self.assertNotIn('breezy.builtins', modules)
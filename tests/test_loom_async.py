@@ -0,0 +1,135 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+# 
+
+"""Tests of the asyncio loom API."""
+
+
+import asyncio
+import threading
+import time
+
+from breezy.branch import Branch
+
+from breezy.plugins.loom import (
+    NotALoom,
+    loom_async,
+    )
+from breezy.plugins.loom.tests import TestCaseWithLoom
+
+
+class TestLoomExecutor(TestCaseWithLoom):
+
+    def setUp(self):
+        super(TestLoomExecutor, self).setUp()
+        self.tree = self.get_tree_with_loom('loom')
+        self.tree.branch.new_thread('bottom')
+        self.tree.branch._set_nick('bottom')
+        self.bottom = self.tree.commit('bottom')
+        self.tree.branch.new_thread('top', 'bottom')
+        self.tree.branch._set_nick('top')
+        self.top = self.tree.commit('top')
+
+    def run_with_executor(self, operation, max_workers=4):
+        async def main():
+            async with loom_async.LoomExecutor(max_workers) as looms:
+                return await operation(looms)
+        return asyncio.run(main())
+
+    def test_get_loom_state(self):
+        state = self.run_with_executor(
+            lambda looms: looms.get_loom_state('loom'))
+        self.assertEqual(self.tree.branch.get_loom_state().get_threads(),
+            state.get_threads())
+
+    def test_get_loom_snapshot(self):
+        snapshot = self.run_with_executor(
+            lambda looms: looms.get_loom_snapshot('loom'))
+        self.assertIs(snapshot, self.tree.branch.get_loom_snapshot())
+
+    def test_get_threads(self):
+        threads = self.run_with_executor(
+            lambda looms: looms.get_threads('loom'))
+        self.assertEqual([('bottom', self.bottom, []), ('top', self.top, [])],
+            threads)
+
+    def test_get_recorded_threads(self):
+        self.tree.branch.record_loom('recorded')
+        rev_id = self.tree.branch.get_loom_state().get_basis_revision_id()
+        threads = self.run_with_executor(
+            lambda looms: looms.get_recorded_threads('loom', rev_id))
+        self.assertEqual([('bottom', self.bottom), ('top', self.top)],
+            threads)
+
+    def test_many_looms_at_once(self):
+        async def states(looms):
+            return await asyncio.gather(
+                *[looms.get_threads('loom') for i in range(10)])
+        results = self.run_with_executor(states)
+        self.assertEqual(10, len(results))
+        self.assertEqual(['bottom', 'top'],
+            [thread[0] for thread in results[-1]])
+
+    def test_not_a_loom(self):
+        self.make_branch('plain')
+        self.assertRaises(NotALoom, self.run_with_executor,
+            lambda looms: looms.get_loom_state('plain'))
+
+    def test_export_threads(self):
+        self.run_with_executor(
+            lambda looms: looms.export_threads('loom', self.get_url('out')))
+        self.assertEqual(self.bottom,
+            Branch.open('out/bottom').last_revision())
+        self.assertEqual(self.top, Branch.open('out/top').last_revision())
+
+    def test_push_and_pull(self):
+        self.tree.branch.record_loom('recorded')
+        self.get_tree_with_loom('pushed-loom')
+        self.run_with_executor(
+            lambda looms: looms.push('loom', 'pushed-loom', overwrite=True))
+        self.assertEqual(
+            [thread[:2] for thread in
+             self.tree.branch.get_loom_state().get_threads()],
+            [thread[:2] for thread in
+             Branch.open('pushed-loom').get_loom_state().get_threads()])
+        self.get_tree_with_loom('pulled-loom')
+        self.run_with_executor(
+            lambda looms: looms.pull('pulled-loom', 'loom', overwrite=True))
+        self.assertEqual(
+            [thread[:2] for thread in
+             self.tree.branch.get_loom_state().get_threads()],
+            [thread[:2] for thread in
+             Branch.open('pulled-loom').get_loom_state().get_threads()])
+
+
+class TestBoundedConcurrency(TestCaseWithLoom):
+
+    def test_max_workers(self):
+        lock = threading.Lock()
+        running = [0]
+        most = [0]
+        def work():
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+        async def main():
+            async with loom_async.LoomExecutor(max_workers=2) as looms:
+                await asyncio.gather(*[looms._run(work) for i in range(8)])
+        asyncio.run(main())
+        self.assertEqual(2, most[0])
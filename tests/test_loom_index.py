@@ -0,0 +1,100 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2008 Canonical Limited.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+# 
+
+
+
+"""Tests of the loom revision index."""
+
+
+from breezy import osutils
+import breezy.plugins.loom.loom_index as loom_index
+from breezy.tests import TestCaseWithMemoryTransport
+
+
+class TestLoomIndex(TestCaseWithMemoryTransport):
+
+    def test_missing_index(self):
+        index = loom_index.LoomIndex(self.get_transport())
+        self.assertEqual(None, index.get(b'loom-1'))
+
+    def test_round_trip(self):
+        transport = self.get_transport()
+        index = loom_index.LoomIndex(transport)
+        index.add(b'loom-1', [], [(u'base', b'rev-1')])
+        index.save()
+        index.add(b'loom-2', [b'loom-1', b'other'],
+            [(u'base', b'rev-1'), (u'name with spaces \xe9', b'empty:')])
+        index.save()
+        entry_1 = b'loom-1\n rev-1 base\n'
+        entry_2 = (b'loom-2 loom-1 other\n'
+            b' rev-1 base\n'
+            b' empty: name with spaces \xc3\xa9\n')
+        self.assertEqual(
+            b'Loom index 2\n'
+            + entry_1 + b'= %s\n' % osutils.sha_string(entry_1)
+            + entry_2 + b'= %s\n' % osutils.sha_string(entry_2),
+            transport.get_bytes('loom-index'))
+        index = loom_index.LoomIndex(transport)
+        self.assertEqual(([], [(u'base', b'rev-1')]), index.get(b'loom-1'))
+        self.assertEqual(([b'loom-1', b'other'],
+            [(u'base', b'rev-1'), (u'name with spaces \xe9', b'empty:')]),
+            index.get(b'loom-2'))
+
+    def test_replaces_unrecognised_index(self):
+        transport = self.get_transport()
+        transport.put_bytes('loom-index', b'Loom index 0\nloom-1\n')
+        index = loom_index.LoomIndex(transport)
+        self.assertEqual(None, index.get(b'loom-1'))
+        index.add(b'loom-2', [], [])
+        index.save()
+        self.assertEqual(b'Loom index 2\nloom-2\n= %s\n'
+            % osutils.sha_string(b'loom-2\n'),
+            transport.get_bytes('loom-index'))
+
+    def test_ignores_torn_entries(self):
+        transport = self.get_transport()
+        index = loom_index.LoomIndex(transport)
+        index.add(b'loom-1', [], [(u'base', b'rev-1')])
+        index.add(b'loom-2', [b'loom-1'],
+            [(u'base', b'rev-1'), (u'top', b'rev-2')])
+        index.save()
+        content = transport.get_bytes('loom-index')
+        # The append of loom-2 stopped part way through its threads.
+        torn = content[:content.index(b' rev-2') + 3]
+        transport.put_bytes('loom-index', torn)
+        index = loom_index.LoomIndex(transport)
+        self.assertEqual(([], [(u'base', b'rev-1')]), index.get(b'loom-1'))
+        self.assertEqual(None, index.get(b'loom-2'))
+        # Entries appended after the torn one are read back.
+        index.add(b'loom-2', [b'loom-1'],
+            [(u'base', b'rev-1'), (u'top', b'rev-2')])
+        index.save()
+        index = loom_index.LoomIndex(transport)
+        self.assertEqual(([b'loom-1'],
+            [(u'base', b'rev-1'), (u'top', b'rev-2')]), index.get(b'loom-2'))
+
+    def test_ignores_entries_without_checksum(self):
+        transport = self.get_transport()
+        index = loom_index.LoomIndex(transport)
+        index.add(b'loom-1', [], [(u'base', b'rev-1'), (u'top', b'rev-2')])
+        index.save()
+        content = transport.get_bytes('loom-index')
+        # Losing a whole thread line leaves an entry that does not match
+        # its checksum.
+        transport.put_bytes('loom-index', content.replace(b' rev-2 top\n',
+            b''))
+        self.assertEqual(None, loom_index.LoomIndex(transport).get(b'loom-1'))
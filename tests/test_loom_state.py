@@ -26,6 +26,7 @@ import breezy.errors as errors
 import breezy.osutils
 import breezy.plugins.loom.loom_io as loom_io
 import breezy.plugins.loom.loom_state as loom_state
+from breezy.plugins.loom.branch import NoSuchThread
 from breezy.plugins.loom.tree import LoomTreeDecorator
 from breezy.revision import NULL_REVISION
 from breezy.tests import TestCase
@@ -119,6 +120,15 @@ class TestLoomState(TestCase):
         state = self.get_sample_state()
         self.assertEqual(0, state.thread_index('foo'))
         self.assertEqual(1, state.thread_index(u'g\xbe'))
+        state.set_threads([(u'g\xbe', b'bar', [])])
+        self.assertEqual(0, state.thread_index(u'g\xbe'))
+        self.assertRaises(NoSuchThread, state.thread_index, 'foo')
+
+    def test_get_thread_revision(self):
+        state = self.get_sample_state()
+        state.set_threads([('foo', b'bar', []), (u'g\xbe', b'baz', [])])
+        self.assertEqual(b'baz', state.get_thread_revision(u'g\xbe'))
+        self.assertRaises(NoSuchThread, state.get_thread_revision, 'qux')
 
     def test_new_thread_after_deleting(self):
         state = self.get_sample_state()
@@ -129,3 +139,57 @@ class TestLoomState(TestCase):
         state = loom_state.LoomState()
         state.set_threads([('foo', b'bar', [])])
         self.assertIs(None, state.get_new_thread_after_deleting('foo'))
+
+
+class TestFrozenLoomState(TestCase):
+
+    def get_frozen_state(self):
+        state = loom_state.LoomState()
+        state.set_parents([b'parent'])
+        state.set_threads([('foo', b'bar', [b'old-foo']),
+                           (u'g\xbe', b'baz', [None])])
+        return state, state.freeze()
+
+    def test_freeze(self):
+        state, frozen = self.get_frozen_state()
+        self.assertEqual(state.get_parents(), frozen.get_parents())
+        self.assertEqual(state.get_threads(), frozen.get_threads())
+        self.assertEqual(state.get_threads_dict(), frozen.get_threads_dict())
+        self.assertEqual(b'parent', frozen.get_basis_revision_id())
+        self.assertEqual(1, frozen.thread_index(u'g\xbe'))
+        self.assertEqual(b'bar', frozen.get_thread_revision('foo'))
+        self.assertRaises(NoSuchThread, frozen.thread_index, 'qux')
+        self.assertIs(frozen, frozen.freeze())
+
+    def test_cannot_change(self):
+        state, frozen = self.get_frozen_state()
+        self.assertRaises(TypeError, frozen.set_parents, [])
+        self.assertRaises(TypeError, frozen.set_threads, [])
+        frozen.get_parents().append(b'other')
+        frozen.get_threads()[0][2].append(b'other')
+        frozen.get_threads_dict()['foo'][1].append(b'other')
+        self.assertEqual(state.get_parents(), frozen.get_parents())
+        self.assertEqual(state.get_threads(), frozen.get_threads())
+
+    def test_independent_of_original(self):
+        state, frozen = self.get_frozen_state()
+        state.set_threads([])
+        state.set_parents([])
+        self.assertEqual([b'parent'], frozen.get_parents())
+        self.assertEqual(2, len(frozen.get_threads()))
+
+    def test_copy(self):
+        state, frozen = self.get_frozen_state()
+        copy = frozen.copy()
+        self.assertFalse(isinstance(copy, loom_state.FrozenLoomState))
+        self.assertEqual(state.get_threads(), copy.get_threads())
+        copy.set_threads([])
+        self.assertEqual(2, len(frozen.get_threads()))
+
+    def test_serialise(self):
+        state, frozen = self.get_frozen_state()
+        expected = BytesIO()
+        loom_io.LoomStateWriter(state).write(expected)
+        stream = BytesIO()
+        loom_io.LoomStateWriter(frozen).write(stream)
+        self.assertEqual(expected.getvalue(), stream.getvalue())
@@ -20,6 +20,7 @@
 
 
 import breezy.errors
+from breezy.plugins.loom import timing
 from breezy.plugins.loom.branch import NoLowerThread, NoSuchThread
 from breezy.plugins.loom.tests import TestCaseWithLoom
 import breezy.plugins.loom.tree
@@ -73,6 +74,49 @@ class TestThreadRevSpec(TestRevSpec):
         spec = RevisionSpec.from_string('thread:top')
         self.assertEqual(rev_id, spec.as_revision_id(tree.branch))
 
+    def test_thread_colon_name_at_loom_revno(self):
+        tree, loom_tree, _, old_top = self.get_two_thread_loom()
+        tree.branch.record_loom('first')
+        new_top = tree.commit('change top again')
+        tree.branch.record_loom('second')
+        self.assertEqual(new_top, RevisionSpec.from_string(
+            'thread:top').as_revision_id(tree.branch))
+        self.assertEqual(new_top, RevisionSpec.from_string(
+            'thread:top@-1').as_revision_id(tree.branch))
+        self.assertEqual(old_top, RevisionSpec.from_string(
+            'thread:top@-2').as_revision_id(tree.branch))
+        self.assertEqual(old_top, RevisionSpec.from_string(
+            'thread:top@1').as_revision_id(tree.branch))
+
+    def test_thread_colon_name_with_at(self):
+        tree, loom_tree, _, top = self.get_two_thread_loom()
+        tree.branch.new_thread('rel@2', 'top')
+        tree.branch._set_nick('rel@2')
+        release = tree.commit('release')
+        self.assertEqual(release, RevisionSpec.from_string(
+            'thread:rel@2').as_revision_id(tree.branch))
+        self.assertEqual(top, RevisionSpec.from_string(
+            'below:rel@2').as_revision_id(tree.branch))
+
+    def test_thread_colon_name_at_unrecorded_loom_errors(self):
+        tree, loom_tree, _, _ = self.get_two_thread_loom()
+        tree.branch.record_loom('first')
+        spec = RevisionSpec.from_string('thread:top@-2')
+        self.assertRaises(breezy.errors.InvalidRevisionNumber,
+            spec.as_revision_id, tree.branch)
+
+    def test_thread_colon_reads_state_once_under_lock(self):
+        tree, loom_tree, bottom, top = self.get_two_thread_loom()
+        reads = []
+        timing.hooks.install_named_hook('count',
+            lambda name, amount: reads.append(name), 'test')
+        with tree.branch.lock_read():
+            self.assertEqual(bottom, RevisionSpec.from_string(
+                'thread:bottom').as_revision_id(tree.branch))
+            self.assertEqual(top, RevisionSpec.from_string(
+                'thread:top').as_revision_id(tree.branch))
+        self.assertEqual(['last-loom.read'], reads)
+
     def test_thread_on_non_loom_gives_BzrError(self):
         tree = self.make_branch_and_tree('.')
         spec = RevisionSpec.from_string('thread:')
@@ -107,6 +151,16 @@ class TestBelowRevSpec(TestRevSpec):
         spec = RevisionSpec.from_string('below:top')
         self.assertEqual(expected_id, spec.as_revision_id(tree.branch))
 
+    def test_below_named_thread_at_loom_revno(self):
+        tree, loom_tree, _, _ = self.get_two_thread_loom()
+        tree.branch.record_loom('first')
+        loom_tree.down_thread()
+        old_bottom = tree.branch.last_revision()
+        tree.commit('change bottom again')
+        tree.branch.record_loom('second')
+        spec = RevisionSpec.from_string('below:top@-2')
+        self.assertEqual(old_bottom, spec.as_revision_id(tree.branch))
+
     def test_below_on_non_loom_gives_BzrError(self):
         tree = self.make_branch_and_tree('.')
         spec = RevisionSpec.from_string('below:')
@@ -0,0 +1,48 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+# 
+
+
+
+"""Tests of importing quilt patch series."""
+
+
+from breezy.plugins.loom import series
+from breezy.tests import TestCase
+
+
+class TestSeries(TestCase):
+
+    def test_read_series(self):
+        self.assertEqual(
+            [('first.patch', 1), ('second.diff', 0), ('third', 1)],
+            series.read_series(b'# a comment\n'
+                b'first.patch\n'
+                b'\n'
+                b'second.diff -p0\n'
+                b'third # trailing comment\n'))
+
+    def test_thread_name_for_patch(self):
+        self.assertEqual('fix', series.thread_name_for_patch('fix.patch'))
+        self.assertEqual('fix', series.thread_name_for_patch('fix.diff'))
+        self.assertEqual('fix', series.thread_name_for_patch('fix'))
+
+    def test_patch_message(self):
+        self.assertEqual('Fix the build.\n\nIn detail.',
+            series.patch_message('fix.patch',
+                b'\nFix the build.\n\nIn detail.\n\n--- a/file\n+++ b/file\n'))
+        self.assertEqual('Import fix.patch.',
+            series.patch_message('fix.patch', b'--- a/file\n+++ b/file\n'))
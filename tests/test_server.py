@@ -0,0 +1,133 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+# 
+
+"""Tests of the loom query server."""
+
+
+import os
+import socket
+import threading
+
+from breezy.branch import Branch
+
+from breezy.plugins.loom import (
+    loom_client,
+    server,
+    )
+from breezy.plugins.loom.tests import TestCaseWithLoom
+
+
+class TestLoomServer(TestCaseWithLoom):
+
+    def setUp(self):
+        super(TestLoomServer, self).setUp()
+        tree = self.get_tree_with_loom('loom')
+        tree.branch.new_thread('bottom')
+        tree.branch._set_nick('bottom')
+        self.bottom = tree.commit('bottom')
+        tree.branch.new_thread('top', 'bottom')
+        tree.branch._set_nick('top')
+        self.top = tree.commit('top')
+        # Unix socket paths are short, so use one relative to the test
+        # directory.
+        self.server = server.LoomServer('loom.sock')
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        def stop():
+            self.server.shutdown()
+            thread.join()
+            self.server.close()
+        self.addCleanup(stop)
+
+    def query(self, name, **kwargs):
+        kwargs.update(query=name, branch='loom')
+        return loom_client.query('loom.sock', kwargs)
+
+    def test_show_loom(self):
+        result = self.query('show-loom')
+        self.assertEqual('top', result['current'])
+        self.assertEqual([], result['parents'])
+        self.assertEqual(
+            [('bottom', self.bottom.decode('utf-8'), False),
+             ('top', self.top.decode('utf-8'), True)],
+            [(thread['name'], thread['revision'], thread['current'])
+             for thread in result['threads']])
+
+    def test_current_thread(self):
+        self.assertEqual('top', self.query('current-thread'))
+
+    def test_revision_id(self):
+        self.assertEqual(self.bottom.decode('utf-8'),
+            self.query('revision-id', spec='thread:'))
+        self.assertEqual(self.top.decode('utf-8'),
+            self.query('revision-id', spec='thread:top'))
+
+    def test_errors(self):
+        self.assertRaises(loom_client.QueryError, self.query, 'revision-id',
+            spec='thread:missing')
+        self.assertRaises(loom_client.QueryError, self.query, 'no-such-query')
+        # The server cannot tell what a relative path is relative to.
+        self.assertRaises(ValueError, self.server.answer,
+            {'query': 'current-thread', 'branch': 'loom'})
+        # The server keeps answering.
+        self.assertEqual('top', self.query('current-thread'))
+
+    def test_sees_changes(self):
+        self.assertEqual(2, len(self.query('show-loom')['threads']))
+        branch = Branch.open('loom')
+        branch.new_thread('middle', 'bottom')
+        self.assertEqual(['bottom', 'middle', 'top'],
+            [thread['name'] for thread in self.query('show-loom')['threads']])
+
+    def test_sees_new_revisions_in_repository(self):
+        self.assertEqual('top', self.query('current-thread'))
+        # Committing to the repository without moving the branch only
+        # changes the repository's pack list.
+        branch = Branch.open('loom')
+        with branch.lock_write():
+            builder = branch.get_commit_builder([self.top])
+            list(builder.record_iter_changes(
+                branch.repository.revision_tree(self.top), self.top, []))
+            builder.finish_inventory()
+            new = builder.commit('unreferenced')
+        self.assertEqual(self.top.decode('utf-8'), self.query('revision-id',
+            spec='before:revid:%s' % new.decode('utf-8')))
+
+    def test_open_branches_are_bounded(self):
+        self.overrideAttr(server, '_MAX_OPEN_LOOMS', 1)
+        self.get_tree_with_loom('other')
+        self.assertEqual('top', self.query('current-thread'))
+        first = self.server._looms[os.path.abspath('loom')].branch
+        self.assertEqual('other', loom_client.query('loom.sock',
+            {'query': 'current-thread', 'branch': 'other'}))
+        self.assertEqual([os.path.abspath('other')],
+            list(self.server._looms))
+        self.assertFalse(first.is_locked())
+
+    def test_already_running(self):
+        self.assertRaises(server.ServerAlreadyRunning, server.LoomServer,
+            'loom.sock')
+
+
+class TestStaleSocket(TestCaseWithLoom):
+
+    def test_stale_socket_is_replaced(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind('loom.sock')
+        stale.close()
+        loom_server = server.LoomServer('loom.sock')
+        loom_server.close()
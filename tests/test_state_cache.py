@@ -0,0 +1,127 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+# 
+
+"""Tests of the process wide loom state cache."""
+
+
+import os
+import threading
+
+from breezy.branch import Branch
+from breezy.tests import TestCase
+
+from breezy.plugins.loom import (
+    loom_state,
+    state_cache,
+    timing,
+    )
+from breezy.plugins.loom.tests import TestCaseWithLoom
+
+
+class TestReadWriteLock(TestCase):
+
+    def test_readers_share(self):
+        lock = state_cache.ReadWriteLock()
+        inside = threading.Barrier(2, timeout=10)
+        def reader():
+            with lock.read():
+                inside.wait()
+        thread = threading.Thread(target=reader)
+        thread.start()
+        # Both readers hold the lock at once, or the barrier times out.
+        with lock.read():
+            inside.wait()
+        thread.join()
+
+    def test_writer_excludes_readers(self):
+        lock = state_cache.ReadWriteLock()
+        events = []
+        writing = threading.Event()
+        def reader():
+            writing.wait()
+            with lock.read():
+                events.append('read')
+        thread = threading.Thread(target=reader)
+        thread.start()
+        with lock.write():
+            writing.set()
+            # Give the reader a chance to get in, which it must not.
+            thread.join(0.05)
+            events.append('written')
+        thread.join()
+        self.assertEqual(['written', 'read'], events)
+
+
+class TestLoomStateCache(TestCaseWithLoom):
+
+    def setUp(self):
+        super(TestLoomStateCache, self).setUp()
+        tree = self.get_tree_with_loom('loom')
+        tree.branch.new_thread('bottom')
+        tree.branch._set_nick('bottom')
+        self.bottom = tree.commit('bottom')
+        self.branch = tree.branch
+        self.cache = state_cache.LoomStateCache()
+        self.reads = []
+        timing.hooks.install_named_hook('count',
+            lambda name, amount: self.reads.append(name == 'last-loom.read'),
+            'test')
+
+    def test_get(self):
+        state, key = self.cache.get(self.branch)
+        self.assertIsInstance(state, loom_state.FrozenLoomState)
+        self.assertEqual([('bottom', self.bottom, [])], state.get_threads())
+        self.assertEqual(self.branch.get_loom_state_and_key()[1], key)
+
+    def test_shared_between_branch_objects(self):
+        state = self.cache.get(self.branch)[0]
+        del self.reads[:]
+        self.assertIs(state, self.cache.get(Branch.open('loom'))[0])
+        self.assertEqual(0, self.reads.count(True))
+
+    def test_sees_changes(self):
+        self.cache.get(self.branch)
+        Branch.open('loom').new_thread('top', 'bottom')
+        self.assertEqual(['bottom', 'top'],
+            [thread[0] for thread in
+             self.cache.get(self.branch)[0].get_threads()])
+
+    def test_touch_keeps_state(self):
+        state = self.cache.get(self.branch)[0]
+        path = self.branch._transport.local_abspath('last-loom')
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        del self.reads[:]
+        self.assertIs(state, self.cache.get(self.branch)[0])
+        self.assertEqual(1, self.reads.count(True))
+
+    def test_invalidate(self):
+        state = self.cache.get(self.branch)[0]
+        self.cache.invalidate(self.branch)
+        self.assertIsNot(state, self.cache.get(self.branch)[0])
+
+    def test_threads_share_state(self):
+        results = []
+        def read():
+            results.append(self.cache.get(Branch.open('loom'))[0])
+        threads = [threading.Thread(target=read) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(8, len(results))
+        self.assertEqual(1, len(set(map(id, results))))
@@ -0,0 +1,314 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+# 
+
+
+
+"""Tests of the loom statistics routines."""
+
+
+from breezy.plugins.loom import stats
+from breezy.plugins.loom.branch import EMPTY_REVISION
+from breezy.plugins.loom.tests import TestCaseWithLoom
+from breezy.revision import NULL_REVISION
+
+
+class TestThreadRevisionCounts(TestCaseWithLoom):
+
+    def test_counts(self):
+        builder = self.make_branch_builder('.')
+        builder.build_snapshot(None, [('add', ('', None, 'directory', ''))],
+            revision_id=b'bottom-1')
+        builder.build_snapshot([b'bottom-1'], [], revision_id=b'bottom-2')
+        builder.build_snapshot([b'bottom-2'], [], revision_id=b'middle-1')
+        builder.build_snapshot([b'bottom-2'], [], revision_id=b'top-1')
+        builder.build_snapshot([b'top-1'], [], revision_id=b'top-2')
+        builder.build_snapshot([b'top-2', b'middle-1'], [],
+            revision_id=b'top-3')
+        branch = builder.get_branch()
+        self.addCleanup(branch.lock_read().unlock)
+        graph = branch.repository.get_graph()
+        self.assertEqual([None, 1, 3],
+            stats.thread_revision_counts(graph,
+                [b'bottom-2', b'middle-1', b'top-3']))
+
+    def test_stops_at_common_ancestors(self):
+        builder = self.make_branch_builder('.')
+        builder.build_snapshot(None, [('add', ('', None, 'directory', ''))],
+            revision_id=b'old-1')
+        for index in range(2, 21):
+            builder.build_snapshot([b'old-%d' % (index - 1)], [],
+                revision_id=b'old-%d' % index)
+        builder.build_snapshot([b'old-20'], [], revision_id=b'bottom-1')
+        builder.build_snapshot([b'old-20'], [], revision_id=b'top-1')
+        builder.build_snapshot([b'top-1', b'bottom-1'], [],
+            revision_id=b'top-2')
+        branch = builder.get_branch()
+        self.addCleanup(branch.lock_read().unlock)
+        asked = []
+        provider = branch.repository._make_parents_provider()
+        class RecordingProvider(object):
+            def get_parent_map(self, revisions):
+                revisions = list(revisions)
+                asked.extend(revisions)
+                return provider.get_parent_map(revisions)
+        graph = type(branch.repository.get_graph())(RecordingProvider())
+        self.assertEqual([None, 2, 0],
+            stats.thread_revision_counts(graph,
+                [b'bottom-1', b'top-2', b'top-2']))
+        # Only the history near where the threads meet is read.
+        self.assertTrue(b'old-20' in asked)
+        self.assertFalse(b'old-10' in asked)
+
+    def test_empty_threads(self):
+        tree = self.make_branch_and_tree('.')
+        rev = tree.commit('one')
+        self.addCleanup(tree.branch.lock_read().unlock)
+        graph = tree.branch.repository.get_graph()
+        self.assertEqual([None, 1, 0, 0],
+            stats.thread_revision_counts(graph,
+                [EMPTY_REVISION, rev, rev, NULL_REVISION]))
+
+
+class TestClassifyThreads(TestCaseWithLoom):
+
+    def test_classify(self):
+        builder = self.make_branch_builder('.')
+        builder.build_snapshot(None, [('add', ('', None, 'directory', ''))],
+            revision_id=b'base')
+        builder.build_snapshot([b'base'], [], revision_id=b'patch-a')
+        builder.build_snapshot([b'base'], [], revision_id=b'patch-b')
+        builder.build_snapshot([b'patch-a'], [], revision_id=b'patch-c')
+        builder.build_snapshot([b'base', b'patch-b'], [],
+            revision_id=b'upstream')
+        branch = builder.get_branch()
+        self.addCleanup(branch.lock_read().unlock)
+        graph = branch.repository.get_graph()
+        revisions = [b'patch-a', b'base', EMPTY_REVISION, b'patch-b',
+            b'patch-c']
+        self.assertEqual(
+            [stats.LIVE, stats.MERGED, stats.MERGED, stats.LIVE, stats.LIVE],
+            stats.classify_threads(graph, revisions))
+        self.assertEqual(
+            [stats.LIVE, stats.MERGED, stats.MERGED, stats.MERGED_UPSTREAM,
+             stats.LIVE],
+            stats.classify_threads(graph, revisions, b'upstream'))
+
+
+class TestThreadsNeedingUpThread(TestCaseWithLoom):
+
+    def test_needing_up_thread(self):
+        builder = self.make_branch_builder('.')
+        builder.build_snapshot(None, [('add', ('', None, 'directory', ''))],
+            revision_id=b'base')
+        builder.build_snapshot([b'base'], [], revision_id=b'base-2')
+        builder.build_snapshot([b'base'], [], revision_id=b'patch-a')
+        builder.build_snapshot([b'patch-a', b'base-2'], [],
+            revision_id=b'patch-b')
+        branch = builder.get_branch()
+        self.addCleanup(branch.lock_read().unlock)
+        graph = branch.repository.get_graph()
+        # patch-b contains patch-a, but the changes patch-a is missing
+        # still have to come up through it.
+        self.assertEqual([False, True, True, True],
+            stats.threads_needing_up_thread(graph,
+                [b'base-2', b'patch-a', b'patch-b', EMPTY_REVISION]))
+        self.assertEqual([False, False, False],
+            stats.threads_needing_up_thread(graph,
+                [b'base', b'patch-a', b'patch-b']))
+        self.assertEqual([False, False],
+            stats.threads_needing_up_thread(graph,
+                [EMPTY_REVISION, b'base']))
+
+    def test_known_pairs(self):
+        builder = self.make_branch_builder('.')
+        builder.build_snapshot(None, [('add', ('', None, 'directory', ''))],
+            revision_id=b'base')
+        builder.build_snapshot([b'base'], [], revision_id=b'patch-a')
+        branch = builder.get_branch()
+        self.addCleanup(branch.lock_read().unlock)
+        graph = branch.repository.get_graph()
+        contained = {}
+        self.assertEqual([False, False],
+            stats.threads_needing_up_thread(graph, [b'base', b'patch-a'],
+                contained))
+        self.assertEqual({(b'base', b'patch-a'): True}, contained)
+        # Known answers are used instead of the graph, and nothing above
+        # the first thread that is behind is looked up.
+        contained = {(b'base', b'patch-a'): False}
+        self.assertEqual([False, True, True],
+            stats.threads_needing_up_thread(graph,
+                [b'base', b'patch-a', b'missing'], contained))
+        self.assertEqual({(b'base', b'patch-a'): False}, contained)
+
+
+class TestDiffstat(TestCaseWithLoom):
+
+    def test_thread_diffstats(self):
+        tree = self.make_branch_and_tree('.')
+        self.build_tree_contents([('a', b'one\ntwo\n'), ('dir/',)])
+        tree.add(['a', 'dir'])
+        bottom = tree.commit('bottom')
+        self.build_tree_contents([('a', b'one\n2\nthree\n'),
+            ('dir/b', b'b\n'), ('binary', b'\x00\x01')])
+        tree.add(['dir/b', 'binary'])
+        top = tree.commit('top')
+        self.addCleanup(tree.branch.lock_read().unlock)
+        self.assertEqual([None, (1, 2, 0), (3, 3, 1)],
+            stats.thread_diffstats(tree.branch.repository,
+                [EMPTY_REVISION, bottom, top]))
+
+
+class TestThreadDependencies(TestCaseWithLoom):
+
+    def test_dependencies(self):
+        builder = self.make_branch_builder('.')
+        builder.build_snapshot(None, [
+            ('add', ('', b'root-id', 'directory', '')),
+            ('add', ('a', b'a-id', 'file', b'a\n')),
+            ('add', ('b', b'b-id', 'file', b'b\n'))],
+            revision_id=b'base')
+        builder.build_snapshot([b'base'],
+            [('modify', ('a', b'a changed\n'))], revision_id=b'one')
+        builder.build_snapshot([b'one'],
+            [('modify', ('b', b'b changed\n'))], revision_id=b'two')
+        builder.build_snapshot([b'two'],
+            [('modify', ('a', b'a changed again\n'))], revision_id=b'three')
+        branch = builder.get_branch()
+        self.addCleanup(branch.lock_read().unlock)
+        self.assertEqual([None, [], [], [1], []],
+            stats.thread_dependencies(branch.repository,
+                [b'base', b'one', b'two', b'three', b'three']))
+
+
+class TestStatsCache(TestCaseWithLoom):
+
+    def test_round_trip(self):
+        transport = self.get_transport()
+        cache = stats.StatsCache(transport)
+        self.assertEqual(None, cache.get(b'a', b'b'))
+        cache.add(b'a', b'b', (1, 2, 3, 4))
+        cache.save()
+        cache = stats.StatsCache(transport)
+        self.assertEqual((1, 2, 3, 4), cache.get(b'a', b'b'))
+
+    def test_evicts_least_recently_used(self):
+        transport = self.get_transport()
+        cache = stats.StatsCache(transport, max_entries=2)
+        cache.add(b'a', b'b', (1, 0, 0, 0))
+        cache.add(b'b', b'c', (2, 0, 0, 0))
+        cache.get(b'a', b'b')
+        cache.add(b'c', b'd', (3, 0, 0, 0))
+        cache.save()
+        cache = stats.StatsCache(transport, max_entries=2)
+        self.assertEqual((1, 0, 0, 0), cache.get(b'a', b'b'))
+        self.assertEqual(None, cache.get(b'b', b'c'))
+        self.assertEqual((3, 0, 0, 0), cache.get(b'c', b'd'))
+
+    def test_ignores_unknown_format(self):
+        transport = self.get_transport()
+        transport.put_bytes('loom-stats', b'garbage\na b 1 2 3 4\n')
+        cache = stats.StatsCache(transport)
+        self.assertEqual(None, cache.get(b'a', b'b'))
+
+    def test_thread_stats_uses_cache(self):
+        tree = self.get_tree_with_loom()
+        bottom = tree.commit('bottom')
+        top = tree.commit('top')
+        self.addCleanup(tree.branch.lock_read().unlock)
+        self.assertEqual([None, (1, 0, 0, 0)],
+            stats.thread_stats(tree.branch, [bottom, top]))
+        cache = stats.StatsCache(tree.branch._transport)
+        self.assertEqual((1, 0, 0, 0), cache.get(bottom, top))
+        cache.add(bottom, top, (5, 6, 7, 8))
+        cache.save()
+        self.assertEqual([None, (5, 6, 7, 8)],
+            stats.thread_stats(tree.branch, [bottom, top]))
+
+
+    def test_thread_stats_only_walks_missing_pairs(self):
+        tree = self.get_tree_with_loom()
+        bottom = tree.commit('bottom')
+        middle = tree.commit('middle')
+        top = tree.commit('top')
+        self.addCleanup(tree.branch.lock_read().unlock)
+        cache = stats.StatsCache(tree.branch._transport)
+        cache.add(bottom, middle, (5, 6, 7, 8))
+        cache.save()
+        walked = []
+        original = stats._pair_revision_counts
+        def pair_revision_counts(graph, pairs):
+            walked.extend(pairs)
+            return original(graph, pairs)
+        self.overrideAttr(stats, '_pair_revision_counts',
+            pair_revision_counts)
+        self.assertEqual([None, (5, 6, 7, 8), (1, 0, 0, 0)],
+            stats.thread_stats(tree.branch, [bottom, middle, top]))
+        self.assertEqual([(middle, top)], walked)
+
+
+class TestSummaryCache(TestCaseWithLoom):
+
+    def test_round_trip(self):
+        transport = self.get_transport()
+        cache = stats.SummaryCache(transport)
+        self.assertEqual(None, cache.get(b'key'))
+        cache.set(b'key', (True, [(False, False), (True, True)]))
+        self.assertEqual((True, [(False, False), (True, True)]),
+            stats.SummaryCache(transport).get(b'key'))
+        self.assertEqual(None, stats.SummaryCache(transport).get(b'other'))
+
+    def test_contained_survives_new_key(self):
+        transport = self.get_transport()
+        self.assertEqual({}, stats.SummaryCache(transport).get_contained())
+        stats.SummaryCache(transport).set(b'key', (False, [(False, False)]),
+            {(b'lower', b'upper'): True})
+        cache = stats.SummaryCache(transport)
+        self.assertEqual(None, cache.get(b'other'))
+        self.assertEqual({(b'lower', b'upper'): True}, cache.get_contained())
+
+    def test_ignores_unknown_format(self):
+        transport = self.get_transport()
+        transport.put_bytes('loom-summary', b'Something else\nkey\n1\n')
+        self.assertEqual(None, stats.SummaryCache(transport).get(b'key'))
+
+
+class TestLoomSummary(TestCaseWithLoom):
+
+    def test_reuses_unchanged_pairs(self):
+        tree = self.get_tree_with_loom()
+        for name, after in [('bottom', None), ('middle', 'bottom'),
+                            ('top', 'middle')]:
+            tree.branch.new_thread(name, after)
+            tree.branch._set_nick(name)
+            tree.commit(name, allow_pointless=True)
+        tree.branch.record_loom('three threads')
+        self.assertEqual((False, [(False, False)] * 3),
+            stats.loom_summary(tree.branch))
+        bottom, middle = [thread[1] for thread in
+            tree.branch.get_loom_state().get_threads()[:2]]
+        tree.commit('top again', allow_pointless=True)
+        known = []
+        original = stats.threads_needing_up_thread
+        def threads_needing_up_thread(graph, revisions, contained=None):
+            known.append(dict(contained))
+            return original(graph, revisions, contained)
+        self.overrideAttr(stats, 'threads_needing_up_thread',
+            threads_needing_up_thread)
+        self.assertEqual((True, [(False, False)] * 2 + [(True, False)]),
+            stats.loom_summary(tree.branch))
+        # Only the pair involving the new top revision is looked up.
+        self.assertEqual([{(bottom, middle): True}], known)
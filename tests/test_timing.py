@@ -0,0 +1,99 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+# 
+
+"""Tests of the loom timing hooks."""
+
+
+from breezy import debug
+
+from breezy.plugins.loom import timing
+from breezy.plugins.loom.tests import TestCaseWithLoom
+
+
+class TestTiming(TestCaseWithLoom):
+
+    def setUp(self):
+        super(TestTiming, self).setUp()
+        self.overrideAttr(debug, 'debug_flags', set())
+        timing.reset_profile()
+        self.addCleanup(timing.reset_profile)
+        self.spans = []
+        self.counts = []
+        timing.hooks.install_named_hook('span',
+            lambda name, seconds: self.spans.append(name), 'test')
+        timing.hooks.install_named_hook('count',
+            lambda name, amount: self.counts.append((name, amount)), 'test')
+
+    def test_hooks(self):
+        with timing.span('outer'):
+            timing.count('event', 2)
+            with timing.span('inner'):
+                pass
+        self.assertEqual(['inner', 'outer'], self.spans)
+        self.assertEqual([('event', 2)], self.counts)
+        # Without -Dloomtime nothing is added up.
+        self.assertEqual(({}, {}), timing.get_profile())
+
+    def test_timed(self):
+        @timing.timed('function')
+        def function(value):
+            return value * 2
+        self.assertEqual(4, function(2))
+        self.assertEqual(['function'], self.spans)
+
+    def test_profile(self):
+        debug.debug_flags.add('loomtime')
+        for unused in range(3):
+            with timing.span('phase'):
+                timing.count('event')
+        spans, counters = timing.get_profile()
+        self.assertEqual(3, spans['phase'][0])
+        self.assertEqual({'event': 3}, counters)
+        lines = timing.format_profile(spans, counters)
+        self.assertContainsRe(lines[1], r'^phase +3 ')
+        self.assertContainsRe(lines[3], r'^event +3$')
+        timing.reset_profile()
+        self.assertEqual(({}, {}), timing.get_profile())
+
+    def test_loom_operations(self):
+        tree = self.get_tree_with_loom()
+        tree.branch.new_thread('bottom')
+        tree.branch._set_nick('bottom')
+        tree.commit('bottom')
+        tree.branch.new_thread('top', 'bottom')
+        del self.spans[:], self.counts[:]
+        tree.branch.record_loom('record')
+        self.assertIn('branch.record_loom', self.spans)
+        self.assertIn('branch.read_state', self.spans)
+        self.assertIn(('last-loom.read', 1), self.counts)
+        self.assertIn(('last-loom.write', 1), self.counts)
+        del self.spans[:], self.counts[:]
+        branch = tree.branch.controldir.sprout('target').open_branch()
+        branch.pull(tree.branch)
+        self.assertIn('transfer.pull', self.spans)
+        self.assertIn(('fetch', 1), self.counts)
+
+
+class TestTimingHooksCleared(TestCaseWithLoom):
+
+    def test_hooks_are_known(self):
+        from breezy.hooks import known_hooks
+        self.assertIn(('breezy.plugins.loom.timing', 'hooks'),
+            known_hooks.keys())
+        # Hooks installed by other tests do not leak into this one.
+        self.assertEqual([], list(timing.hooks['span']))
+        self.assertEqual([], list(timing.hooks['count']))
@@ -19,11 +19,15 @@
 """Tests of the loom Tree related routines."""
 
 
+import time
+
 import breezy
 from breezy import (
     errors,
     merge as _mod_merge,
+    trace,
 )
+from breezy.branch import Branch
 
 from breezy.plugins.loom.branch import EMPTY_REVISION
 from breezy.plugins.loom.tests import TestCaseWithLoom
@@ -67,6 +71,111 @@ class TestTreeDecorator(TestCaseWithLoom):
         self.assertEqual('bottom', tree.branch.nick)
         self.assertEqual([bottom_id], tree.get_parent_ids())
 
+    def test_down_thread_keeps_unrelated_changes(self):
+        loom_tree = self.get_loom_with_two_threads()
+        tree = loom_tree.tree
+        self.build_tree_contents([('source/common', 'common\n')])
+        tree.add('common')
+        tree.commit('bottom')
+        loom_tree.up_thread()
+        self.build_tree_contents([('source/topfile', 'top\n')])
+        tree.add('topfile')
+        tree.commit('top')
+        self.build_tree_contents([('source/common', 'changed\n')])
+        loom_tree.down_thread()
+        self.assertEqual('bottom', tree.branch.nick)
+        self.assertPathDoesNotExist('source/topfile')
+        self.assertFileEqual('changed\n', 'source/common')
+
+    def test_down_thread_caches_thread_inventories(self):
+        loom_tree = self.get_loom_with_two_threads()
+        tree = loom_tree.tree
+        tree.commit('bottom', rev_id=b'bottom-1')
+        loom_tree.up_thread()
+        tree.commit('top', rev_id=b'top-1')
+        repository = tree.branch.repository
+        loom_tree.down_thread()
+        loom_tree.down_thread('top')
+        self.assertEqual([b'top-1'], tree.get_parent_ids())
+        # Switching back does not deserialise either inventory again.
+        loaded = []
+        revision_tree = repository.revision_tree
+        def counting_revision_tree(revision_id):
+            loaded.append(revision_id)
+            return revision_tree(revision_id)
+        repository.revision_tree = counting_revision_tree
+        self.assertEqual(b'bottom-1',
+            loom_tree._thread_tree(b'bottom-1').get_revision_id())
+        self.assertEqual(b'top-1',
+            loom_tree._thread_tree(b'top-1').get_revision_id())
+        self.assertEqual([], loaded)
+        # Other repository objects have caches of their own.
+        other_repository = Branch.open('source').repository
+        self.assertIsNot(repository._loom_thread_inventories,
+            getattr(other_repository, '_loom_thread_inventories', None))
+
+    def test_down_thread_updates_basis_by_delta(self):
+        loom_tree = self.get_loom_with_two_threads()
+        tree = loom_tree.tree
+        self.build_tree(['source/dir/', 'source/dir/a', 'source/b'])
+        tree.add(['dir', 'dir/a', 'b'])
+        tree.commit('bottom', rev_id=b'bottom-1')
+        loom_tree.up_thread()
+        tree.rename_one('dir/a', 'a')
+        tree.remove(['b'], keep_files=False)
+        self.build_tree(['source/c'])
+        tree.add(['c'])
+        tree.commit('top', rev_id=b'top-1')
+        loom_tree.down_thread()
+        self.assertEqual([b'bottom-1'], tree.get_parent_ids())
+        bottom_tree = tree.branch.repository.revision_tree(b'bottom-1')
+        with tree.lock_read():
+            basis_tree = tree.basis_tree()
+            with basis_tree.lock_read():
+                self.assertEqual([], list(basis_tree.iter_changes(bottom_tree)))
+            self.assertFalse(tree.has_changes())
+
+    def test_down_thread_keeps_stat_cache(self):
+        loom_tree = self.get_loom_with_two_threads()
+        tree = loom_tree.tree
+        self.build_tree(['source/unchanged', 'source/changed'])
+        tree.add(['unchanged', 'changed'])
+        tree.commit('bottom', rev_id=b'bottom-1')
+        loom_tree.up_thread()
+        self.build_tree_contents([('source/changed', b'top\n')])
+        tree.commit('top', rev_id=b'top-1')
+        tree.lock_write()
+        self.addCleanup(tree.unlock)
+        state = tree.current_dirstate()
+        # Files younger than the cutoff time are not given cached values.
+        state._cutoff_time = time.time() + 60
+        self.assertFalse(tree.has_changes())
+        details = tree._get_entry(path='unchanged')[1][0]
+        self.assertNotEqual(b'', details[1])
+        replaced = []
+        set_parent_trees = tree.set_parent_trees
+        def record_set_parent_trees(parents_list):
+            replaced.append(parents_list)
+            set_parent_trees(parents_list)
+        tree.set_parent_trees = record_set_parent_trees
+        loom_tree.down_thread()
+        self.assertEqual([], replaced)
+        self.assertEqual(details, tree._get_entry(path='unchanged')[1][0])
+        # So the first status after the switch does not read the file.
+        hashed = []
+        provider = state._sha1_provider
+        class RecordingProvider(object):
+            def sha1(self, abspath):
+                hashed.append(abspath)
+                return provider.sha1(abspath)
+            def stat_and_sha1(self, abspath):
+                hashed.append(abspath)
+                return provider.stat_and_sha1(abspath)
+        state._sha1_provider = RecordingProvider()
+        self.assertFalse(tree.has_changes())
+        self.assertEqual([], [path for path in hashed
+                              if path.endswith('unchanged')])
+
     def test_up_thread(self):
         loom_tree = self.get_loom_with_two_threads()
         tree = loom_tree.tree
@@ -186,6 +295,63 @@ class TestTreeDecorator(TestCaseWithLoom):
         self.assertEqual([b'top-1', b'bottom-2'], rev.parent_ids)
         self.assertEqual('Merge bottom into top', rev.message)
 
+    def test_up_many_fast_forwards(self):
+        loom_tree = self.get_loom_with_three_threads()
+        tree = loom_tree.tree
+        tree.commit('bottom', rev_id=b'bottom-1')
+        loom_tree.up_many()
+        self.assertEqual('top', tree.branch.nick)
+        self.assertEqual([b'bottom-1'], tree.get_parent_ids())
+        # No merge revisions were committed.
+        self.assertEqual(
+            [('bottom', b'bottom-1', []),
+             ('middle', b'bottom-1', []),
+             ('top', b'bottom-1', [])],
+            tree.branch.get_loom_state().get_threads())
+
+    def test_up_many_already_merged(self):
+        loom_tree = self.get_loom_with_two_threads()
+        tree = loom_tree.tree
+        tree.commit('bottom', rev_id=b'bottom-1')
+        loom_tree.up_thread()
+        self.build_tree_contents([('source/a', 'a')])
+        tree.add('a')
+        tree.commit('top', rev_id=b'top-1')
+        loom_tree.down_thread()
+        loom_tree.up_many()
+        self.assertEqual('top', tree.branch.nick)
+        self.assertEqual([b'top-1'], tree.get_parent_ids())
+        self.assertPathExists('source/a')
+
+    def test_up_many_merges_every_thread(self):
+        loom_tree = self.get_loom_with_three_threads()
+        tree = loom_tree.tree
+        tree.commit('bottom', rev_id=b'bottom-1')
+        loom_tree.up_many()
+        self.build_tree_contents([('source/top', 'top')])
+        tree.add('top')
+        tree.commit('top', rev_id=b'top-1')
+        loom_tree.down_thread('middle')
+        self.build_tree_contents([('source/middle', 'middle')])
+        tree.add('middle')
+        tree.commit('middle', rev_id=b'middle-1')
+        loom_tree.down_thread('bottom')
+        tree.commit('bottom', rev_id=b'bottom-2')
+        loom_tree.up_many()
+        self.assertEqual('top', tree.branch.nick)
+        threads = tree.branch.get_loom_state().get_threads()
+        self.assertEqual(['bottom', 'middle', 'top'],
+            [thread[0] for thread in threads])
+        repository = tree.branch.repository
+        middle_rev = repository.get_revision(threads[1][1])
+        self.assertEqual([b'middle-1', b'bottom-2'], middle_rev.parent_ids)
+        self.assertEqual('Merge bottom into middle', middle_rev.message)
+        top_rev = repository.get_revision(threads[2][1])
+        self.assertEqual([b'top-1', threads[1][1]], top_rev.parent_ids)
+        self.assertEqual([threads[2][1]], tree.get_parent_ids())
+        self.assertPathExists('source/middle')
+        self.assertPathExists('source/top')
+
     def test_up_many_halts_on_conflicts(self):
         loom_tree = self.get_loom_with_three_threads()
         tree = loom_tree.tree
@@ -203,6 +369,74 @@ class TestTreeDecorator(TestCaseWithLoom):
         self.assertEqual([b'middle-1', b'bottom-2'], tree.get_parent_ids())
         self.assertEqual(1, len(tree.conflicts()))
 
+    def test_predict_conflicts(self):
+        loom_tree = self.get_loom_with_three_threads()
+        tree = loom_tree.tree
+        self.build_tree_contents([('source/file', 'contents-a')])
+        tree.add('file')
+        tree.commit('bottom', rev_id=b'bottom-1')
+        loom_tree.up_thread()
+        self.build_tree_contents([('source/file', 'contents-b')])
+        tree.commit('middle', rev_id=b'middle-1')
+        loom_tree.down_thread()
+        self.build_tree_contents([('source/file', 'contents-c')])
+        tree.commit('bottom', rev_id=b'bottom-2')
+        [(lower, upper, conflicts)] = loom_tree.predict_conflicts()
+        self.assertEqual(('bottom', 'middle'), (lower, upper))
+        self.assertEqual(['file'], [conflict.path for conflict in conflicts])
+        # The conflict is returned, not warned about.
+        self.assertNotContainsRe(self.get_log(), 'Text conflict in file')
+        # Nothing was changed.
+        self.assertEqual('bottom', tree.branch.nick)
+        self.assertEqual([b'bottom-2'], tree.get_parent_ids())
+        self.assertEqual(
+            [('bottom', b'bottom-2', []),
+             ('middle', b'middle-1', []),
+             ('top', EMPTY_REVISION, [])],
+            tree.branch.get_loom_state().get_threads())
+
+    def test_predict_conflicts_carried_up(self):
+        # A change in the bottom thread only conflicts with the top thread
+        # once an up-thread has carried it through the middle thread.
+        loom_tree = self.get_loom_with_three_threads()
+        tree = loom_tree.tree
+        self.build_tree_contents([('source/file', b'contents-a\n'),
+                                  ('source/other', b'other-a\n')])
+        tree.add(['file', 'other'])
+        tree.commit('bottom', rev_id=b'bottom-1')
+        loom_tree.up_thread()
+        self.build_tree_contents([('source/other', b'other-b\n')])
+        tree.commit('middle', rev_id=b'middle-1')
+        loom_tree.up_thread()
+        self.build_tree_contents([('source/file', b'contents-top\n')])
+        tree.commit('top', rev_id=b'top-1')
+        loom_tree.down_thread('bottom')
+        self.build_tree_contents([('source/file', b'contents-bottom\n')])
+        tree.commit('bottom', rev_id=b'bottom-2')
+        [(lower, upper, conflicts)] = loom_tree.predict_conflicts()
+        self.assertEqual(('middle', 'top'), (lower, upper))
+        self.assertEqual(['file'], [conflict.path for conflict in conflicts])
+
+    def test_predict_conflicts_passes_on_other_warnings(self):
+        loom_tree = self.get_loom_with_three_threads()
+        tree = loom_tree.tree
+        self.build_tree_contents([('source/file', 'contents-a')])
+        tree.add('file')
+        tree.commit('bottom', rev_id=b'bottom-1')
+        loom_tree.up_thread()
+        self.build_tree_contents([('source/file', 'contents-b')])
+        tree.commit('middle', rev_id=b'middle-1')
+        loom_tree.down_thread()
+        self.build_tree_contents([('source/file', 'contents-c')])
+        tree.commit('bottom', rev_id=b'bottom-2')
+        def warn(merger):
+            trace.warning('unrelated warning')
+        _mod_merge.Merger.hooks.install_named_hook('merge_file_content',
+            warn, 'test')
+        self.assertEqual(1, len(loom_tree.predict_conflicts()))
+        self.assertContainsRe(self.get_log(), 'unrelated warning')
+        self.assertNotContainsRe(self.get_log(), 'Text conflict in file')
+
     def test_up_many_target_thread(self):
         loom_tree = self.get_loom_with_three_threads()
         tree = loom_tree.tree
@@ -0,0 +1,159 @@
+# Loom, a plugin for bzr to assist in developing focused patches.
+# Copyright (C) 2006, 2008 Canonical Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+
+"""Timing of the phases of loom operations.
+
+Loom operations are divided into named spans, such as 'branch.read_state'
+or 'tree.merge', and named counters, such as 'last-loom.read' or 'fetch'.
+Finished spans and counted events are reported to the hooks in ``hooks``.
+With the ``-Dloomtime`` debug flag they are also added up, and a summary is
+written to ``.brz.log`` at the end of each command.
+"""
+
+from __future__ import absolute_import
+
+import contextlib
+import functools
+import threading
+import time
+
+from breezy import (
+    debug,
+    hooks as _mod_hooks,
+    trace,
+    )
+
+
+class LoomTimingHooks(_mod_hooks.Hooks):
+    """Hooks for timing loom operations."""
+
+    def __init__(self):
+        _mod_hooks.Hooks.__init__(self, 'breezy.plugins.loom.timing',
+                                  'hooks')
+        self.add_hook('span',
+            "Called when a timed phase of a loom operation finishes. Called "
+            "with the name of the span and the time it took, in seconds.",
+            (3, 0))
+        self.add_hook('count',
+            "Called when a counted loom event happens, such as a read of the "
+            "last-loom file or a fetch. Called with the name of the counter "
+            "and the amount to add to it.", (3, 0))
+
+
+hooks = LoomTimingHooks()
+
+
+# The totals collected for -Dloomtime: span name to [calls, seconds], and
+# counter name to count.
+_profile_lock = threading.Lock()
+_span_totals = {}
+_counter_totals = {}
+
+
+def _profiling():
+    return 'loomtime' in debug.debug_flags
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time the body of a with statement as the span called name."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        if _profiling():
+            with _profile_lock:
+                totals = _span_totals.setdefault(name, [0, 0.0])
+                totals[0] += 1
+                totals[1] += elapsed
+        for hook in hooks['span']:
+            hook(name, elapsed)
+
+
+def timed(name):
+    """Decorate a function so that each call is timed as a span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, amount=1):
+    """Add amount to the counter called name."""
+    if _profiling():
+        with _profile_lock:
+            _counter_totals[name] = _counter_totals.get(name, 0) + amount
+    for hook in hooks['count']:
+        hook(name, amount)
+
+
+def get_profile():
+    """Return the totals collected since the last reset.
+
+    :return: A (spans, counters) tuple. spans maps each span name to a
+        (calls, seconds) tuple, and counters maps each counter name to its
+        count.
+    """
+    with _profile_lock:
+        spans = dict((name, tuple(totals))
+                     for name, totals in _span_totals.items())
+        return spans, dict(_counter_totals)
+
+
+def reset_profile():
+    """Discard the totals collected so far."""
+    with _profile_lock:
+        _span_totals.clear()
+        _counter_totals.clear()
+
+
+def format_profile(spans, counters):
+    """Format the totals returned by get_profile as lines of text.
+
+    Spans are listed slowest first. Spans nest, so the time of a span
+    includes the time of the spans inside it.
+    """
+    lines = []
+    if spans:
+        lines.append('%-32s %8s %10s' % ('span', 'calls', 'seconds'))
+        for name, (calls, seconds) in sorted(spans.items(),
+                key=lambda item: (-item[1][1], item[0])):
+            lines.append('%-32s %8d %10.3f' % (name, calls, seconds))
+    if counters:
+        lines.append('%-32s %8s' % ('counter', 'count'))
+        for name, total in sorted(counters.items()):
+            lines.append('%-32s %8d' % (name, total))
+    return lines
+
+
+def log_profile(command):
+    """Write the totals for command to .brz.log, and reset them.
+
+    This is a post_command hook, and does nothing unless -Dloomtime is set.
+    """
+    if not _profiling():
+        return
+    spans, counters = get_profile()
+    reset_profile()
+    if not spans and not counters:
+        return
+    trace.mutter('loom timings for %s:\n%s', command.name(),
+                 '\n'.join(format_profile(spans, counters)))
@@ -25,16 +25,66 @@ from __future__ import absolute_import
 
 __all__ = ['LoomTreeDecorator']
 
+import logging
+import threading
+
 from breezy import (
+    lru_cache,
     trace,
     )
+from breezy.bzr import (
+    inventorytree as _mod_inventorytree,
+    workingtree_4 as _mod_workingtree_4,
+    )
 import breezy.errors
 import breezy.merge
 import breezy.revision
 
+from breezy.plugins.loom import timing
 from breezy.plugins.loom.branch import EMPTY_REVISION
 
 
+# How many inventories of recently visited thread revisions each repository
+# object keeps, so that long running processes which switch back and forth
+# between the same threads do not deserialise them every time.
+_THREAD_INVENTORY_CACHE_SIZE = 20
+
+
+class _HeldWarnings(logging.Filter):
+    """Hold back the warnings the current thread logs."""
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self._thread = threading.get_ident()
+        self.records = []
+
+    def filter(self, record):
+        if (record.levelno != logging.WARNING or
+            record.thread != self._thread):
+            return True
+        self.records.append(record)
+        return False
+
+
+class _PreviewParentsProvider(object):
+    """The parents in a graph, and those of merges previewed in memory."""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self._previewed = {}
+
+    def add(self, revision_id, parents):
+        self._previewed[revision_id] = parents
+
+    def get_parent_map(self, keys):
+        keys = set(keys)
+        result = {}
+        for key in keys.intersection(self._previewed):
+            result[key] = self._previewed[key]
+        result.update(self.graph.get_parent_map(keys.difference(result)))
+        return result
+
+
 class LoomTreeDecorator(object):
     """Adapt any tree with a loomed branch to give it loom-aware methods.
 
@@ -56,6 +106,7 @@ class LoomTreeDecorator(object):
             raise breezy.errors.BzrCommandError('Cannot switch threads with an'
             ' out-of-date tree. Please run bzr update.')
 
+    @timing.timed('tree.up_thread')
     def up_thread(self, merge_type=None):
         """Move one thread up in the loom."""
         with self.lock_write():
@@ -98,7 +149,8 @@ class LoomTreeDecorator(object):
                     ' has no common ancestor with thread %s'
                     % (new_thread_name, threadname))
             merge_controller.merge_type = merge_type
-            result = merge_controller.do_merge()
+            with timing.span('tree.merge'):
+                result = merge_controller.do_merge()
             # change the tree to the revision of the new thread.
             parent_trees = []
             if new_thread_rev != breezy.revision.NULL_REVISION:
@@ -106,8 +158,9 @@ class LoomTreeDecorator(object):
             # record the merge if:
             # the old thread != new thread (we have something to record)
             # and the new thread is not a descendant of old thread
-            if (old_thread_rev != new_thread_rev and not
-                graph.is_ancestor(old_thread_rev, new_thread_rev)):
+            with timing.span('tree.graph'):
+                merged = graph.is_ancestor(old_thread_rev, new_thread_rev)
+            if old_thread_rev != new_thread_rev and not merged:
                 basis_tree = self.tree.basis_tree()
                 basis_tree.lock_read()
                 parent_trees.append((old_thread_rev, basis_tree))
@@ -137,7 +190,11 @@ class LoomTreeDecorator(object):
             else:
                 return 0
 
-    def up_many(self, merge_type=None, target_thread=None):
+    def _up_target(self, target_thread):
+        """Check and return the thread an up-thread would stop at.
+
+        :param target_thread: The requested thread, or None for the top one.
+        """
         loom_state = self.branch.get_loom_state()
         threads = loom_state.get_threads()
         if target_thread is None:
@@ -151,15 +208,262 @@ class LoomTreeDecorator(object):
             if lower_thread_i > upper_thread_i:
                 raise breezy.errors.BzrCommandError(
                     "Cannot up-thread to lower thread.")
+        return target_thread
+
+    @timing.timed('tree.up_many')
+    def up_many(self, merge_type=None, target_thread=None):
+        target_thread = self._up_target(target_thread)
+        if not self.tree.has_changes():
+            return self._up_many_in_memory(merge_type, target_thread)
         while self.branch.nick != target_thread:
             old_nick = self.branch.nick
+            if self._up_thread_without_merge():
+                continue
             result = self.up_thread(merge_type)
             if result != 0:
                 return result
             if len(self.tree.get_parent_ids()) > 1:
-                self.tree.commit('Merge %s into %s' % (old_nick,
-                                                       self.branch.nick))
+                with timing.span('tree.commit'):
+                    self.tree.commit('Merge %s into %s' % (old_nick,
+                                                           self.branch.nick))
+
+    def _up_many_in_memory(self, merge_type, target_thread):
+        """Move up to target_thread without writing each merge to the tree.
+
+        Every merge is computed on a preview of the thread above and committed
+        straight into the repository, and the loom state is written once. The
+        working tree is then switched to target_thread in a single step.
 
+        If a merge would conflict, the threads below it are recorded and that
+        merge alone is done in the working tree, exactly as up_thread does.
+        """
+        if merge_type is None:
+            merge_type = breezy.merge.Merge3Merger
+        with self.lock_write():
+            self._check_switch()
+            state = self.branch.get_loom_state()
+            threads = state.get_threads()
+            current_index = state.thread_index(self.branch.nick)
+            target_index = state.thread_index(target_thread)
+            graph = self.branch.repository.get_graph()
+            new_revisions = {}
+            lower_rev = self.tree.last_revision()
+            for index in range(current_index + 1, target_index + 1):
+                lower_name = threads[index - 1][0]
+                upper_name, upper_rev, _ = threads[index]
+                if upper_rev == EMPTY_REVISION:
+                    upper_rev = breezy.revision.NULL_REVISION
+                if upper_rev != lower_rev:
+                    with timing.span('tree.graph'):
+                        heads = graph.heads([lower_rev, upper_rev])
+                    if heads == set([lower_rev]):
+                        # fast-forward the thread above.
+                        upper_rev = lower_rev
+                    elif heads != set([upper_rev]):
+                        upper_rev = self._commit_merge_in_memory(graph,
+                            lower_rev, upper_rev, merge_type,
+                            upper_name, 'Merge %s into %s' % (lower_name,
+                                                              upper_name))
+                        if upper_rev is None:
+                            # conflicts: let the user resolve them in the tree.
+                            self.branch.record_threads(new_revisions)
+                            if index - 1 != current_index:
+                                self.down_thread(lower_name)
+                            return self.up_thread(merge_type)
+                new_revisions[upper_name] = upper_rev
+                lower_rev = upper_rev
+            self.branch.record_threads(new_revisions)
+            if lower_rev == self.tree.last_revision():
+                # special case no-change condition.
+                self.branch._set_nick(target_thread)
+            else:
+                self.down_thread(target_thread)
+            return 0
+
+    @timing.timed('tree.predict_conflicts')
+    def predict_conflicts(self, merge_type=None, target_thread=None):
+        """Predict the conflicts an up-thread to target_thread would hit.
+
+        Each thread from the current one up to target_thread is merged into
+        the thread above it in memory, using the thread revisions as they
+        are now. As in a real up-thread, the result of each merge is what is
+        merged into the next thread, so conflicts with changes carried up
+        from lower threads are found too. After a merge that conflicts the
+        upper thread is carried up as it is, since how the conflict will be
+        resolved is not known. Nothing is committed and the tree is not
+        changed.
+
+        :return: A list of (lower_thread, upper_thread, conflicts) tuples, one
+            for each pair of threads whose merge conflicts.
+        """
+        if merge_type is None:
+            merge_type = breezy.merge.Merge3Merger
+        with self.lock_read():
+            target_thread = self._up_target(target_thread)
+            state = self.branch.get_loom_state()
+            threads = state.get_threads()
+            current_index = state.thread_index(self.branch.nick)
+            target_index = state.thread_index(target_thread)
+            # Merges previewed in memory are added to the graph, so the next
+            # merge finds the same base as it would after a real commit.
+            previewed = _PreviewParentsProvider(
+                self.branch.repository.get_graph())
+            graph = type(previewed.graph)(previewed)
+            result = []
+            lower_rev = self.tree.last_revision()
+            lower_transform = None
+            try:
+                for index in range(current_index + 1, target_index + 1):
+                    lower_name = threads[index - 1][0]
+                    upper_name, upper_rev, _ = threads[index]
+                    if upper_rev == EMPTY_REVISION:
+                        upper_rev = breezy.revision.NULL_REVISION
+                    if upper_rev == lower_rev:
+                        continue
+                    heads = graph.heads([lower_rev, upper_rev])
+                    if heads == set([lower_rev]):
+                        # The upper thread would be fast-forwarded.
+                        continue
+                    merged_rev, merged_transform = upper_rev, None
+                    if heads != set([upper_rev]):
+                        lower_tree = None
+                        if lower_transform is not None:
+                            lower_tree = lower_transform.get_preview_tree()
+                        merge, transform = self._preview_merge(graph,
+                            lower_rev, upper_rev, merge_type, upper_name,
+                            lower_tree)
+                        if merge.cooked_conflicts:
+                            result.append((lower_name, upper_name,
+                                           list(merge.cooked_conflicts)))
+                            transform.finalize()
+                        else:
+                            merged_rev = b'loom-preview:%d' % index
+                            previewed.add(merged_rev, (upper_rev, lower_rev))
+                            merged_transform = transform
+                    if lower_transform is not None:
+                        lower_transform.finalize()
+                    lower_rev, lower_transform = merged_rev, merged_transform
+            finally:
+                if lower_transform is not None:
+                    lower_transform.finalize()
+            return result
+
+    @timing.timed('tree.merge')
+    def _preview_merge(self, graph, lower_rev, upper_rev, merge_type,
+                       upper_name, lower_tree=None):
+        """Merge lower_rev into upper_rev on a preview transform.
+
+        :param lower_tree: The tree of lower_rev, if it is not in the
+            repository but a merge previewed in memory.
+        :return: The merger and its preview transform. The caller must
+            finalize the transform.
+        """
+        upper_tree = self._thread_tree(upper_rev)
+        merger = breezy.merge.Merger(self.branch, this_tree=upper_tree,
+            revision_graph=graph)
+        # The branch is not at upper_rev, so Merger's default basis is wrong.
+        merger.this_basis = upper_rev
+        try:
+            if lower_tree is None:
+                merger.set_other_revision(lower_rev, self.branch)
+            else:
+                merger.other_rev_id = merger.other_basis = lower_rev
+                merger.other_branch = self.branch
+                merger.other_tree = lower_tree
+            merger.find_base()
+        except breezy.errors.UnrelatedBranches:
+            raise breezy.errors.BzrCommandError('corrupt loom: thread %s'
+                ' has no common ancestor with revision %s'
+                % (upper_name, lower_rev.decode('utf-8')))
+        merger.merge_type = merge_type
+        merge = merger.make_merger()
+        # Conflicts are reported by the callers, but the merger also warns
+        # about each one. Hold its warnings back and pass on any others.
+        brz_logger = logging.getLogger('brz')
+        held = _HeldWarnings()
+        brz_logger.addFilter(held)
+        try:
+            transform = merge.make_preview_transform()
+        finally:
+            brz_logger.removeFilter(held)
+        described = set(conflict.describe()
+                        for conflict in merge.cooked_conflicts)
+        for record in held.records:
+            if record.getMessage() not in described:
+                brz_logger.handle(record)
+        return merge, transform
+
+    def _commit_merge_in_memory(self, graph, lower_rev, upper_rev, merge_type,
+                                upper_name, message):
+        """Commit a merge of lower_rev into upper_rev without using the tree.
+
+        :return: The new revision id, or None if the merge has conflicts.
+        """
+        merge, transform = self._preview_merge(graph, lower_rev, upper_rev,
+            merge_type, upper_name)
+        try:
+            if merge.cooked_conflicts:
+                return None
+            with timing.span('tree.commit'):
+                builder = self.branch.get_commit_builder(
+                    [upper_rev, lower_rev],
+                    revprops={'branch-nick': upper_name})
+                for unused in builder.record_iter_changes(
+                    transform.get_preview_tree(), upper_rev,
+                    transform.iter_changes()):
+                    pass
+                builder.finish_inventory()
+                return builder.commit(message)
+        finally:
+            transform.finalize()
+
+    def _up_thread_without_merge(self):
+        """Move one thread up if the graph shows no merge is needed.
+
+        If the next thread up is an ancestor of the current thread it is
+        fast-forwarded to the current thread, and if it already contains the
+        current thread the tree is simply switched to it. Neither case needs
+        a merge or a commit.
+
+        :return: True if the branch was moved up, False if up_thread must do
+            a real merge.
+        """
+        with self.lock_write():
+            self._check_switch()
+            if len(self.tree.get_parent_ids()) > 1:
+                # Pending merges need the full merge machinery.
+                return False
+            state = self.branch.get_loom_state()
+            threads = state.get_threads()
+            old_thread_index = state.thread_index(self.branch.nick)
+            if old_thread_index + 1 >= len(threads):
+                return False
+            # The tree tip, not the loom state, is authoritative here: an
+            # outer lock may not have recorded earlier steps yet.
+            old_thread_rev = self.tree.last_revision()
+            new_thread_name, new_thread_rev, _ = threads[old_thread_index + 1]
+            if new_thread_rev == EMPTY_REVISION:
+                new_thread_rev = breezy.revision.NULL_REVISION
+            if new_thread_rev == old_thread_rev:
+                self.branch._set_nick(new_thread_name)
+                return True
+            graph = self.branch.repository.get_graph()
+            with timing.span('tree.graph'):
+                heads = graph.heads([old_thread_rev, new_thread_rev])
+            if heads == set([old_thread_rev]):
+                # The thread above has nothing of its own: fast-forward it.
+                # The branch is already at old_thread_rev, so unlock will
+                # record it for the new thread.
+                self.branch._set_nick(new_thread_name)
+                trace.note("Moved to thread '%s'." % new_thread_name)
+                return True
+            if heads == set([new_thread_rev]):
+                # The thread above already contains this one.
+                self.down_thread(new_thread_name)
+                return True
+            return False
+
+    @timing.timed('tree.down_thread')
     def down_thread(self, name=None):
         """Move to a thread down in the loom.
 
@@ -196,29 +500,100 @@ class LoomTreeDecorator(object):
             try:
                 basis_tree = self.tree.revision_tree(old_thread_rev)
             except breezy.errors.NoSuchRevisionInTree:
-                basis_tree = repository.revision_tree(old_thread_rev)
-            to_tree = repository.revision_tree(new_thread_rev)
-            result = breezy.merge.merge_inner(self.tree.branch,
-                to_tree,
-                basis_tree,
-                this_tree=self.tree)
+                basis_tree = self._thread_tree(old_thread_rev)
+            to_tree = self._thread_tree(new_thread_rev)
+            result = self._merge_thread_changes(basis_tree, to_tree)
             branch_revno, branch_revision = self.tree.branch.last_revision_info()
             graph = repository.get_graph()
-            new_thread_revno = graph.find_distance_to_null(new_thread_rev,
-                [(branch_revision, branch_revno)])
+            with timing.span('tree.graph'):
+                new_thread_revno = graph.find_distance_to_null(
+                    new_thread_rev, [(branch_revision, branch_revno)])
             self.tree.branch.set_last_revision_info(new_thread_revno,
                                                     new_thread_rev)
-            if new_thread_rev == breezy.revision.NULL_REVISION:
-                parent_list = []
-            else:
-                parent_list = [(new_thread_rev, to_tree)]
-            self.tree.set_parent_trees(parent_list)
+            self._set_thread_basis(old_thread_rev, new_thread_rev, to_tree)
             breezy.trace.note("Moved to thread '%s'." % new_thread_name)
             return result
 
+    def _thread_tree(self, revision_id):
+        """Get the revision tree for a thread revision.
+
+        The inventory is reused when a recent operation on the same
+        repository object has already loaded it. Inventories may load their
+        content lazily from the repository they were read from, so the cache
+        hangs off the repository object and goes away with it.
+        """
+        repository = self.branch.repository
+        cache = getattr(repository, '_loom_thread_inventories', None)
+        if cache is None:
+            cache = repository._loom_thread_inventories = lru_cache.LRUCache(
+                max_cache=_THREAD_INVENTORY_CACHE_SIZE)
+        inventory = cache.get(revision_id)
+        if inventory is not None:
+            return _mod_inventorytree.InventoryRevisionTree(repository,
+                inventory, revision_id)
+        tree = repository.revision_tree(revision_id)
+        if (revision_id != breezy.revision.NULL_REVISION and
+            isinstance(tree, _mod_inventorytree.InventoryRevisionTree)):
+            cache[revision_id] = tree.root_inventory
+        return tree
+
+    def _set_thread_basis(self, old_thread_rev, new_thread_rev, to_tree):
+        """Make to_tree, the tree of new_thread_rev, the basis of the tree.
+
+        Dirstate trees whose only parent is old_thread_rev are updated with
+        the inventory delta between the two thread revisions. The dirstate
+        entries of files that are the same in both threads, including their
+        cached stat and sha1 values, are left alone, so the first status after
+        a switch does not have to rehash them.
+        """
+        if (isinstance(self.tree, _mod_workingtree_4.DirStateWorkingTree) and
+            old_thread_rev != breezy.revision.NULL_REVISION and
+            new_thread_rev != breezy.revision.NULL_REVISION and
+            self.tree.get_parent_ids() == [old_thread_rev]):
+            old_tree = self._thread_tree(old_thread_rev)
+            if (isinstance(old_tree, _mod_inventorytree.InventoryRevisionTree)
+                and isinstance(to_tree,
+                               _mod_inventorytree.InventoryRevisionTree)):
+                delta = to_tree.root_inventory._make_delta(
+                    old_tree.root_inventory)
+                self.tree.update_basis_by_delta(new_thread_rev, delta)
+                return
+        if new_thread_rev == breezy.revision.NULL_REVISION:
+            parent_list = []
+        else:
+            parent_list = [(new_thread_rev, to_tree)]
+        self.tree.set_parent_trees(parent_list)
+
+    @timing.timed('tree.merge')
+    def _merge_thread_changes(self, basis_tree, to_tree):
+        """Merge the changes from basis_tree to to_tree into the tree.
+
+        Only the paths that differ between the two thread trees take part in
+        the merge, so switching threads costs time in proportion to the
+        difference between them rather than to the size of the tree.
+        """
+        changed_paths = set()
+        with basis_tree.lock_read(), to_tree.lock_read():
+            for change in to_tree.iter_changes(basis_tree):
+                changed_paths.update(
+                    path for path in change.path if path is not None)
+        if not changed_paths:
+            # Nothing to merge; report it as merge_inner would.
+            trace.note('All changes applied successfully.')
+            return 0
+        return breezy.merge.merge_inner(self.tree.branch,
+            to_tree,
+            basis_tree,
+            interesting_files=sorted(changed_paths),
+            this_tree=self.tree)
+
+    def lock_read(self):
+        return self.tree.lock_read()
+
     def lock_write(self):
         return self.tree.lock_write()
 
+    @timing.timed('tree.revert_loom')
     def revert_loom(self, thread=None):
         """Revert the loom. This function takes care of tree state for revert.
 
@@ -258,12 +633,9 @@ class LoomTreeDecorator(object):
             if to_rev == EMPTY_REVISION:
                 to_rev = breezy.revision.NULL_REVISION
             # the thread changed, do a merge to match.
-            basis_tree = self.tree.branch.repository.revision_tree(current_thread_rev)
-            to_tree = self.tree.branch.repository.revision_tree(to_rev)
-            result = breezy.merge.merge_inner(self.tree.branch,
-                to_tree,
-                basis_tree,
-                this_tree=self.tree)
+            basis_tree = self._thread_tree(current_thread_rev)
+            to_tree = self._thread_tree(to_rev)
+            result = self._merge_thread_changes(basis_tree, to_tree)
             self.tree.set_last_revision(to_rev)
 
     def unlock(self):